@@ -95,9 +95,51 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Parallel maintenance workers and Celery write concurrently: take the
+        # write lock when a transaction starts and wait for it instead of failing
+        'OPTIONS': {
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# Cache
+# A shared backend lets every worker process see rating-table version changes.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds between checks of the shared rating-table version stamp
+RATING_TABLES_VERSION_CHECK_INTERVAL = 5
+
+# Premium payment row locks: longest wait per attempt (ms), retries, and the
+# wait (seconds) above which a lock wait is logged as slow
+PAYMENT_LOCK_TIMEOUT_MS = 2000
+PAYMENT_LOCK_RETRIES = 2
+PAYMENT_LOCK_SLOW_WAIT = 0.5
+
+# Policy number and receipt serials each process reserves per database round trip
+POLICY_NUMBER_BLOCK_SIZE = 20
+RECEIPT_NUMBER_BLOCK_SIZE = 100
+
+# Outbox events handled per drain transaction, and attempts before an event is left for inspection
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Rows loaded and written per query when bulk_mode() applies deferred side effects
+BULK_CHUNK_SIZE = 1000
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -12,6 +12,7 @@ from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 from django.db.models.signals import post_save
 from datetime import date, timedelta
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.utils.html import format_html
@@ -22,8 +23,10 @@ from .frontend_data import *
 from .models import (
     InsurancePolicy, SalesAgent, PolicyHolder, Underwriting,
     ClaimRequest, ClaimProcessing, PremiumPayment,MortalityRate,
-    EmployeePosition, Employee, PaymentProcessing, Branch, Company, AgentReport, AgentApplication, Occupation, DurationFactor, GSVRate, SSVConfig, Bonus, BonusRate, Loan, LoanRepayment,UserProfile, OTP, Commission, PolicySurrender, PolicyRenewal
+    EmployeePosition, Employee, PaymentProcessing, Branch, Company, AgentReport, AgentApplication, Occupation, DurationFactor, GSVRate, SSVConfig, Bonus, BonusRate, Loan, LoanRepayment,UserProfile, OTP, Commission, PolicySurrender, PolicyRenewal,
+    RatingTableVersion, PremiumTransaction, OutboxEvent, BatchJobRun, LoanInterestAccrual, JobLease, PolicyEvent
 )
+from .rating_tables import get_rating_tables
 from decimal import Decimal, InvalidOperation as DecimalException
 
 from django.utils.translation import gettext_lazy as _
@@ -74,19 +77,90 @@ class InsurancePolicyAdmin(admin.ModelAdmin):
     search_fields = ('name', 'policy_type')
     inlines = [GSVRateInline, SSVConfigInline]
 
+# Rating Table Version Admin
+@admin.register(RatingTableVersion)
+class RatingTableVersionAdmin(admin.ModelAdmin):
+    list_display = ('name', 'effective_date', 'is_active', 'activated_at', 'created_at')
+    list_filter = ('is_active',)
+    readonly_fields = ('is_active', 'activated_at', 'created_at')
+    actions = ['activate_versions']
+
+    def activate_versions(self, request, queryset):
+        """Admin action to activate selected draft versions"""
+        activated_count = 0
+        for version in queryset.filter(is_active=False):
+            try:
+                version.activate()
+                activated_count += 1
+            except ValidationError as e:
+                self.message_user(request, f"{version}: {str(e)}", level=messages.ERROR)
+
+        if activated_count > 0:
+            self.message_user(request, f"Activated {activated_count} rating table versions.", level=messages.SUCCESS)
+        else:
+            self.message_user(request, "No draft versions were selected.", level=messages.WARNING)
+    activate_versions.short_description = "Activate selected versions"
+
+# Outbox Admin
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event_type', 'created_at', 'processed_at', 'attempts', 'last_error')
+    list_filter = ('event_type', ('processed_at', admin.EmptyFieldListFilter))
+    readonly_fields = ('event_type', 'payload', 'created_at', 'processed_at', 'attempts', 'last_error')
+    actions = ['retry_events']
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_events(self, request, queryset):
+        """Admin action to give failed events another round of attempts"""
+        retried = queryset.filter(processed_at__isnull=True).update(attempts=0)
+        self.message_user(request, f"Queued {retried} events for retry.", level=messages.SUCCESS)
+    retry_events.short_description = "Retry selected events"
+
+@admin.register(BatchJobRun)
+class BatchJobRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job_name', 'shard', 'as_of_date', 'status', 'last_key', 'started_at', 'finished_at')
+    list_filter = ('job_name', 'status')
+    readonly_fields = (
+        'job_name', 'shard', 'as_of_date', 'last_key', 'counts', 'status', 'error',
+        'started_at', 'checkpointed_at', 'finished_at',
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(PolicyEvent)
+class PolicyEventAdmin(admin.ModelAdmin):
+    list_display = ('policy_holder', 'event_type', 'due_date', 'status', 'processed_at')
+    list_filter = ('event_type', 'status', 'due_date')
+    search_fields = ('policy_holder__policy_number',)
+    readonly_fields = ('policy_holder', 'event_type', 'due_date', 'status', 'processed_at')
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(JobLease)
+class JobLeaseAdmin(admin.ModelAdmin):
+    list_display = ('name', 'holder', 'token', 'acquired_at', 'expires_at')
+    readonly_fields = ('name', 'holder', 'token', 'acquired_at', 'expires_at')
+
+    def has_add_permission(self, request):
+        return False
+
 #Bonus Rate Admin
 @admin.register(BonusRate)
 class BonusRateAdmin(admin.ModelAdmin):
-    list_display = ('year', 'policy_type', 'min_year', 'max_year', 'bonus_per_thousand')
+    list_display = ('year', 'policy_type', 'min_year', 'max_year', 'bonus_per_thousand', 'rating_version')
     ordering = ['year', 'policy_type', 'min_year']
     search_fields = ('year', 'policy_type')
-    list_filter = ('year', 'policy_type')
+    list_filter = ('year', 'policy_type', 'rating_version')
 
 # Register Duration Factor
 @admin.register(DurationFactor)
 class DurationFactorAdmin(admin.ModelAdmin):
-    list_display = ( 'policy_type', 'min_duration', 'max_duration', 'factor')
-    list_filter = ( 'policy_type', 'factor')
+    list_display = ( 'policy_type', 'min_duration', 'max_duration', 'factor', 'rating_version')
+    list_filter = ( 'policy_type', 'factor', 'rating_version')
     search_fields = ('company__name',)
 
 # Register Underwriting
@@ -162,6 +236,17 @@ class PremiumPaymentForm(forms.ModelForm):
     
 # Register Premium Payment
 
+class PremiumTransactionInline(admin.TabularInline):
+    model = PremiumTransaction
+    extra = 0
+    can_delete = False
+    fields = ('payment_date', 'receipt_number', 'amount', 'premium_amount', 'fine_amount',
+              'vat_amount', 'service_tax', 'tds_amount')
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 @admin.register(PremiumPayment)
 class PremiumPaymentAdmin(admin.ModelAdmin, BranchFilterMixin):
     list_display = ('policy_holder', 'annual_premium', 'interval_payment', 'total_premium',
@@ -170,6 +255,7 @@ class PremiumPaymentAdmin(admin.ModelAdmin, BranchFilterMixin):
                        'remaining_premium', 'payment_status', 'next_payment_date', 'fine_due', 'fine_paid')
     search_fields = ('policy_holder__first_name', 'policy_holder__last_name', 'policy_holder__policy_number')
     list_filter = ('payment_status',)
+    inlines = [PremiumTransactionInline]
     actions = ['add_payment', 'check_policy_expiry']
 
     def get_queryset(self, request):
@@ -447,7 +533,8 @@ class AgentApplicationAdmin(BranchFilterMixin,admin.ModelAdmin):
         
 @admin.register(MortalityRate)
 class MortalityRateAdmin(admin.ModelAdmin):
-    list_display = ('age_range_display', 'rate', 'edit_button')
+    list_display = ('age_range_display', 'rate', 'rating_version', 'edit_button')
+    list_filter = ('rating_version',)
     search_fields = ('age_group_start', 'age_group_end')
     change_list_template = "mortalityrate/mortality_changelist.html"
     change_form_template = "mortalityrate/mortality_from.html"
@@ -456,8 +543,10 @@ class MortalityRateAdmin(admin.ModelAdmin):
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
         
-        # Get all mortality rates for the chart
-        rates = MortalityRate.objects.all().order_by('age_group_start')
+        # Get the mortality rates in force for the chart
+        rates = MortalityRate.objects.filter(
+            rating_version_id=get_rating_tables().rating_version_id
+        ).order_by('age_group_start')
         age_ranges = [f"{rate.age_group_start}-{rate.age_group_end}" for rate in rates]
         rate_values = [float(rate.rate) for rate in rates]
         
@@ -473,8 +562,10 @@ class MortalityRateAdmin(admin.ModelAdmin):
         obj = self.get_object(request, object_id)
         
         if obj:
-            # Get all mortality rates for the chart
-            rates = MortalityRate.objects.all().order_by('age_group_start')
+            # Get the mortality rates in force for the chart
+            rates = MortalityRate.objects.filter(
+                rating_version_id=get_rating_tables().rating_version_id
+            ).order_by('age_group_start')
             age_ranges = [f"{rate.age_group_start}-{rate.age_group_end}" for rate in rates]
             rate_values = [float(rate.rate) for rate in rates]
             
@@ -561,14 +652,18 @@ class MortalityRateAdmin(admin.ModelAdmin):
                 
                 if bulk_form.is_valid():
                     try:
-                        for i, range_data in enumerate(age_ranges):
-                            rate_value = bulk_form.cleaned_data[f'rate_{i}']
-                            MortalityRate.objects.create(
-                                age_group_start=range_data['start'],
-                                age_group_end=range_data['end'],
-                                rate=rate_value
-                            )
-                        messages.success(request, 'Mortality rates created successfully.')
+                        RatingTableVersion.publish(
+                            f"Mortality rates {timezone.now():%Y-%m-%d %H:%M}",
+                            {MortalityRate: [
+                                MortalityRate(
+                                    age_group_start=range_data['start'],
+                                    age_group_end=range_data['end'],
+                                    rate=bulk_form.cleaned_data[f'rate_{i}']
+                                )
+                                for i, range_data in enumerate(age_ranges)
+                            ]},
+                        )
+                        messages.success(request, 'Mortality rates published as a new rating table version.')
                         return HttpResponseRedirect(
                             reverse('admin:app_mortalityrate_changelist')
                         )
@@ -608,13 +703,23 @@ class LoanRepaymentInline(admin.StackedInline):
     fields = ('amount', 'repayment_type', 'repayment_date', 'remaining_loan_balance')
     can_delete = False
 
+class LoanInterestAccrualInline(admin.TabularInline):
+    model = LoanInterestAccrual
+    extra = 0
+    fields = ('accrual_date', 'from_date', 'days', 'principal', 'interest_rate', 'amount')
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
 #Loan Admin
 @admin.register(Loan)
 class LoanAdmin(admin.ModelAdmin, BranchFilterMixin):
     list_display = ('policy_holder', 'loan_amount', 'remaining_balance', 'accrued_interest', 'loan_status', 'created_at', 'print_button')
     readonly_fields = ('remaining_balance', 'accrued_interest', 'last_interest_date')
     search_fields = ('policy_holder__first_name', 'policy_holder__last_name')
-    inlines = [LoanRepaymentInline]
+    inlines = [LoanRepaymentInline, LoanInterestAccrualInline]
     
     def get_urls(self):
         urls = super().get_urls()
@@ -1241,7 +1346,7 @@ class SalesAgentAdmin(BranchFilterMixin, admin.ModelAdmin):
             'fields': ('user', 'branch', 'application', 'agent_code', 'phone_number', 'email', 'is_active')
         }),
         ('Commission Details', {
-            'fields': ('commission_rate', 'total_policies_sold', 'total_premium_collected', 'last_policy_date')
+            'fields': ('commission_rate', 'total_policies_sold', 'total_premium_collected', 'last_policy_date', 'counter_shards')
         }),
         ('Status Information', {
             'fields': ('status', 'joining_date', 'termination_date', 'termination_reason')
@@ -0,0 +1,234 @@
+import logging
+import random
+from datetime import date
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DecimalField, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncMonth
+
+from .models import AgentCounterShard, AgentReport, PolicyHolder, PremiumTransaction, SalesAgent
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+
+
+def _report_defaults(month):
+    return {'reporting_period': f"{month.year}-{month.month}", 'month': month.month, 'year': month.year}
+
+
+def _increment(rows, create, **values):
+    """Apply ``values`` (F() increments) to the one row of ``rows``, creating it first if needed."""
+    if rows.update(**values):
+        return
+    try:
+        with transaction.atomic():
+            create()
+    except IntegrityError:
+        # Created concurrently; the update below applies to that row
+        pass
+    rows.update(**values)
+
+
+def _latest(field, day):
+    """Update expression moving a date field forward to ``day``, never back."""
+    return Case(
+        When(Q(**{f'{field}__isnull': True}) | Q(**{f'{field}__lt': day}), then=Value(day)),
+        default=F(field),
+    )
+
+
+def _apply_sales(agent, month, policies_sold, premium_collected, last_policy_date=None):
+    """Add sales to an agent's totals and monthly report with atomic F() updates."""
+    agent_values = {
+        'total_policies_sold': F('total_policies_sold') + policies_sold,
+        'total_premium_collected': F('total_premium_collected') + premium_collected,
+    }
+    if last_policy_date:
+        agent_values['last_policy_date'] = _latest('last_policy_date', last_policy_date)
+    SalesAgent.objects.filter(pk=agent.pk).update(**agent_values)
+
+    report_key = {'agent_id': agent.pk, 'branch_id': agent.branch_id, 'report_date': month}
+    _increment(
+        AgentReport.objects.filter(**report_key),
+        lambda: AgentReport.objects.create(**report_key, **_report_defaults(month)),
+        policies_sold=F('policies_sold') + policies_sold,
+        total_premium=F('total_premium') + premium_collected,
+    )
+
+
+def record_sales(agent, on_date, policies_sold=0, premium_collected=ZERO):
+    """
+    Count sales towards an agent and their report for the month of
+    ``on_date``. Sharded agents update a random one of their counter
+    shards instead of their own row, so concurrent sales don't queue on it.
+    """
+    month = on_date.replace(day=1)
+    last_policy_date = on_date if policies_sold else None
+    if agent.counter_shards <= 1:
+        _apply_sales(agent, month, policies_sold, premium_collected, last_policy_date)
+        return
+
+    shard_key = {'agent_id': agent.pk, 'month': month, 'shard': random.randrange(agent.counter_shards)}
+    values = {
+        'policies_sold': F('policies_sold') + policies_sold,
+        'premium_collected': F('premium_collected') + premium_collected,
+    }
+    if last_policy_date:
+        values['last_policy_date'] = _latest('last_policy_date', last_policy_date)
+    _increment(
+        AgentCounterShard.objects.filter(**shard_key),
+        lambda: AgentCounterShard.objects.create(**shard_key),
+        **values,
+    )
+
+
+def roll_up_counter_shards():
+    """
+    Fold the counter shards into agent totals and monthly reports and reset
+    them. Returns the number of agent months rolled up.
+    """
+    with transaction.atomic():
+        shards = list(
+            AgentCounterShard.objects.select_for_update()
+            .exclude(policies_sold=0, premium_collected=0)
+            .select_related('agent')
+        )
+        totals = {}
+        for shard in shards:
+            agent, policies_sold, premium_collected, last_policy_date = totals.get(
+                (shard.agent_id, shard.month), (shard.agent, 0, ZERO, None)
+            )
+            if shard.last_policy_date and (last_policy_date is None or shard.last_policy_date > last_policy_date):
+                last_policy_date = shard.last_policy_date
+            totals[(shard.agent_id, shard.month)] = (
+                agent, policies_sold + shard.policies_sold, premium_collected + shard.premium_collected, last_policy_date
+            )
+
+        for (_, month), (agent, policies_sold, premium_collected, last_policy_date) in totals.items():
+            _apply_sales(agent, month, policies_sold, premium_collected, last_policy_date)
+        # The rows stay locked until commit, so no sale lands between the read and the reset
+        AgentCounterShard.objects.filter(pk__in=[shard.pk for shard in shards]).update(
+            policies_sold=0, premium_collected=ZERO
+        )
+        AgentCounterShard.objects.filter(
+            month__lt=date.today().replace(day=1), policies_sold=0, premium_collected=0
+        ).delete()
+
+    if totals:
+        logger.info(f"AGENT COUNTERS - Rolled up {len(shards)} shards into {len(totals)} agent months")
+    return len(totals)
+
+
+def _shard_total(field):
+    return Subquery(
+        AgentCounterShard.objects.filter(agent=OuterRef('pk'))
+        .values('agent').annotate(total=Sum(field)).values('total')
+    )
+
+
+def with_sales_totals(agents):
+    """
+    Annotate a SalesAgent queryset with ``policies_sold_total`` and
+    ``premium_collected_total``, including sales not yet rolled up from
+    counter shards.
+    """
+    return agents.annotate(
+        policies_sold_total=F('total_policies_sold') + Coalesce(
+            _shard_total('policies_sold'), Value(0), output_field=IntegerField()
+        ),
+        premium_collected_total=F('total_premium_collected') + Coalesce(
+            _shard_total('premium_collected'), Value(ZERO), output_field=DecimalField(max_digits=12, decimal_places=2)
+        ),
+    )
+
+
+def add_unrolled_sales(report):
+    """Add the sales of the report's month still in counter shards to a loaded AgentReport."""
+    totals = AgentCounterShard.objects.filter(agent_id=report.agent_id, month=report.report_date).aggregate(
+        policies_sold=Sum('policies_sold'), premium_collected=Sum('premium_collected')
+    )
+    report.policies_sold += totals['policies_sold'] or 0
+    report.total_premium += totals['premium_collected'] or ZERO
+    return report
+
+
+def reconcile_agent_counters(dry_run=False):
+    """
+    Rebuild every agent's totals and monthly report counters from the
+    source tables and reset the counter shards.
+
+    A policy counts as sold by its agent once it has a policy number, in
+    the month it started; premium counts in the month it was paid. Events
+    still pending in the outbox are counted again when they are drained,
+    so drain it first. Returns ``(agents changed, reports changed)``.
+    """
+    with transaction.atomic():
+        # Hold back sales counted from here on until the rebuilt totals are in
+        list(AgentCounterShard.objects.select_for_update().values_list('pk', flat=True))
+        agents = list(SalesAgent.objects.select_for_update().only(
+            'id', 'branch_id', 'total_policies_sold', 'total_premium_collected'
+        ))
+
+        sold = {}
+        for agent_id, month, policies_sold in (
+            PolicyHolder.objects.filter(agent__isnull=False, policy_number__isnull=False)
+            .annotate(month=TruncMonth('start_date'))
+            .values('agent_id', 'month')
+            .annotate(policies_sold=Count('id'))
+            .values_list('agent_id', 'month', 'policies_sold')
+        ):
+            sold[(agent_id, month)] = [policies_sold, ZERO]
+        for agent_id, month, premium_collected in (
+            PremiumTransaction.objects.filter(premium_payment__policy_holder__agent__isnull=False, premium_amount__gt=0)
+            .annotate(agent_id=F('premium_payment__policy_holder__agent_id'), month=TruncMonth('payment_date'))
+            .values('agent_id', 'month')
+            .annotate(premium_collected=Sum('premium_amount'))
+            .values_list('agent_id', 'month', 'premium_collected')
+        ):
+            sold.setdefault((agent_id, month), [0, ZERO])[1] = premium_collected
+
+        agent_totals = {}
+        for (agent_id, _), (policies_sold, premium_collected) in sold.items():
+            totals = agent_totals.setdefault(agent_id, [0, ZERO])
+            totals[0] += policies_sold
+            totals[1] += premium_collected
+
+        changed_agents = []
+        branches = {}
+        for agent in agents:
+            branches[agent.pk] = agent.branch_id
+            policies_sold, premium_collected = agent_totals.get(agent.pk, (0, ZERO))
+            if (agent.total_policies_sold, agent.total_premium_collected) != (policies_sold, premium_collected):
+                agent.total_policies_sold, agent.total_premium_collected = policies_sold, premium_collected
+                changed_agents.append(agent)
+
+        changed_reports = []
+        for report in AgentReport.objects.only('id', 'agent_id', 'branch_id', 'report_date', 'policies_sold', 'total_premium'):
+            key = (report.agent_id, report.report_date)
+            # Counters belong on the report of the agent's current branch
+            policies_sold, premium_collected = (
+                sold.pop(key) if report.branch_id == branches.get(report.agent_id) and key in sold else (0, ZERO)
+            )
+            if (report.policies_sold, report.total_premium) != (policies_sold, premium_collected):
+                report.policies_sold, report.total_premium = policies_sold, premium_collected
+                changed_reports.append(report)
+        new_reports = [
+            AgentReport(
+                agent_id=agent_id, branch_id=branches[agent_id], report_date=month,
+                policies_sold=policies_sold, total_premium=premium_collected, **_report_defaults(month)
+            )
+            for (agent_id, month), (policies_sold, premium_collected) in sold.items()
+            if agent_id in branches
+        ]
+
+        if dry_run:
+            transaction.set_rollback(True)
+        else:
+            SalesAgent.objects.bulk_update(changed_agents, ['total_policies_sold', 'total_premium_collected'], batch_size=1000)
+            AgentReport.objects.bulk_update(changed_reports, ['policies_sold', 'total_premium'], batch_size=1000)
+            AgentReport.objects.bulk_create(new_reports, batch_size=1000)
+            AgentCounterShard.objects.all().delete()
+
+    return len(changed_agents), len(changed_reports) + len(new_reports)
@@ -8,6 +8,7 @@ from django.utils import timezone
 from django.db.models import Q
 
 from .models import OTP, PolicyHolder, SalesAgent
+from .agent_counters import add_unrolled_sales, with_sales_totals
 
 import random
 import logging
@@ -260,7 +261,7 @@ def get_profile(request):
             
         # Check if user is a sales agent
         elif hasattr(user, 'sales_agent') and user.sales_agent:
-            agent = user.sales_agent
+            agent = with_sales_totals(SalesAgent.objects.filter(pk=user.sales_agent.pk)).get()
             profile_data.update({
                 'user_type': 'agent',
                 'id': agent.id,
@@ -271,13 +272,14 @@ def get_profile(request):
                 'branch_name': agent.branch.name if agent.branch else None,
                 'is_active': agent.is_active,
                 'commission_rate': str(agent.commission_rate),
-                'total_policies_sold': agent.total_policies_sold,
+                'total_policies_sold': agent.policies_sold_total,
             })
             
             # Add performance metrics
             try:
-                latest_report = agent.agenreport_set.order_by('-report_date').first()
+                latest_report = agent.agentreport_set.order_by('-report_date').first()
                 if latest_report:
+                    add_unrolled_sales(latest_report)
                     profile_data['performance'] = {
                         'report_date': latest_report.report_date,
                         'policies_sold': latest_report.policies_sold,
@@ -0,0 +1,122 @@
+import logging
+from datetime import date
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import ExtractDay, ExtractMonth
+
+from .models import Bonus, BonusHistory
+from .rating_tables import get_rating_tables
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+
+# An anniversary is still credited this many days after it passed (see Bonus.update_anniversary_bonus)
+BONUS_CATCH_UP_DAYS = 30
+
+
+def anniversary_in(start_date, year):
+    """The anniversary of ``start_date`` in ``year``; 29 February falls on the 28th in other years."""
+    try:
+        return start_date.replace(year=year)
+    except ValueError:
+        return date(year, 2, 28)
+
+
+def latest_anniversary(start_date, today):
+    """The most recent anniversary of ``start_date`` on or before ``today``."""
+    anniversary = anniversary_in(start_date, today.year)
+    return anniversary if anniversary <= today else anniversary_in(start_date, today.year - 1)
+
+
+def with_anniversary_between(policy_holders, first_day, last_day):
+    """
+    Filter holders whose start date's month and day fall between two dates
+    less than a year apart, wrapping around the end of the year.
+    """
+    policy_holders = policy_holders.annotate(
+        anniversary=ExtractMonth('start_date') * 100 + ExtractDay('start_date')
+    )
+    first, last = first_day.month * 100 + first_day.day, last_day.month * 100 + last_day.day
+    if first <= last:
+        return policy_holders.filter(anniversary__range=(first, last))
+    return policy_holders.filter(Q(anniversary__gte=first) | Q(anniversary__lte=last))
+
+
+def anniversary_bonus(policy_type, sum_assured, policy_year, rating_tables):
+    """``(amount, rate per 1000)`` for a policy year, as Bonus.calculate_bonus rates it; rate is None without one."""
+    # Only endowment policies get bonuses
+    if policy_type != "Endowment":
+        return ZERO, None
+    bonus_rate = rating_tables.bonus_rate(policy_type, policy_year)
+    if not bonus_rate:
+        return ZERO, None
+    bonus_per_1000 = Decimal(bonus_rate.bonus_per_thousand)
+    return ((sum_assured / Decimal(1000)) * bonus_per_1000).quantize(Decimal('1.00')), bonus_per_1000
+
+
+def accrue_anniversary_bonuses(policy_holders, today=None, rating_tables=None):
+    """
+    Credit each holder's latest anniversary bonus the way
+    Bonus.update_anniversary_bonus does, for a chunk of holders loaded with
+    their policy: two reads and three bulk writes in one transaction.
+    Returns the number of anniversaries credited.
+    """
+    today = today or date.today()
+    rating_tables = rating_tables or get_rating_tables()
+    policy_holder_ids = [policy_holder.pk for policy_holder in policy_holders]
+
+    bonuses = {}
+    for bonus in Bonus.objects.filter(policy_holder_id__in=policy_holder_ids).order_by('id'):
+        bonuses.setdefault(bonus.policy_holder_id, bonus)
+    history = {}
+    for policy_holder_id, policy_year, bonus_amount in BonusHistory.objects.filter(
+        policy_holder_id__in=policy_holder_ids
+    ).values_list('policy_holder_id', 'policy_year', 'bonus_amount'):
+        history.setdefault(policy_holder_id, {})[policy_year] = bonus_amount
+
+    new_bonuses, updated_bonuses, new_history = [], [], []
+    for policy_holder in policy_holders:
+        anniversary = latest_anniversary(policy_holder.start_date, today)
+        policy_year = anniversary.year - policy_holder.start_date.year
+        # No bonus for the first year
+        if (today - anniversary).days > BONUS_CATCH_UP_DAYS or policy_year <= 0:
+            continue
+
+        years_credited = history.get(policy_holder.pk, {})
+        bonus = bonuses.get(policy_holder.pk)
+        if bonus is None:
+            # A new bonus starts from the history already recorded
+            bonus = Bonus(
+                policy_holder=policy_holder,
+                start_date=policy_holder.start_date,
+                accrued_amount=sum(years_credited.values(), ZERO),
+            )
+            new_bonuses.append(bonus)
+        elif bonus.last_anniversary_processed and bonus.last_anniversary_processed >= anniversary:
+            continue
+        else:
+            bonus.last_updated = today
+            updated_bonuses.append(bonus)
+
+        bonus_amount, bonus_rate = anniversary_bonus(
+            policy_holder.policy.policy_type, policy_holder.sum_assured, policy_year, rating_tables
+        )
+        if bonus_rate is not None and policy_year not in years_credited:
+            new_history.append(BonusHistory(
+                policy_holder=policy_holder, policy_year=policy_year, bonus_amount=bonus_amount, bonus_rate=bonus_rate,
+            ))
+        bonus.accrued_amount += bonus_amount
+        bonus.last_anniversary_processed = anniversary
+
+    with transaction.atomic():
+        Bonus.objects.bulk_create(new_bonuses)
+        Bonus.objects.bulk_update(updated_bonuses, ['accrued_amount', 'last_anniversary_processed', 'last_updated'])
+        BonusHistory.objects.bulk_create(new_history, ignore_conflicts=True)
+
+    credited = len(new_bonuses) + len(updated_bonuses)
+    if credited:
+        logger.info(f"BONUS UPDATE - Credited {credited} anniversaries, {len(new_history)} new history records")
+    return credited
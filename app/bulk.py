@@ -0,0 +1,376 @@
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PolicyHolder, PremiumPayment, Underwriting
+from .outbox import publish_many
+from .payments import deferred_side_effects, holder_payment_status
+from .policy_events import schedule_policy_events
+from .premium_engine import PremiumBatch
+from .rating_tables import get_rating_tables
+
+logger = logging.getLogger(__name__)
+
+# Rows loaded and written per query when bulk changes are applied
+BULK_CHUNK_SIZE = getattr(settings, 'BULK_CHUNK_SIZE', 1000)
+
+# Inputs of the set-based re-rating, in PremiumBatch argument order
+RATING_FIELDS = (
+    'id',
+    'policy_holder__age',
+    'policy_holder__sum_assured',
+    'policy_holder__duration_years',
+    'policy_holder__policy__policy_type',
+    'policy_holder__policy__base_multiplier',
+    'policy_holder__policy__include_adb',
+    'policy_holder__policy__adb_percentage',
+    'policy_holder__policy__include_ptd',
+    'policy_holder__policy__ptd_percentage',
+    'policy_holder__underwriting__premium_loading_percentage',
+    'policy_holder__payment_interval',
+    'annual_premium',
+    'interval_payment',
+    'total_premium',
+    'total_paid',
+    'payment_status',
+)
+
+# Holder fields bulk_mode sets with UPDATEs, copied back onto the holders saved in the block
+HOLDER_DERIVED_FIELDS = ['risk_category', 'payment_status']
+
+RATED_FIELDS = ['annual_premium', 'interval_payment', 'total_premium', 'remaining_premium', 'payment_status']
+
+ASSESSED_FIELDS = [
+    'risk_assessment_score', 'risk_category', 'premium_loading_percentage', 'medical_examination_required',
+    'needs_review', 'last_reviewed_date', 'last_updated_by', 'last_updated_at',
+]
+
+_bulk = threading.local()
+
+
+def _chunks(values, size=BULK_CHUNK_SIZE):
+    values = iter(values)
+    while chunk := list(itertools.islice(values, size)):
+        yield chunk
+
+
+class BulkChanges:
+    """Rows saved inside a ``bulk_mode`` block whose side effects are still due."""
+
+    def __init__(self):
+        # PolicyHolder id -> (created, tracked fields changed by any of its saves)
+        self.policy_holders = {}
+        # PolicyHolder id -> the instances that were saved, so later saves of them keep the derived fields
+        self.instances = {}
+        # PolicyHolder ids whose underwriting was saved
+        self.underwritten = set()
+        # PolicyHolder ids whose premium payment was saved
+        self.payment_status = set()
+
+
+def in_bulk_mode():
+    return getattr(_bulk, 'changes', None) is not None
+
+
+@contextmanager
+def bulk_mode():
+    """
+    Save many PolicyHolder, Underwriting and PremiumPayment rows without the
+    per-row signal cascade. Saves inside the block only record which rows
+    they touched; on exit the side effects are applied once, set-based:
+
+    - underwritings are created or reassessed in bulk and holder risk
+      categories synced with one UPDATE per category,
+    - premium payments are created for newly approved holders and re-rated
+      through ``PremiumBatch`` when their inputs or loading changed,
+    - holder payment statuses are refreshed with one UPDATE per status,
+    - policy events are planned again for holders whose status, term or
+      payments changed,
+    - posted payments are handled as in ``deferred_side_effects`` and
+      outbox events (new user accounts, agent reports and commissions) are
+      published with bulk INSERTs, and
+    - holder instances saved in the block are given the new risk category
+      and payment status, so saving them again keeps both.
+
+    Several saves of one row inside a block are applied as one, so the
+    underwriting of a holder created and then edited in the same block is
+    assessed once rather than reviewed again for each save. If the block
+    raises, nothing is applied. Nested blocks join the outermost one.
+    """
+    if in_bulk_mode():
+        yield
+        return
+
+    changes = _bulk.changes = BulkChanges()
+    try:
+        with deferred_side_effects():
+            yield
+            # Saves made while applying are recorded too, so payment statuses go last
+            _apply_policy_holder_saves(changes)
+            refresh_payment_statuses(changes.payment_status)
+            schedule_policy_events(changes.payment_status)
+            refresh_saved_policy_holders(changes.instances)
+    finally:
+        _bulk.changes = None
+
+
+def defer_policy_holder_save(policy_holder, created, changed):
+    """Record a holder save for the open bulk block, if any; returns whether one was open."""
+    if not in_bulk_mode():
+        return False
+    was_created, was_changed = _bulk.changes.policy_holders.get(policy_holder.pk, (False, set()))
+    _bulk.changes.policy_holders[policy_holder.pk] = (was_created or created, was_changed | changed)
+    instances = _bulk.changes.instances.setdefault(policy_holder.pk, [])
+    if not any(instance is policy_holder for instance in instances):
+        instances.append(policy_holder)
+    return True
+
+
+def defer_underwriting_save(underwriting):
+    """Record an underwriting save for the open bulk block, if any; returns whether one was open."""
+    if not in_bulk_mode():
+        return False
+    _bulk.changes.underwritten.add(underwriting.policy_holder_id)
+    return True
+
+
+def defer_payment_status(premium_payment):
+    """Record a premium payment save for the open bulk block, if any; returns whether one was open."""
+    if not in_bulk_mode():
+        return False
+    _bulk.changes.payment_status.add(premium_payment.policy_holder_id)
+    return True
+
+
+def _apply_policy_holder_saves(changes):
+    """Run the PolicyHolder pipeline stages for every recorded holder at once."""
+    from .signals import POLICY_EVENT_INPUTS, PREMIUM_INPUTS, UNDERWRITING_INPUTS
+
+    created = {pk for pk, (was_created, _) in changes.policy_holders.items() if was_created}
+    underwrite = created | {
+        pk for pk, (_, changed) in changes.policy_holders.items() if changed & UNDERWRITING_INPUTS
+    }
+    rate = created | {
+        pk for pk, (_, changed) in changes.policy_holders.items() if changed & PREMIUM_INPUTS
+    }
+
+    issued = {pk for pk, (_, changed) in changes.policy_holders.items() if 'policy_number' in changed}
+
+    events = [
+        ('policy_holder.created', {'policy_holder_id': pk})
+        for chunk in _chunks(sorted(created))
+        for pk in PolicyHolder.objects.filter(pk__in=chunk, user__isnull=True, phone_number__isnull=False)
+        .exclude(phone_number='').values_list('pk', flat=True)
+    ] + [
+        ('policy.sold', {'policy_holder_id': pk})
+        for chunk in _chunks(sorted(issued))
+        for pk in PolicyHolder.objects.filter(pk__in=chunk, policy_number__isnull=False, agent__isnull=False)
+        .values_list('pk', flat=True)
+    ]
+    if events:
+        publish_many(events)
+
+    reassessed = underwrite_policy_holders(underwrite)
+    sync_risk_categories(underwrite | changes.underwritten)
+
+    # A reassessed underwriting re-rates the premium with its new loading
+    rerate = reassessed | changes.underwritten | create_premium_payments(rate)
+    rerated = sum(
+        changed for _, changed, _ in rerate_premium_payments(PremiumPayment.objects.filter(policy_holder_id__in=rerate))
+    )
+    changes.payment_status |= rerate
+    schedule_policy_events(
+        created | {pk for pk, (_, changed) in changes.policy_holders.items() if changed & POLICY_EVENT_INPUTS}
+    )
+    logger.info(f"BULK - Applied saves of {len(changes.policy_holders)} policy holders: "
+                f"{len(underwrite)} underwritten, {rerated} premiums re-rated")
+
+
+def underwrite_policy_holders(policy_holder_ids):
+    """
+    Create the missing underwritings of holders under review and reassess
+    the existing ones, with one INSERT and one UPDATE per chunk. Returns
+    the ids of the holders whose existing underwriting was reassessed.
+    """
+    reassessed = set()
+    for chunk in _chunks(sorted(policy_holder_ids)):
+        created, updated = [], []
+        for policy_holder in PolicyHolder.objects.filter(
+            pk__in=chunk, status__in=['Pending', 'Approved', 'Active']
+        ).select_related('occupation', 'policy', 'underwriting'):
+            try:
+                underwriting = policy_holder.underwriting
+            except Underwriting.DoesNotExist:
+                underwriting = Underwriting(policy_holder=policy_holder)
+            try:
+                underwriting.assess()
+            except ValidationError as e:
+                logger.error(f"BULK - Could not assess underwriting of policy holder {policy_holder.pk}: {str(e)}")
+                continue
+            if underwriting.pk:
+                underwriting.last_updated_at = timezone.now()
+                updated.append(underwriting)
+            else:
+                created.append(underwriting)
+
+        with transaction.atomic():
+            Underwriting.objects.bulk_create(created)
+            Underwriting.objects.bulk_update(updated, ASSESSED_FIELDS)
+        reassessed.update(underwriting.policy_holder_id for underwriting in updated)
+    return reassessed
+
+
+def sync_risk_categories(policy_holder_ids):
+    """Copy the risk category of each holder's underwriting to the holder, one UPDATE per category."""
+    for chunk in _chunks(sorted(policy_holder_ids)):
+        for risk_category, _ in Underwriting._meta.get_field('risk_category').choices:
+            PolicyHolder.objects.filter(
+                pk__in=chunk, underwriting__risk_category=risk_category
+            ).exclude(risk_category=risk_category).update(risk_category=risk_category)
+
+
+def create_premium_payments(policy_holder_ids):
+    """
+    Create the premium payment of every approved or active holder that has
+    none yet. Returns the ids of the holders that already had one, which
+    are due for re-rating instead.
+    """
+    existing = set()
+    for chunk in _chunks(sorted(policy_holder_ids)):
+        policy_holders = PolicyHolder.objects.filter(pk__in=chunk, status__in=['Approved', 'Active'])
+        existing.update(
+            PremiumPayment.objects.filter(policy_holder__in=policy_holders).values_list('policy_holder_id', flat=True)
+        )
+        for policy_holder in policy_holders.exclude(pk__in=existing).select_related('policy'):
+            # Each payment still rates itself; only its signal side effects are batched
+            try:
+                PremiumPayment.objects.create(policy_holder=policy_holder)
+            except ValidationError as e:
+                logger.error(f"BULK - Could not create premium payment for policy holder {policy_holder.pk}: {str(e)}")
+    return existing
+
+
+def rerate_premium_payments(premium_payments, chunk_size=5000, rating_tables=None, dry_run=False):
+    """
+    Recalculate the premiums of ``premium_payments`` with ``PremiumBatch``,
+    ``chunk_size`` rows per query, writing only the rows whose premium
+    changed with one ``bulk_update`` per chunk. Yields ``(rated, changed,
+    unrated)`` counts after each chunk.
+    """
+    # One snapshot for the whole run so every chunk is rated consistently
+    rating_tables = rating_tables or get_rating_tables()
+    last_id = 0
+    while True:
+        rows = list(
+            premium_payments.filter(id__gt=last_id)
+            .order_by('id')
+            .values_list(*RATING_FIELDS)[:chunk_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        changed, unrated = rate_premium_rows(rows, rating_tables)
+        if changed and not dry_run:
+            with transaction.atomic():
+                PremiumPayment.objects.bulk_update(changed, RATED_FIELDS)
+        yield len(rows), len(changed), unrated
+
+
+def rate_premium_rows(rows, rating_tables):
+    """Rate ``RATING_FIELDS`` rows and return the PremiumPayment objects whose values changed."""
+    (ids, ages, sums, durations, policy_types, multipliers, include_adb, adb_percentages,
+     include_ptd, ptd_percentages, loadings, intervals, annuals, interval_payments,
+     totals, totals_paid, statuses) = zip(*rows)
+
+    batch = PremiumBatch(
+        age=ages,
+        sum_assured=sums,
+        duration_years=durations,
+        policy_type=policy_types,
+        base_multiplier=multipliers,
+        include_adb=include_adb,
+        adb_percentage=adb_percentages,
+        include_ptd=include_ptd,
+        ptd_percentage=ptd_percentages,
+        loading_percentage=loadings,
+        payment_interval=intervals,
+        rating_tables=rating_tables,
+    )
+
+    changed = []
+    for row in range(len(rows)):
+        if not batch.rated[row]:
+            continue
+
+        annual_premium = batch.annual_premium(row)
+        interval_payment = batch.interval_payment(row)
+        if intervals[row] == "Single":
+            total_premium = interval_payment
+        else:
+            total_premium = annual_premium * Decimal(str(durations[row]))
+
+        if (annual_premium, interval_payment, total_premium) == (annuals[row], interval_payments[row], totals[row]):
+            continue
+
+        total_paid = totals_paid[row]
+        payment_status = statuses[row]
+        if payment_status in ('Unpaid', 'Partially Paid', 'Paid'):
+            if total_paid >= total_premium:
+                payment_status = 'Paid'
+            elif total_paid > 0:
+                payment_status = 'Partially Paid'
+            else:
+                payment_status = 'Unpaid'
+
+        changed.append(PremiumPayment(
+            id=ids[row],
+            annual_premium=annual_premium,
+            interval_payment=interval_payment,
+            total_premium=total_premium,
+            remaining_premium=max(total_premium - total_paid, Decimal('0.00')),
+            payment_status=payment_status,
+        ))
+
+    unrated = len(rows) - int(batch.rated.sum())
+    if unrated:
+        logger.warning(f"{unrated} premium payments in chunk ending at id {ids[-1]} could not be rated")
+    return changed, unrated
+
+
+def refresh_payment_statuses(policy_holder_ids):
+    """Refresh holder payment statuses from their first premium payment, one UPDATE per status."""
+    for chunk in _chunks(sorted(policy_holder_ids)):
+        first_payments = {}
+        for premium_payment in PremiumPayment.objects.filter(
+            policy_holder_id__in=chunk
+        ).only('policy_holder_id', 'total_paid', 'total_premium').order_by('id'):
+            first_payments.setdefault(premium_payment.policy_holder_id, premium_payment)
+
+        holders_by_status = {}
+        for policy_holder_id, premium_payment in first_payments.items():
+            holders_by_status.setdefault(holder_payment_status(premium_payment), []).append(policy_holder_id)
+        for payment_status, holder_ids in holders_by_status.items():
+            PolicyHolder.objects.filter(pk__in=holder_ids).exclude(
+                payment_status=payment_status
+            ).update(payment_status=payment_status)
+
+
+def refresh_saved_policy_holders(instances):
+    """
+    Copy ``HOLDER_DERIVED_FIELDS`` from the database onto holder instances
+    saved in the block, so saving one of them again does not write back
+    the values it had before the block's UPDATEs.
+    """
+    for chunk in _chunks(sorted(instances)):
+        for pk, *values in PolicyHolder.objects.filter(pk__in=chunk).values_list('pk', *HOLDER_DERIVED_FIELDS):
+            for policy_holder in instances[pk]:
+                for field, value in zip(HOLDER_DERIVED_FIELDS, values):
+                    setattr(policy_holder, field, value)
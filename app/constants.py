@@ -60,4 +60,11 @@ PAYMENT_CHOICES = [
     ('Unpaid', 'Unpaid'),
     ('Partially Paid', 'Partially Paid'),
     ('Paid', 'Paid'),
-]
\ No newline at end of file
+]
+# Number of instalments per year for each PolicyHolder.payment_interval
+PAYMENT_INTERVAL_COUNTS = {"quarterly": 4, "semi_annual": 2, "annual": 1, "Single": 1}
+# Months between instalments for each PolicyHolder.payment_interval; single premiums have none
+PAYMENT_INTERVAL_MONTHS = {"quarterly": 3, "semi_annual": 6, "annual": 12, "Single": None}
+
+# 3 years of non-payment leads to policy expiry (1095 days ≈ 3 years)
+LAPSE_DAYS = 1095
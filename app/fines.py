@@ -0,0 +1,99 @@
+import calendar
+import logging
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from .premium_engine import cents_to_decimal
+
+logger = logging.getLogger(__name__)
+
+# Days after the due date before a fine accrues (15 days in Nepal standard practice)
+GRACE_PERIOD_DAYS = 15
+# 1% of the instalment per month after the grace period, accrued daily over 30-day months
+MONTHLY_FINE_RATE = Decimal('0.01')
+# Fine in paisa is instalment paisa * chargeable days / FINE_DIVISOR
+FINE_DIVISOR = int(Decimal(30) / MONTHLY_FINE_RATE)
+
+
+def add_months(day, months):
+    """``day`` moved ``months`` calendar months on, clamped to the end of a shorter month."""
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return day.replace(year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def add_months_array(days, months):
+    """Vectorised ``add_months`` for ``datetime64[D]`` arrays; NaT stays NaT."""
+    month_starts = days.astype('datetime64[M]')
+    day_offsets = (days - month_starts.astype('datetime64[D]')).astype(np.int64)
+    target_months = month_starts + months
+    month_lengths = ((target_months + 1).astype('datetime64[D]') - target_months.astype('datetime64[D]')).astype(np.int64)
+    return target_months.astype('datetime64[D]') + np.minimum(day_offsets, month_lengths - 1)
+
+
+def fine_for_days_late(interval_payment, days_late):
+    """Fine on an instalment ``days_late`` days overdue, as ``PremiumPayment.calculate_fine`` charges it."""
+    if days_late <= GRACE_PERIOD_DAYS:
+        return Decimal('0.00')
+
+    daily_rate = MONTHLY_FINE_RATE / Decimal('30')  # Approximate daily rate
+    # Fine applies after grace period
+    fine = interval_payment * daily_rate * Decimal(str(days_late - GRACE_PERIOD_DAYS))
+    return max(fine.quantize(Decimal('1.00')), Decimal('0.00'))
+
+
+def _as_dates(values):
+    if isinstance(values, np.ndarray):
+        return values.astype('datetime64[D]')
+    return np.array([np.datetime64('NaT') if v is None else np.datetime64(v, 'D') for v in values], dtype='datetime64[D]')
+
+
+def _as_cents(values):
+    return np.array([int(Decimal(str(v)).scaleb(2).to_integral_value()) for v in values], dtype=np.int64)
+
+
+class FineBatch:
+    """
+    Column-oriented ``calculate_fine`` for many payments at once.
+
+    Takes one next payment date (a date or None, or a ``datetime64[D]``
+    array with NaT) and instalment amount per payment. Days late are integer differences of the dates and the fine
+    is integer paisa arithmetic; after construction ``fine_cents`` holds
+    the fine per payment. Exact half-paisa results, where rounding the
+    Decimal formula depends on its precision, are recomputed in Decimal.
+    """
+
+    def __init__(self, next_payment_date, interval_payment, today=None):
+        self.today = today or date.today()
+        self._interval_payment = list(interval_payment)
+        self.next_payment_dates = _as_dates(next_payment_date)
+        self.interval_cents = _as_cents(self._interval_payment)
+        self._calculate()
+
+    def __len__(self):
+        return len(self.fine_cents)
+
+    def _calculate(self):
+        dated = ~np.isnat(self.next_payment_dates)
+        days_late = np.zeros(len(self.next_payment_dates), dtype=np.int64)
+        days_late[dated] = (np.datetime64(self.today, 'D') - self.next_payment_dates[dated]).astype(np.int64)
+        self.days_late = days_late
+
+        chargeable_days = np.where(dated & (days_late > GRACE_PERIOD_DAYS), days_late - GRACE_PERIOD_DAYS, 0)
+        fine_units = self.interval_cents * chargeable_days
+        fine_cents, remainder = np.divmod(fine_units, FINE_DIVISOR)
+        fine_cents += remainder * 2 > FINE_DIVISOR
+        self.fine_cents = np.maximum(fine_cents, 0)
+
+        self.exact_rows = np.flatnonzero((chargeable_days > 0) & (remainder * 2 == FINE_DIVISOR))
+        for row in self.exact_rows:
+            fine = fine_for_days_late(Decimal(str(self._interval_payment[row])), int(days_late[row]))
+            self.fine_cents[row] = int(fine * 100)
+
+        if len(self.exact_rows):
+            logger.info(f"FINE BATCH - Recomputed {len(self.exact_rows)} half-paisa rows in Decimal")
+
+    def fine(self, row):
+        return cents_to_decimal(self.fine_cents[row])
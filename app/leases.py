@@ -0,0 +1,92 @@
+import logging
+import os
+import socket
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import JobLease
+
+logger = logging.getLogger(__name__)
+
+# Seconds a lease lasts unless its holder renews it
+JOB_LEASE_TTL = getattr(settings, 'JOB_LEASE_TTL', 10 * 60)
+
+
+class LeaseUnavailable(Exception):
+    """Another process holds the lease."""
+
+
+class LeaseLost(Exception):
+    """The lease was taken over or released while its holder was still writing."""
+
+
+class Lease:
+    """
+    A lease this process holds. It keeps only plain values, so it can be
+    passed to worker processes, which renew it with the same token.
+    """
+
+    def __init__(self, name, token, ttl=JOB_LEASE_TTL, holder=''):
+        self.name = name
+        self.token = token
+        self.ttl = ttl
+        self.holder = holder
+
+    def renew(self):
+        """
+        Extend the lease by its TTL, or raise LeaseLost if it has been
+        released, has expired or another process has acquired it since.
+        Call it inside the transaction of every write made under the lease:
+        the row it locks holds off a takeover until that transaction ends,
+        so a stale holder can never commit.
+        """
+        now = timezone.now()
+        # A released lease has no expiry, and an expired one is free for the taking
+        renewed = JobLease.objects.filter(name=self.name, token=self.token, expires_at__gt=now).update(
+            expires_at=now + timedelta(seconds=self.ttl)
+        )
+        if not renewed:
+            raise LeaseLost(f"Lease {self.name} with token {self.token} is no longer held")
+
+    def release(self):
+        """Give the lease up; the token stays, so the next holder's is higher."""
+        JobLease.objects.filter(name=self.name, token=self.token).update(holder='', expires_at=None)
+        logger.info(f"LEASE - Released {self.name} (token {self.token})")
+
+
+def acquire_lease(name, ttl=JOB_LEASE_TTL):
+    """
+    Take the lease ``name`` for ``ttl`` seconds if nobody holds it or the
+    last holder let it expire. Returns the Lease with its new fencing token;
+    raises LeaseUnavailable if it is held.
+    """
+    holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    now = timezone.now()
+    with transaction.atomic():
+        JobLease.objects.get_or_create(name=name)
+        acquired = JobLease.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__lte=now), name=name
+        ).update(
+            holder=holder, token=F('token') + 1, acquired_at=now, expires_at=now + timedelta(seconds=ttl)
+        )
+        lease = JobLease.objects.get(name=name)
+    if not acquired:
+        raise LeaseUnavailable(f"{name} is held by {lease.holder} until {lease.expires_at}")
+    logger.info(f"LEASE - {holder} acquired {name} (token {lease.token})")
+    return Lease(name, lease.token, ttl, holder)
+
+
+@contextmanager
+def hold_lease(name, ttl=JOB_LEASE_TTL):
+    """Hold the lease ``name`` for the duration of the block."""
+    lease = acquire_lease(name, ttl)
+    try:
+        yield lease
+    finally:
+        lease.release()
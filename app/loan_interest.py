@@ -0,0 +1,83 @@
+import logging
+from datetime import date
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+
+from .models import Loan, LoanInterestAccrual
+from .premium_engine import cents_to_decimal
+
+logger = logging.getLogger(__name__)
+
+DAYS_PER_YEAR = 365
+# Interest in paisa is balance paisa * rate in hundredths of a percent * days / INTEREST_DIVISOR
+INTEREST_DIVISOR = 100 * 100 * DAYS_PER_YEAR
+
+
+def _hundredths(amount):
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
+
+def interest_paisa(remaining_balance, interest_rate, days):
+    """
+    Simple interest in paisa on ``remaining_balance`` at ``interest_rate``
+    percent a year over ``days`` days, computed exactly in integers and
+    rounded half to even like ``Decimal.quantize``.
+    """
+    paisa, remainder = divmod(_hundredths(remaining_balance) * _hundredths(interest_rate) * days, INTEREST_DIVISOR)
+    if remainder * 2 > INTEREST_DIVISOR or (remainder * 2 == INTEREST_DIVISOR and paisa % 2):
+        paisa += 1
+    return paisa
+
+
+def accrue_loan_interest(loans=None, as_of_date=None, chunk_size=1000):
+    """
+    Accrue interest up to ``as_of_date`` on the Active loans of ``loans``
+    (default all) not yet accrued to that date.
+
+    Each chunk of loans gets one ledger row per loan from a bulk INSERT and
+    its ``accrued_interest`` and ``last_interest_date`` moved on by a single
+    UPDATE reading those rows, without saving loans one by one. Returns the
+    number of loans accrued.
+    """
+    as_of_date = as_of_date or date.today()
+    loans = (Loan.objects.all() if loans is None else loans).filter(
+        loan_status='Active', last_interest_date__lt=as_of_date
+    )
+    accrued = 0
+    total = 0
+    last_id = 0
+
+    while True:
+        with transaction.atomic():
+            chunk = list(
+                loans.filter(pk__gt=last_id).select_for_update().order_by('pk')
+                .values_list('pk', 'remaining_balance', 'interest_rate', 'last_interest_date')[:chunk_size]
+            )
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+
+            accruals = []
+            for loan_id, remaining_balance, interest_rate, last_interest_date in chunk:
+                days = (as_of_date - last_interest_date).days
+                amount = cents_to_decimal(interest_paisa(remaining_balance, interest_rate, days))
+                accruals.append(LoanInterestAccrual(
+                    loan_id=loan_id, accrual_date=as_of_date, from_date=last_interest_date, days=days,
+                    principal=remaining_balance, interest_rate=interest_rate, amount=amount,
+                ))
+                total += amount
+            LoanInterestAccrual.objects.bulk_create(accruals)
+
+            Loan.objects.filter(pk__in=[accrual.loan_id for accrual in accruals]).update(
+                accrued_interest=F('accrued_interest') + Subquery(
+                    LoanInterestAccrual.objects.filter(loan=OuterRef('pk'), accrual_date=as_of_date).values('amount')[:1]
+                ),
+                last_interest_date=as_of_date,
+            )
+        accrued += len(chunk)
+
+    if accrued:
+        logger.info(f"LOAN INTEREST - Accrued {total} on {accrued} loans to {as_of_date}")
+    return accrued
@@ -0,0 +1,144 @@
+import importlib
+import logging
+from datetime import timedelta
+from io import StringIO
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, Min, OuterRef, Subquery
+
+from .loan_interest import accrue_loan_interest
+from .models import Loan, PolicyHolder, PolicyRenewal, PremiumPayment
+
+logger = logging.getLogger(__name__)
+
+# Policy holder ids per chunk of the nightly pipeline
+MAINTENANCE_CHUNK_SIZE = getattr(settings, 'MAINTENANCE_CHUNK_SIZE', 5000)
+
+NIGHTLY_MAINTENANCE = 'nightly_maintenance'
+# Lease held by every entry point that runs the maintenance jobs: the
+# nightly chord, the policy event runner and the sharded commands, so no
+# two of them ever write to the book at once
+MAINTENANCE_LEASE = 'maintenance'
+# Seconds the nightly lease outlives its last renewal, long enough for queued chunks to start
+NIGHTLY_MAINTENANCE_LEASE_TTL = getattr(settings, 'NIGHTLY_MAINTENANCE_LEASE_TTL', 2 * 60 * 60)
+
+# Renewal records are raised this many days before maturity (see PolicyHolder.check_for_renewal)
+RENEWAL_NOTICE_DAYS = 60
+# A pending renewal expires this many days after its due date (see PolicyRenewal.save)
+RENEWAL_GRACE_DAYS = 30
+
+
+def plan_chunks(chunk_size=MAINTENANCE_CHUNK_SIZE):
+    """
+    Split the book into ``(first_id, last_id)`` ranges of policy holder ids,
+    ``chunk_size`` ids wide. Ranges are cut from the id bounds alone, so
+    planning costs one query however large the book is.
+    """
+    bounds = PolicyHolder.objects.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return []
+    return [
+        (first_id, min(first_id + chunk_size - 1, bounds['last']))
+        for first_id in range(bounds['first'], bounds['last'] + 1, chunk_size)
+    ]
+
+
+def _command_job(command_name):
+    """A job running a ShardedCommand's chunk step with the command's default options."""
+    def run(policy_holders, as_of_date):
+        command = importlib.import_module(f'app.management.commands.{command_name}').Command(stdout=StringIO())
+        options = vars(command.create_parser('manage.py', command_name).parse_args([]))
+        command.prepare(**options)
+        return command.handle_chunk(
+            command.get_queryset(as_of_date, **options).filter(pk__in=policy_holders), as_of_date, **options
+        )
+    return run
+
+
+def accrue_interest(policy_holders, as_of_date):
+    """Accrue interest on the loans taken against ``policy_holders``."""
+    accrued = accrue_loan_interest(Loan.objects.filter(policy_holder__in=policy_holders), as_of_date)
+    return {'accrued': accrued}
+
+
+def check_renewals(policy_holders, as_of_date):
+    """
+    Raise renewal records for annual policies nearing maturity and expire
+    pending renewals whose grace period has passed, together with their
+    still Active policies, as PolicyRenewal.save and check_expiry do.
+    """
+    due = policy_holders.filter(
+        status='Active',
+        payment_interval='annual',
+        maturity_date__lte=as_of_date + timedelta(days=RENEWAL_NOTICE_DAYS),
+    ).exclude(
+        Exists(PolicyRenewal.objects.filter(
+            policy_holder=OuterRef('pk'), due_date=OuterRef('maturity_date'), status__in=['Pending', 'Renewed']
+        ))
+    ).annotate(
+        renewal_amount=Subquery(
+            PremiumPayment.objects.filter(policy_holder=OuterRef('pk')).order_by('pk').values('annual_premium')[:1]
+        )
+    )
+    renewals = PolicyRenewal.objects.bulk_create([
+        PolicyRenewal(
+            policy_holder_id=policy_holder_id,
+            due_date=maturity_date,
+            grace_period_end=maturity_date + timedelta(days=RENEWAL_GRACE_DAYS),
+            renewal_amount=renewal_amount or 0,
+            is_first_reminder_sent=True,
+            first_reminder_date=as_of_date,
+        )
+        for policy_holder_id, maturity_date, renewal_amount in due.values_list('pk', 'maturity_date', 'renewal_amount')
+    ])
+    for renewal in renewals:
+        logger.info(f"Renewal record created for policy holder {renewal.policy_holder_id}")
+
+    lapsed = PolicyRenewal.objects.filter(
+        policy_holder__in=policy_holders, status='Pending', grace_period_end__lt=as_of_date
+    )
+    lapsed_holder_ids = list(lapsed.values_list('policy_holder_id', flat=True))
+    expired = lapsed.update(status='Expired')
+    PolicyHolder.objects.filter(pk__in=lapsed_holder_ids, status='Active').update(status='Expired')
+
+    return {'renewals_created': len(renewals), 'renewals_expired': expired}
+
+
+# Jobs run on each chunk, in this order: fines and interest are brought up
+# to date before lapsed policies are expired and surrendered, and only
+# policies still active get bonuses and renewals
+MAINTENANCE_JOBS = {
+    'update_premium_fines': _command_job('update_premium_fines'),
+    'accrue_loan_interest': accrue_interest,
+    'check_policy_expiry': _command_job('check_policy_expiry'),
+    'update_bonuses': _command_job('update_bonuses'),
+    'check_renewals': check_renewals,
+}
+
+
+def run_maintenance_job(job_name, first_id, last_id, as_of_date, lease=None):
+    """
+    Run one job over the policy holders with ids ``first_id`` to ``last_id``
+    in a single transaction and ``bulk_mode``, so a failed chunk can be
+    retried on its own.
+    With ``lease``, the job only commits while that lease is still held.
+    Returns the job's counts.
+    """
+    from .bulk import bulk_mode
+
+    with transaction.atomic(), bulk_mode():
+        if lease is not None:
+            lease.renew()
+        counts = MAINTENANCE_JOBS[job_name](PolicyHolder.objects.filter(pk__range=(first_id, last_id)), as_of_date)
+    logger.info(f"MAINTENANCE - {job_name} on policy holders {first_id}-{last_id}: {counts}")
+    return counts
+
+
+def add_counts(summary, chunk_summary):
+    """Add one chunk's ``{job_name: counts}`` into ``summary``."""
+    for job_name, counts in chunk_summary.items():
+        totals = summary.setdefault(job_name, {})
+        for name, count in counts.items():
+            totals[name] = totals.get(name, 0) + count
+    return summary
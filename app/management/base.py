@@ -0,0 +1,187 @@
+import argparse
+import importlib
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models.functions import Mod
+
+from app.bulk import bulk_mode
+from app.leases import LeaseUnavailable, hold_lease
+from app.maintenance import MAINTENANCE_LEASE
+from app.models import BatchJobRun
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(value):
+    """Parse ``--shard i/N`` into ``(i, N)``."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a shard like 0/4, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard {value} is out of range")
+    return index, count
+
+
+def in_shard(queryset, shard, field='id'):
+    """
+    Filter ``queryset`` to one ``(index, count)`` shard of ``field``.
+    Ids are striped rather than cut into ranges, so shards launched
+    separately agree without coordinating and rows added during a run
+    still land in exactly one shard.
+    """
+    index, count = shard
+    if count == 1:
+        return queryset
+    return queryset.alias(shard_key=Mod(field, count)).filter(shard_key=index)
+
+
+def _init_worker():
+    # Spawned workers start without Django; forked ones already have it
+    django.setup()
+
+
+def _run_shard(command_module, options):
+    command = importlib.import_module(command_module).Command()
+    try:
+        return command.handle_shard(**options)
+    finally:
+        connections.close_all()
+
+
+class ShardedCommand(BaseCommand):
+    """
+    Base for maintenance commands that walk the whole book of policies.
+
+    Subclasses implement ``get_queryset(as_of_date, **options)`` returning
+    the policy holders to process, ``handle_chunk(policy_holders,
+    as_of_date, **options)`` processing a chunk of them and returning a
+    dict of counts, and ``report(counts, **options)`` to print the summary.
+
+    Holders are taken in id order, ``--chunk-size`` at a time, and each
+    chunk commits together with its checkpoint in a BatchJobRun, so
+    ``--resume`` carries a failed run on from where it stopped. Chunks run
+    in ``bulk_mode``, so holder and payment saves inside them apply their
+    side effects once per chunk.
+    ``--shard i/N`` runs one shard of the book, e.g. to split a long run
+    into parts resumed separately, and ``--workers N`` splits the run
+    across a process pool with a database connection per worker; counts
+    are summed across workers. A run holds the maintenance lease, shared
+    with the nightly chord and the policy event runner, so no two
+    maintenance runs of any job, shard or worker count overlap anywhere in
+    the cluster; every chunk renews it as it commits.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes to split the run across (default: 1)',
+        )
+        parser.add_argument(
+            '--shard',
+            type=parse_shard,
+            default=(0, 1),
+            help='Only process shard i of N, given as i/N (default: 0/1, everything)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of policy holders processed per transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Carry on the last unfinished run from its checkpoint (use the same --shard and --workers)',
+        )
+
+    @property
+    def job_name(self):
+        return self.__class__.__module__.rsplit('.', 1)[-1]
+
+    def get_queryset(self, as_of_date, **options):
+        raise NotImplementedError('subclasses of ShardedCommand must provide a get_queryset() method')
+
+    def handle_chunk(self, policy_holders, as_of_date, **options):
+        raise NotImplementedError('subclasses of ShardedCommand must provide a handle_chunk() method')
+
+    def prepare(self, **options):
+        """Set up state shared by every chunk of a run, before the first one."""
+
+    def handle_shard(self, **options):
+        self.prepare(**options)
+        index, count = options['shard']
+        run = BatchJobRun.start(self.job_name, f'{index}/{count}', resume=options['resume'])
+        if run.status == 'Completed':
+            self.stdout.write(f'Shard {run.shard} already completed for {run.as_of_date}')
+            return run.counts
+        if run.last_key:
+            self.stdout.write(f'Resuming shard {run.shard} as of {run.as_of_date} after policy holder {run.last_key}')
+
+        policy_holders = in_shard(self.get_queryset(run.as_of_date, **options), options['shard'])
+        self.stdout.write(f'Found {policy_holders.filter(pk__gt=run.last_key).count()} policies to process')
+        try:
+            while True:
+                chunk = list(
+                    policy_holders.filter(pk__gt=run.last_key)
+                    .order_by('pk').values_list('pk', flat=True)[:options['chunk_size']]
+                )
+                if not chunk:
+                    break
+                # Saves made by the chunk apply their side effects set-based, before it commits
+                with transaction.atomic(), bulk_mode():
+                    options['lease'].renew()
+                    counts = self.handle_chunk(
+                        policy_holders.filter(pk__gt=run.last_key, pk__lte=chunk[-1]), run.as_of_date, **options
+                    )
+                    run.checkpoint(chunk[-1], counts)
+        except Exception as e:
+            run.finish(error=str(e))
+            raise
+        run.finish()
+        return run.counts
+
+    def report(self, counts, **options):
+        raise NotImplementedError('subclasses of ShardedCommand must provide a report() method')
+
+    def run_shards(self, options):
+        workers = options['workers']
+        index, count = options['shard']
+        if workers == 1:
+            return self.handle_shard(**options)
+
+        # Worker k takes every workers-th stripe of the requested shard
+        shards = [(index + count * k, count * workers) for k in range(workers)]
+        options = {key: value for key, value in options.items() if key not in ('stdout', 'stderr')}
+        self.stdout.write(f'Running {len(shards)} shards on {workers} workers...')
+        # Forked workers must not share the parent's connections
+        connections.close_all()
+        counts = Counter()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [
+                pool.submit(_run_shard, self.__class__.__module__, {**options, 'shard': shard})
+                for shard in shards
+            ]
+            for future in futures:
+                counts.update(future.result())
+        return dict(counts)
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        index, count = options['shard']
+
+        try:
+            with hold_lease(MAINTENANCE_LEASE) as lease:
+                counts = self.run_shards({**options, 'lease': lease})
+        except LeaseUnavailable as e:
+            raise CommandError(f'Not running {self.job_name}: {e}')
+
+        self.report(counts, **options)
@@ -1,15 +1,18 @@
-from django.core.management.base import BaseCommand
-from datetime import date, timedelta
-from django.db.models import Q, Max, F
-from app.models import PremiumPayment, PolicyHolder
+from datetime import timedelta
+from django.db.models import Q, Max
+from app.bulk import refresh_payment_statuses
+from app.constants import LAPSE_DAYS
+from app.management.base import ShardedCommand
+from app.models import PremiumPayment, PolicyHolder, PolicySurrender
 import logging
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(ShardedCommand):
     help = 'Check policies for expiry due to non-payment'
 
     def add_arguments(self, parser):
+        super().add_arguments(parser)
         parser.add_argument(
             '--force',
             action='store_true',
@@ -22,11 +25,8 @@ class Command(BaseCommand):
             help='Only check policies active within the last N days (default: 1200)',
         )
 
-    def handle(self, *args, **options):
-        force_check = options['force']
-        days_limit = options['days']
-        today = date.today()
-        cutoff_date = today - timedelta(days=days_limit)
+    def get_queryset(self, as_of_date, **options):
+        cutoff_date = as_of_date - timedelta(days=options['days'])
         
         self.stdout.write('Checking for expired policies...')
         
@@ -35,72 +35,79 @@ class Command(BaseCommand):
             ~Q(status='Expired') & ~Q(status='Surrendered'),
             start_date__gte=cutoff_date
         )
-        
-        self.stdout.write(f'Found {active_policies.count()} policies to check from the last {days_limit} days')
-        
-        # Filter policies with unpaid premiums
-        unpaid_premiums = PremiumPayment.objects.filter(
-            policy_holder__in=active_policies,
-            payment_status__in=['Unpaid', 'Partially Paid']
-        ).select_related('policy_holder')
-        
+        if options['force']:
+            return active_policies
+
+        # Only policies with a payment date past the threshold can lapse
+        return active_policies.filter(
+            pk__in=PremiumPayment.objects.filter(
+                next_payment_date__lt=as_of_date - timedelta(days=LAPSE_DAYS)
+            ).values('policy_holder_id')
+        )
+
+    def handle_chunk(self, active_policies, as_of_date, **options):
+        force_check = options['force']
+        threshold = as_of_date - timedelta(days=LAPSE_DAYS)
         checked_count = 0
         expired_count = 0
 
-        # First check for policies with missing payments based on start date
-        for policy in active_policies:
-            # Skip policies without premium payments (they'll be handled elsewhere)
-            if not policy.premium_payments.exists():
-                continue
-                
-            # Get the last payment record and date
-            last_payment = policy.premium_payments.aggregate(
-                last_date=Max('next_payment_date')
-            )['last_date']
-            
-            # Skip if no payment date is recorded
-            if not last_payment:
-                continue
-                
-            # Calculate days since last payment date
-            days_late = (today - last_payment).days
-            
-            # Check if policy has been non-paying for more than 3 years
-            if days_late > 1095 or force_check:
-                checked_count += 1
-                
-                # Mark as expired if meets criteria
-                if days_late > 1095:
-                    policy.status = 'Expired'
-                    policy.save(update_fields=['status'])
-                    
-                    # Also update all related premium payments
-                    policy.premium_payments.filter(
-                        payment_status__in=['Unpaid', 'Partially Paid']
-                    ).update(payment_status='Expired')
-                    
-                    expired_count += 1
-                    logger.info(f"Policy {policy.id} marked as expired due to no payments for {days_late} days")
-        
-        # Then check all unpaid premiums with next_payment_date
-        for payment in unpaid_premiums:
-            if not payment.next_payment_date:
-                continue
-                
-            days_late = (today - payment.next_payment_date).days
-            
-            # Check policies with payments due more than 3 years ago, or check all with force
-            if days_late > 1095 or force_check:
-                checked_count += 1
-                
-                # Skip policies already marked as expired above
-                if payment.policy_holder.status == 'Expired':
-                    continue
-                    
-                if payment.check_policy_expiry():
-                    # Save the payment to persist the 'Expired' status after check_policy_expiry
-                    payment.save(update_fields=['payment_status'])
-                    expired_count += 1
-                    logger.info(f"Policy {payment.policy_holder.id} marked as expired due to non-payment for {days_late} days")
-        
-        self.stdout.write(self.style.SUCCESS(f'Finished checking {checked_count} policies. {expired_count} policies marked as expired.')) 
\ No newline at end of file
+        # First expire policies whose latest payment date is over 3 years ago
+        last_payment_dates = active_policies.annotate(
+            last_date=Max('premium_payments__next_payment_date')
+        ).filter(last_date__isnull=False)
+        if not force_check:
+            last_payment_dates = last_payment_dates.filter(last_date__lt=threshold)
+        last_payment_dates = dict(last_payment_dates.values_list('id', 'last_date'))
+        checked_count += len(last_payment_dates)
+
+        expired_ids = [
+            policy_id for policy_id, last_date in last_payment_dates.items() if last_date < threshold
+        ]
+        if expired_ids:
+            PolicyHolder.objects.filter(pk__in=expired_ids).update(status='Expired')
+            # Also update all related premium payments
+            PremiumPayment.objects.filter(
+                policy_holder_id__in=expired_ids,
+                payment_status__in=['Unpaid', 'Partially Paid']
+            ).update(payment_status='Expired')
+            expired_count += len(expired_ids)
+            for policy_id in expired_ids:
+                days_late = (as_of_date - last_payment_dates[policy_id]).days
+                logger.info(f"Policy {policy_id} marked as expired due to no payments for {days_late} days")
+
+        # Then surrender the remaining policies with an unpaid premium due over 3 years ago
+        unpaid_premiums = PremiumPayment.objects.filter(
+            policy_holder__in=active_policies.exclude(pk__in=expired_ids),
+            payment_status__in=['Unpaid', 'Partially Paid'],
+            next_payment_date__isnull=False
+        )
+        if not force_check:
+            unpaid_premiums = unpaid_premiums.filter(next_payment_date__lt=threshold)
+        unpaid_premiums = list(unpaid_premiums.values_list('id', 'policy_holder_id', 'next_payment_date'))
+        checked_count += len(unpaid_premiums)
+
+        lapsed_payment_ids = []
+        days_late_by_policy = {}
+        for payment_id, policy_id, next_payment_date in unpaid_premiums:
+            if next_payment_date < threshold:
+                lapsed_payment_ids.append(payment_id)
+                days_late = (as_of_date - next_payment_date).days
+                days_late_by_policy[policy_id] = max(days_late, days_late_by_policy.get(policy_id, 0))
+
+        if days_late_by_policy:
+            PolicySurrender.create_automatic_surrenders({
+                policy_id: f"Automatic surrender due to non-payment for {days_late} days (over 3 years)"
+                for policy_id, days_late in days_late_by_policy.items()
+            })
+            PremiumPayment.objects.filter(pk__in=lapsed_payment_ids).update(payment_status='Expired')
+            refresh_payment_statuses(days_late_by_policy)
+            expired_count += len(days_late_by_policy)
+            for policy_id, days_late in days_late_by_policy.items():
+                logger.info(f"Policy {policy_id} marked as expired due to non-payment for {days_late} days")
+
+        return {'checked': checked_count, 'expired': expired_count}
+
+    def report(self, counts, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f"Finished checking {counts.get('checked', 0)} policies. {counts.get('expired', 0)} policies marked as expired."
+        ))
@@ -0,0 +1,54 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from app.payment_import import FILE_FORMATS, IMPORT_CHUNK_SIZE, detect_format, import_payments, read_payment_rows
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Post premium payments from a bank collection file (CSV or JSON lines)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Collection file to import')
+        parser.add_argument(
+            '--format',
+            choices=FILE_FORMATS,
+            help='File format (default: guessed from the extension)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=IMPORT_CHUNK_SIZE,
+            help=f'Number of rows posted per transaction (default: {IMPORT_CHUNK_SIZE})',
+        )
+        parser.add_argument(
+            '--results',
+            help='Write the per-row results CSV here (default: <path>.results.csv, "-" for stdout)',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or detect_format(path)
+        results_path = options['results'] or f'{path}.results.csv'
+        started = time.monotonic()
+
+        try:
+            source = open(path, newline='', encoding='utf-8-sig')
+        except OSError as e:
+            raise CommandError(f'Cannot open {path}: {e}')
+
+        with source:
+            if results_path == '-':
+                counts = import_payments(read_payment_rows(source, file_format), sys.stdout, options['chunk_size'])
+            else:
+                with open(results_path, 'w', newline='', encoding='utf-8') as results:
+                    counts = import_payments(read_payment_rows(source, file_format), results, options['chunk_size'])
+
+        summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'no rows'
+        elapsed = time.monotonic() - started
+        self.stderr.write(self.style.SUCCESS(f'Imported {path} in {elapsed:.1f}s: {summary}'))
+        if results_path != '-':
+            self.stderr.write(f'Results written to {results_path}')
@@ -0,0 +1,24 @@
+from app.management.base import ShardedCommand
+from app.models import PolicyHolder
+from app.policy_events import plan_policy_events
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(ShardedCommand):
+    help = 'Plan the policy event calendar of every policy, e.g. to fill it for the first time'
+
+    def get_queryset(self, as_of_date, **options):
+        self.stdout.write('Planning policy events...')
+
+        return PolicyHolder.objects.all()
+
+    def handle_chunk(self, policy_holders, as_of_date, **options):
+        policy_holder_ids = list(policy_holders.values_list('pk', flat=True))
+        planned_count = plan_policy_events(policy_holder_ids, as_of_date)
+        return {'processed': len(policy_holder_ids), 'planned': planned_count}
+
+    def report(self, counts, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {counts.get('processed', 0)} policies. Planned {counts.get('planned', 0)} policy events."
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from app.rate_grid import rebuild_premium_rate_grid
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed premium rate grid for policies whose rating inputs changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--policy',
+            type=int,
+            action='append',
+            help='Only rebuild the grid of this InsurancePolicy id (repeatable)',
+        )
+
+    def handle(self, *args, **options):
+        policy_ids = set(options['policy']) if options['policy'] else None
+        rebuilt = rebuild_premium_rate_grid(policy_ids)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt premium rate grid for {rebuilt} policies'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+import time
+from app.agent_counters import reconcile_agent_counters
+from app.outbox import drain
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild agent sales totals and monthly report counters from policy holders and the premium ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report how many counters are out of line without changing them',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        started = time.monotonic()
+
+        if not dry_run:
+            # Sales still waiting in the outbox would otherwise be counted twice
+            drained = drain()
+            self.stdout.write(f'Applied {drained} pending outbox events')
+
+        agents, reports = reconcile_agent_counters(dry_run=dry_run)
+
+        elapsed = time.monotonic() - started
+        action = 'Would correct' if dry_run else 'Corrected'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {agents} agent totals and {reports} monthly reports in {elapsed:.1f}s.'
+        ))
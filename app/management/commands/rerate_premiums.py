@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+import time
+from app.bulk import rerate_premium_payments
+from app.models import PremiumPayment
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Recalculate premiums for the whole book after a rating-table change'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='Number of premium payments rated and written per batch (default: 5000)',
+        )
+        parser.add_argument(
+            '--policy',
+            type=int,
+            help='Only re-rate holders of this InsurancePolicy id',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Calculate and report changes without writing them',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+        started = time.monotonic()
+
+        premium_payments = PremiumPayment.objects.exclude(
+            policy_holder__status__in=['Surrendered', 'Expired']
+        )
+        if options['policy']:
+            premium_payments = premium_payments.filter(policy_holder__policy_id=options['policy'])
+
+        processed_count = 0
+        changed_count = 0
+        unrated_count = 0
+
+        self.stdout.write('Re-rating premium payments...')
+
+        for rated, changed, unrated in rerate_premium_payments(premium_payments, chunk_size, dry_run=dry_run):
+            processed_count += rated
+            changed_count += changed
+            unrated_count += unrated
+            self.stdout.write(f'Processed {processed_count} premium payments so far...')
+
+        elapsed = time.monotonic() - started
+        rate = processed_count / elapsed if elapsed else processed_count
+        action = 'Would update' if dry_run else 'Updated'
+        self.stdout.write(self.style.SUCCESS(
+            f'Rated {processed_count} premium payments in {elapsed:.1f}s ({rate:.0f} rows/s). '
+            f'{action} {changed_count}; {unrated_count} could not be rated and were left unchanged.'
+        ))
@@ -1,15 +1,21 @@
-from django.core.management.base import BaseCommand
-from datetime import date, timedelta
+from datetime import timedelta
 from django.db.models import Q
+import numpy as np
+from app.bulk import BULK_CHUNK_SIZE, refresh_payment_statuses
+from app.constants import PAYMENT_INTERVAL_MONTHS
+from app.fines import FineBatch, add_months_array
+from app.management.base import ShardedCommand
 from app.models import PremiumPayment, PolicyHolder
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(ShardedCommand):
     help = 'Update fine calculations for premium payments'
 
     def add_arguments(self, parser):
+        super().add_arguments(parser)
         parser.add_argument(
             '--all',
             action='store_true',
@@ -22,21 +28,23 @@ class Command(BaseCommand):
             help='Only check policies active within the last N days (default: 365)',
         )
 
-    def handle(self, *args, **options):
-        update_all = options['all']
-        days_limit = options['days']
-        today = date.today()
-        cutoff_date = today - timedelta(days=days_limit)
+    def get_queryset(self, as_of_date, **options):
+        cutoff_date = as_of_date - timedelta(days=options['days'])
         
         self.stdout.write('Updating fine calculations for premium payments...')
         
         # Get active policies with start dates within the time limit
-        active_policies = PolicyHolder.objects.filter(
+        return PolicyHolder.objects.filter(
             Q(status='Active') | Q(status='Pending'),
             start_date__gte=cutoff_date
         )
-        
-        self.stdout.write(f'Found {active_policies.count()} active policies within the last {days_limit} days')
+
+    def handle(self, *args, **options):
+        self.started = time.monotonic()
+        super().handle(*args, **options)
+
+    def handle_chunk(self, active_policies, as_of_date, **options):
+        update_all = options['all']
         
         # Filter premium payments based on active policies
         if update_all:
@@ -47,46 +55,50 @@ class Command(BaseCommand):
             premium_payments = PremiumPayment.objects.filter(
                 policy_holder__in=active_policies
             ).exclude(payment_status='Paid')
-            
-        updated_count = 0
-        fines_added = 0
         
-        for payment in premium_payments:
-            # Update next payment date if it's not set
-            if not payment.next_payment_date:
-                interval_months = {
-                    "quarterly": 3,
-                    "semi_annual": 6,
-                    "annual": 12,
-                    "Single": None
-                }.get(payment.policy_holder.payment_interval)
-                
-                if interval_months:
-                    policy_start = payment.policy_holder.start_date
-                    # Set next payment date based on policy start date
-                    payment.next_payment_date = policy_start.replace(
-                        month=((policy_start.month - 1 + interval_months) % 12) + 1,
-                        year=policy_start.year + ((policy_start.month - 1 + interval_months) // 12)
-                    )
-                    logger.info(f"Set next payment date for policy {payment.policy_holder.id} to {payment.next_payment_date}")
-            
-            # Calculate current fine
-            current_fine = payment.calculate_fine()
-            
-            # Update if there's a fine to add
-            if current_fine > 0:
-                old_fine = payment.fine_due
-                payment.fine_due = current_fine
-                payment.save(update_fields=['fine_due', 'next_payment_date'])
-                
-                fines_added += 1
-                logger.info(f"Updated fine for {payment.policy_holder.id} from {old_fine} to {current_fine}")
-            elif payment.next_payment_date and payment.next_payment_date != payment.next_payment_date:
-                # Save if only the next payment date was updated
-                payment.save(update_fields=['next_payment_date'])
-            
-            updated_count += 1
+        rows = list(premium_payments.values_list(
+            'id', 'policy_holder_id', 'next_payment_date', 'interval_payment', 'fine_due',
+            'policy_holder__start_date', 'policy_holder__payment_interval',
+        ))
+        if not rows:
+            return {'updated': 0, 'fines_added': 0}
+        ids, policy_holder_ids, next_payment_dates, interval_payments, fines_due, start_dates, intervals = zip(*rows)
         
+        # Payments without a next payment date are due one interval after the policy start
+        next_payment_dates = np.array(
+            [np.datetime64('NaT') if d is None else np.datetime64(d, 'D') for d in next_payment_dates],
+            dtype='datetime64[D]'
+        )
+        interval_months = np.array([PAYMENT_INTERVAL_MONTHS.get(i) or 0 for i in intervals], dtype=np.int64)
+        filled = np.isnat(next_payment_dates) & (interval_months > 0)
+        next_payment_dates[filled] = add_months_array(
+            np.array(start_dates, dtype='datetime64[D]')[filled], interval_months[filled]
+        )
+        
+        fines = FineBatch(next_payment_dates, interval_payments, as_of_date)
+        fined = fines.fine_cents > 0
+        
+        # Only rows whose fine or next payment date actually changes are written
+        fine_due_cents = np.array([int(f * 100) for f in fines_due], dtype=np.int64)
+        changed = fined & ((fines.fine_cents != fine_due_cents) | filled)
+        
+        updates = []
+        for row in np.flatnonzero(changed):
+            updates.append(PremiumPayment(
+                pk=ids[row], policy_holder_id=policy_holder_ids[row],
+                fine_due=fines.fine(row), next_payment_date=next_payment_dates[row].astype(object),
+            ))
+            logger.info(f"Updated fine for {policy_holder_ids[row]} from {fines_due[row]} to {fines.fine(row)}")
+        PremiumPayment.objects.bulk_update(updates, ['fine_due', 'next_payment_date'], batch_size=BULK_CHUNK_SIZE)
+        # Holder payment statuses are refreshed as saving each payment did
+        refresh_payment_statuses({update.policy_holder_id for update in updates})
+        
+        return {'updated': len(ids), 'fines_added': int(fined.sum())}
+
+    def report(self, counts, **options):
+        elapsed = time.monotonic() - self.started
+        updated = counts.get('updated', 0)
         self.stdout.write(self.style.SUCCESS(
-            f'Updated {updated_count} premium payments. Added/updated fines for {fines_added} payments.'
-        )) 
\ No newline at end of file
+            f"Updated {updated} premium payments. Added/updated fines for {counts.get('fines_added', 0)} payments. "
+            f"({updated / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
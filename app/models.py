@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User, AbstractUser
 from datetime import date, timedelta
 from decimal import Decimal, ROUND_HALF_UP
@@ -25,12 +25,55 @@ from .constants import (
     EMPLOYEE_STATUS_CHOICES,
     EXE_FREQ_CHOICE,
     RISK_CHOICES,
-    PAYMENT_CHOICES
+    PAYMENT_CHOICES,
+    PAYMENT_INTERVAL_COUNTS
 )
+from .rating_tables import get_rating_tables
+from .premium_engine import premium_from_base_rate, premium_from_rates
+from .fines import add_months, fine_for_days_late
 import logging
 
 logger = logging.getLogger(__name__)
 
+class DirtyFieldsMixin:
+    """
+    Remembers the database values of ``TRACKED_FIELDS`` so ``changed_fields``
+    can report which of them were modified since the instance was loaded or
+    last saved. Tracked names are attribute names (``policy_holder_id``).
+    """
+    TRACKED_FIELDS = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if name in cls.TRACKED_FIELDS
+        }
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._remember_tracked_fields(fields)
+
+    def _remember_tracked_fields(self, fields=None):
+        loaded = getattr(self, '_loaded_values', {})
+        for name in self.TRACKED_FIELDS:
+            if name in self.__dict__ and (fields is None or name in fields or name.removesuffix('_id') in fields):
+                loaded[name] = self.__dict__[name]
+        self._loaded_values = loaded
+
+    def changed_fields(self):
+        """Tracked fields that differ from the database; all of them for unsaved instances."""
+        loaded = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded is None:
+            return set(self.TRACKED_FIELDS)
+        return {
+            name for name in self.TRACKED_FIELDS
+            # Deferred fields that were never loaded only count once they are assigned
+            if name in self.__dict__ and (name not in loaded or self.__dict__[name] != loaded[name])
+        }
+
+
 # Create your models here.
 class Occupation(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -43,14 +86,145 @@ class Occupation(models.Model):
     def __str__(self):
         return f"{self.name} ({self.risk_category})"
     
+class RatingVersionQuerySet(models.QuerySet):
+    """
+    Queryset that refuses bulk updates reaching an activated version, which
+    save() and delete() signal handlers would never see.
+    """
+    active_lookup = 'is_active'
+
+    def update(self, **kwargs):
+        if self.filter(**{self.active_lookup: True}).exists():
+            raise ValidationError("Active rating table versions cannot be changed; publish a new version instead.")
+        return super().update(**kwargs)
+
+
+class RatingRowQuerySet(RatingVersionQuerySet):
+    active_lookup = 'rating_version__is_active'
+
+    def update(self, **kwargs):
+        version = kwargs.get('rating_version', kwargs.get('rating_version_id'))
+        version_id = getattr(version, 'pk', version)
+        if version_id and RatingTableVersion.objects.filter(pk=version_id, is_active=True).exists():
+            raise ValidationError("Rows cannot be moved into an active rating table version.")
+        return super().update(**kwargs)
+
+
+class RatingTableVersion(models.Model):
+    """
+    A complete set of rating tables: mortality rates, duration factors, GSV
+    rates, SSV configs and bonus rates.
+
+    Rows are bulk-written to a draft version which is then activated in a
+    single update, so premium calculations never see a partial table. From
+    its effective date an activated version replaces the one before it.
+    Activated versions are immutable. Rows without a version are the
+    original tables and stay in force until the first version takes effect.
+    After that, a product added later is rated from its own unversioned
+    GSV and SSV rows until a version with rows for it is published.
+    Deleting a product deletes its GSV and SSV rows from every version,
+    including activated ones; the rest of those versions is unchanged.
+    """
+    name = models.CharField(max_length=200)
+    effective_date = models.DateField(default=date.today)
+    is_active = models.BooleanField(default=False, help_text="Activated versions can no longer be changed")
+    activated_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = RatingVersionQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-effective_date', '-activated_at']
+        verbose_name = 'Rating Table Version'
+        verbose_name_plural = 'Rating Table Versions'
+
+    def __str__(self):
+        status = "active" if self.is_active else "draft"
+        return f"{self.name} (from {self.effective_date}, {status})"
+
+    @staticmethod
+    def rate_models():
+        return [MortalityRate, DurationFactor, GSVRate, SSVConfig, BonusRate]
+
+    @classmethod
+    def create_draft(cls, name, effective_date=None, based_on=None):
+        """
+        Create a draft holding a copy of every row of the ``based_on`` version
+        id (``None`` copies the unversioned tables).
+        """
+        with transaction.atomic():
+            version = cls.objects.create(name=name, effective_date=effective_date or date.today())
+            for model in cls.rate_models():
+                rows = list(model.objects.filter(rating_version_id=based_on))
+                for row in rows:
+                    row.pk = None
+                    row.rating_version = version
+                model.objects.bulk_create(rows)
+        return version
+
+    @classmethod
+    def publish(cls, name, replacements, effective_date=None):
+        """
+        Publish a new version that copies the version in force and replaces
+        the tables in ``replacements`` (``{model: [unsaved rows]}``).
+        """
+        with transaction.atomic():
+            version = cls.create_draft(
+                name, effective_date=effective_date, based_on=get_rating_tables().rating_version_id
+            )
+            for model, rows in replacements.items():
+                version.replace_rows(model, rows)
+            version.activate()
+        return version
+
+    def check_editable(self):
+        if self.is_active:
+            raise ValidationError(f"Rating table version '{self.name}' is active and cannot be changed.")
+
+    def replace_rows(self, model, rows):
+        """Replace all of this draft's rows of ``model`` with ``rows``."""
+        self.check_editable()
+        with transaction.atomic():
+            model.objects.filter(rating_version=self).delete()
+            for row in rows:
+                row.rating_version = self
+            model.objects.bulk_create(rows)
+
+    def activate(self):
+        """Make this version take effect from its effective date."""
+        with transaction.atomic():
+            version = RatingTableVersion.objects.select_for_update().get(pk=self.pk)
+            version.check_editable()
+            self.is_active = True
+            self.activated_at = timezone.now()
+            self.save(update_fields=['is_active', 'activated_at'])
+        logger.info(f"Activated rating table version {self.pk} effective {self.effective_date}")
+
+
+def check_rating_version_editable(row):
+    """Reject changes to rows that belong, or belonged when last saved, to an activated version."""
+    version_ids = {row.rating_version_id}
+    if row.pk is not None:
+        version_ids.add(type(row).objects.filter(pk=row.pk).values_list('rating_version_id', flat=True).first())
+    version_ids.discard(None)
+    if version_ids and RatingTableVersion.objects.filter(pk__in=version_ids, is_active=True).exists():
+        raise ValidationError("Rows of an active rating table version cannot be changed; publish a new version instead.")
+
+
 class MortalityRate(models.Model):
-    
+    rating_version = models.ForeignKey(
+        RatingTableVersion, on_delete=models.CASCADE, null=True, blank=True, related_name='mortality_rates')
     age_group_start = models.PositiveIntegerField(null = True, blank= True)
     age_group_end = models.PositiveIntegerField(null = True, blank= True)
     rate = models.DecimalField(max_digits=5, decimal_places=2, default=0.00, null = True, blank= True)
 
+    objects = RatingRowQuerySet.as_manager()
+
     class Meta:
-        unique_together = ( 'age_group_start', 'age_group_end')
+        unique_together = ('rating_version', 'age_group_start', 'age_group_end')
+
+    def clean(self):
+        check_rating_version_editable(self)
 
     def __str__(self):
         return f"{self.age_group_start}-{self.age_group_end}: {self.rate}%"
@@ -145,13 +319,18 @@ class InsurancePolicy(models.Model):
             raise ValidationError("PTD percentage must be greater than 0 when PTD is included")
 #Guranteed Surrender Value
 class GSVRate(models.Model):
+    rating_version = models.ForeignKey(
+        RatingTableVersion, on_delete=models.CASCADE, null=True, blank=True, related_name='gsv_rates')
     policy = models.ForeignKey('InsurancePolicy', on_delete=models.CASCADE, related_name='gsv_rates')
     min_year = models.PositiveIntegerField(help_text="Minimum year of the range.")
     max_year = models.PositiveIntegerField(help_text="Maximum year of the range.")
     rate = models.DecimalField(max_digits=5, decimal_places=2, help_text="GSV rate as a percentage.")
 
+    objects = RatingRowQuerySet.as_manager()
+
     def clean(self):
         """Ensure the year range is valid and does not overlap with other GSV ranges."""
+        check_rating_version_editable(self)
         if self.min_year > self.max_year:
             raise ValidationError("Minimum year cannot be greater than maximum year")
         if self.rate < 0:
@@ -163,7 +342,8 @@ class GSVRate(models.Model):
 
         # Get all existing ranges for the policy
         existing_ranges = GSVRate.objects.filter(
-            policy=self.policy
+            policy=self.policy,
+            rating_version_id=self.rating_version_id
         ).exclude(pk=self.pk)  # Exclude the current instance
 
 
@@ -185,6 +365,8 @@ class GSVRate(models.Model):
 
 # SSv Factor
 class SSVConfig(models.Model):
+    rating_version = models.ForeignKey(
+        RatingTableVersion, on_delete=models.CASCADE, null=True, blank=True, related_name='ssv_configs')
     policy = models.ForeignKey('InsurancePolicy', on_delete=models.CASCADE, related_name='ssv_configs')
     min_year = models.PositiveIntegerField(help_text="Minimum year of the range.")
     max_year = models.PositiveIntegerField(help_text="Maximum year of the range.")
@@ -192,13 +374,17 @@ class SSVConfig(models.Model):
     eligibility_years = models.PositiveIntegerField(default=5, help_text="Years of premium payment required for SSV eligibility.")
     custom_condition = models.TextField(blank=True, help_text="Optional custom condition for SSV.")
 
+    objects = RatingRowQuerySet.as_manager()
+
     def clean(self):
         """Ensure the year range is valid and does not overlap with other SSV ranges."""
+        check_rating_version_editable(self)
         if self.min_year >= self.max_year:
             raise ValidationError("Minimum year must be less than maximum year.")
 
         overlapping = SSVConfig.objects.filter(
             policy=self.policy,
+            rating_version_id=self.rating_version_id,
             min_year__lte=self.max_year,
             max_year__gte=self.min_year
         ).exclude(pk=self.pk)  # Exclude the current instance
@@ -292,6 +478,10 @@ class SalesAgent(models.Model):
     total_policies_sold = models.IntegerField(default=0)
     total_premium_collected = models.DecimalField(
         max_digits=12, decimal_places=2, default=0.00)
+    counter_shards = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="Counter rows sales are spread over; raise for high-volume agents to avoid lock contention."
+    )
     last_policy_date = models.DateField(null=True, blank=True)
     termination_date = models.DateField(null=True, blank=True)
     termination_reason = models.CharField(
@@ -321,22 +511,28 @@ class SalesAgent(models.Model):
         ]
         
 class DurationFactor(models.Model):
+    rating_version = models.ForeignKey(
+        RatingTableVersion, on_delete=models.CASCADE, null=True, blank=True, related_name='duration_factors')
     min_duration = models.PositiveIntegerField(help_text="Minimum duration in years")
     max_duration = models.PositiveIntegerField(help_text="Maximum duration in years")
     factor = models.DecimalField(max_digits=5, decimal_places=2)
     policy_type = models.CharField(max_length=50, choices=POLICY_TYPES)
 
+    objects = RatingRowQuerySet.as_manager()
+
     class Meta:
-        unique_together = ['min_duration', 'max_duration', 'policy_type']
+        unique_together = ['rating_version', 'min_duration', 'max_duration', 'policy_type']
         ordering = ['min_duration']
 
     def clean(self):
+        check_rating_version_editable(self)
         if self.min_duration >= self.max_duration:
             raise ValidationError("Minimum duration must be less than maximum duration")
         
 
         overlapping = DurationFactor.objects.filter(
             policy_type=self.policy_type,
+            rating_version_id=self.rating_version_id,
             min_duration__lte=self.max_duration,
             max_duration__gte=self.min_duration
         ).exclude(pk=self.pk)
@@ -347,9 +543,60 @@ class DurationFactor(models.Model):
     def __str__(self):
         return f"{self.policy_type} - {self.min_duration}-{self.max_duration} years ({self.factor})"
 
+
+class PremiumRateGrid(models.Model):
+    """
+    Precomputed premium rate per 1000 of sum assured for every rated
+    (policy, age, duration) combination. Rows are rebuilt in the background
+    whenever the policy, mortality rates or duration factors change;
+    ``source_digest`` identifies the inputs a policy's rows were built from.
+    """
+    policy = models.ForeignKey(InsurancePolicy, on_delete=models.CASCADE, related_name='rate_grid')
+    age = models.PositiveIntegerField()
+    duration_years = models.PositiveIntegerField()
+    base_rate = models.DecimalField(
+        max_digits=18, decimal_places=6,
+        help_text="Premium per 1000 sum assured before riders and underwriting loading."
+    )
+    source_digest = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = ['policy', 'age', 'duration_years']
+        verbose_name = 'Premium Rate Grid'
+        verbose_name_plural = 'Premium Rate Grid'
+
+    def __str__(self):
+        return f"{self.policy.name} - age {self.age}, {self.duration_years} years ({self.base_rate})"
+
+class PolicyNumberSequence(models.Model):
+    """
+    Next unused policy number serial of a company branch. Processes reserve
+    blocks of serials from it and assign them from memory; see
+    ``app.sequences``.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='policy_number_sequences')
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='policy_number_sequences')
+    next_value = models.PositiveBigIntegerField(default=1)
+
+    def __str__(self):
+        return f"{self.company} / {self.branch}: next {self.next_value}"
+
+    class Meta:
+        unique_together = ('company', 'branch')
+        verbose_name = "Policy Number Sequence"
+        verbose_name_plural = "Policy Number Sequences"
+
 #policy holders start
 
-class PolicyHolder(models.Model):
+class PolicyHolder(DirtyFieldsMixin, models.Model):
+    # Inputs of the post-save pipeline stages in app.signals
+    TRACKED_FIELDS = (
+        'status', 'policy_id', 'sum_assured', 'duration_years', 'date_of_birth', 'payment_interval',
+        'include_adb', 'include_ptd', 'occupation_id', 'smoker', 'alcoholic', 'exercise_frequency',
+        'work_environment_risk', 'health_history', 'family_medical_history', 'natural_hazard_exposure',
+        'policy_number',
+    )
+
     id = models.BigAutoField(primary_key=True)
     user = models.OneToOneField(User, on_delete=models.SET_NULL, related_name='policy_holder', null=True, blank=True)
     company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='policy_holders', default=1)
@@ -528,16 +775,8 @@ class PolicyHolder(models.Model):
         if not self.company or not self.branch:
             return None
 
-        try:
-            last_holder = PolicyHolder.objects.filter(
-                company=self.company, branch=self.branch
-            ).exclude(policy_number__isnull=True).order_by('-policy_number').first()
-
-            last_number = int(str(last_holder.policy_number)[-5:]) if last_holder else 0
-            new_number = last_number + 1
-            return f"{self.company.company_code}{self.branch.branch_code}{str(new_number).zfill(5)}"
-        except Exception as e:
-            raise ValueError(f"Error generating policy number: {e}")
+        from .sequences import allocate_policy_numbers
+        return allocate_policy_numbers(self.company, self.branch)[0]
 
     def check_for_maturity(self):
         """Check if policy has reached maturity date"""
@@ -654,15 +893,11 @@ class PolicyHolder(models.Model):
         if not self.maturity_date:
             self.maturity_date = self.calculate_maturity_date()
         
-        # Check for policy maturity
-        if self.pk and self.status == 'Active':
-            self.check_for_maturity()
-            self.check_for_renewal()  # Check for renewal needs
-            
         # Run full validation
         self.full_clean()
         
         super().save(*args, **kwargs)
+        self._remember_tracked_fields(kwargs.get('update_fields'))
 
     def __str__(self):
         """String representation of the policy holder"""
@@ -680,6 +915,8 @@ class PolicyHolder(models.Model):
 # Bonus Rate model
 
 class BonusRate(models.Model):
+    rating_version = models.ForeignKey(
+        RatingTableVersion, on_delete=models.CASCADE, null=True, blank=True, related_name='bonus_rates')
     year = models.PositiveIntegerField(
         default=date.today().year,  # ✅ Default to current year
         help_text="Year the bonus rate applies to"
@@ -696,21 +933,22 @@ class BonusRate(models.Model):
         help_text="Bonus amount per 1000 of sum assured", default=0.00
     )
 
+    objects = RatingRowQuerySet.as_manager()
+
     class Meta:
-        unique_together = ['policy_type', 'min_year', 'max_year']
+        unique_together = ['rating_version', 'policy_type', 'min_year', 'max_year']
         ordering = ['policy_type', 'min_year']
 
+    def clean(self):
+        check_rating_version_editable(self)
+
     def __str__(self):
         return f"{self.policy_type}: {self.min_year}-{self.max_year} years -> {self.bonus_per_thousand} per 1000"
 
     @classmethod
     def get_bonus_rate(cls, policy_type, duration):
         """Fetch the correct bonus rate based on policy type and duration."""
-        return cls.objects.filter(
-            policy_type=policy_type,
-            min_year__lte=duration,
-            max_year__gte=duration
-        ).first()
+        return get_rating_tables().bonus_rate(policy_type, duration)
 
 
 #Bonus Model
@@ -1081,7 +1319,8 @@ class Underwriting(models.Model):
     )
     last_updated_at = models.DateTimeField(auto_now=True)
 
-    def save(self, *args, **kwargs):
+    def assess(self):
+        """Recompute the risk assessment and review flags without saving."""
         # Only calculate risk if manual override is disabled
         if not self.manual_override:
             self.calculate_risk()
@@ -1096,8 +1335,15 @@ class Underwriting(models.Model):
         if self.pk and self.needs_review:
             self.last_reviewed_date = date.today()
             self.needs_review = False
-            
+
+    def save(self, *args, **kwargs):
+        self.assess()
         super().save(*args, **kwargs)
+
+        # In bulk mode the holder and premium are brought in line when the block exits
+        from .bulk import defer_underwriting_save
+        if defer_underwriting_save(self):
+            return
         
         # Update policy holder risk category to match
         if self.policy_holder.risk_category != self.risk_category:
@@ -1251,7 +1497,7 @@ class Underwriting(models.Model):
             premium_payment = self.policy_holder.premium_payments.first()
             
             if premium_payment:
-                premium_payment.save()  # Trigger recalculation
+                premium_payment.save(recalculate=['premium'])
                 logger.info(f"Updated premium for policy_holder_id={self.policy_holder.id} with loading {self.premium_loading_percentage}%")
         except Exception as e:
             logger.error(f"Error updating premium with loading: {str(e)}")
@@ -1296,7 +1542,7 @@ class Underwriting(models.Model):
 
 # Premium Payment Model
 
-class PremiumPayment(models.Model):
+class PremiumPayment(DirtyFieldsMixin, models.Model):
     """Model to track premium payments for a policy holder."""
     policy_holder = models.ForeignKey(
         PolicyHolder, 
@@ -1426,11 +1672,37 @@ class PremiumPayment(models.Model):
                            f"sum_assured={sum_assured}, age={age}")
                 raise ValidationError("Policy, Sum Assured, and Age are required for premium calculation.")
 
+            rating_tables = get_rating_tables()
+
+            # Apply underwriting loading if available
+            loading_percentage = Decimal('0.00')
+            try:
+                if hasattr(self.policy_holder, 'underwriting'):
+                    loading_percentage = self.policy_holder.underwriting.premium_loading_percentage
+                    logger.info(f"PREMIUM CALCULATION - Underwriting loading: {loading_percentage}%")
+            except Exception as e:
+                logger.warning(f"PREMIUM CALCULATION - Error applying underwriting loading: {str(e)}")
+
+            interval_count = PAYMENT_INTERVAL_COUNTS.get(self.policy_holder.payment_interval, 1)
+            adb_percentage = policy.adb_percentage if policy.include_adb else 0
+            ptd_percentage = policy.ptd_percentage if policy.include_ptd else 0
+
+            # Precomputed rate grid: one lookup plus a multiply
+            base_rate = rating_tables.base_rate(policy.id, age, duration_years)
+            if base_rate is not None:
+                annual_premium, interval_payment = premium_from_base_rate(
+                    sum_assured,
+                    base_rate,
+                    adb_percentage=adb_percentage,
+                    ptd_percentage=ptd_percentage,
+                    loading_percentage=loading_percentage,
+                    interval_count=interval_count,
+                )
+                logger.info(f"PREMIUM CALCULATION - RESULT (rate grid): annual={annual_premium}, interval={interval_payment}")
+                return annual_premium, interval_payment
+
             # Fetch mortality rate based on age range
-            mortality_rate_obj = MortalityRate.objects.filter(
-                age_group_start__lte=age,  
-                age_group_end__gte=age  
-            ).first()
+            mortality_rate_obj = rating_tables.mortality_rate(age)
 
             if not mortality_rate_obj:
                 logger.error(f"PREMIUM CALCULATION - No mortality rate found for age {age}")
@@ -1439,16 +1711,8 @@ class PremiumPayment(models.Model):
             mortality_rate = Decimal(mortality_rate_obj.rate)
             logger.info(f"PREMIUM CALCULATION - Found mortality rate: {mortality_rate} for age {age}")
 
-            # Base premium calculation
-            base_premium = (sum_assured * mortality_rate) / Decimal(1000)
-            logger.info(f"PREMIUM CALCULATION - Base premium: {base_premium}")
-
             # Fetch duration factor
-            duration_factor_obj = DurationFactor.objects.filter(
-                min_duration__lte=duration_years,  
-                max_duration__gte=duration_years,
-                policy_type=policy.policy_type
-            ).first()
+            duration_factor_obj = rating_tables.duration_factor(policy.policy_type, duration_years)
 
             if not duration_factor_obj:
                 logger.error(f"PREMIUM CALCULATION - No duration factor found for duration {duration_years} and policy type {policy.policy_type}")
@@ -1457,45 +1721,17 @@ class PremiumPayment(models.Model):
             duration_factor = Decimal(duration_factor_obj.factor)  
             logger.info(f"PREMIUM CALCULATION - Found duration factor: {duration_factor}")
 
-            # Adjust premium based on policy type
-            if policy.policy_type == "Endownment":
-                adjusted_premium = base_premium * Decimal(policy.base_multiplier) * duration_factor
-                logger.info(f"PREMIUM CALCULATION - Endowment premium: {adjusted_premium} (base * {policy.base_multiplier} * {duration_factor})")
-            elif policy.policy_type == "Term":
-                adjusted_premium = base_premium
-                logger.info(f"PREMIUM CALCULATION - Term premium: {adjusted_premium}")
-            else:
-                logger.error(f"PREMIUM CALCULATION - Unsupported policy type: {policy.policy_type}")
-                raise ValidationError(f"Unsupported policy type: {policy.policy_type}")
-
-            # Add ADB/PTD charges if applicable
-            adb_charge = (sum_assured * Decimal(policy.adb_percentage)) / Decimal(100) if policy.include_adb else Decimal('0.00')
-            ptd_charge = (sum_assured * Decimal(policy.ptd_percentage)) / Decimal(100) if policy.include_ptd else Decimal('0.00')
-            logger.info(f"PREMIUM CALCULATION - ADB charge: {adb_charge}, PTD charge: {ptd_charge}")
-
-            # Apply underwriting loading if available
-            premium_loading = Decimal('0.00')
-            try:
-                if hasattr(self.policy_holder, 'underwriting'):
-                    underwriting = self.policy_holder.underwriting
-                    if underwriting.premium_loading_percentage > 0:
-                        premium_loading = (adjusted_premium * underwriting.premium_loading_percentage) / Decimal('100.00')
-                        logger.info(f"PREMIUM CALCULATION - Applied underwriting loading: {underwriting.premium_loading_percentage}% = {premium_loading}")
-            except Exception as e:
-                logger.warning(f"PREMIUM CALCULATION - Error applying underwriting loading: {str(e)}")
-
-            # Calculate final premium with all adjustments
-            annual_premium = adjusted_premium + adb_charge + ptd_charge + premium_loading
-            logger.info(f"PREMIUM CALCULATION - Annual premium (with loading): {annual_premium}")
-
-            # Calculate interval payments
-            interval_mapping = {"quarterly": 4, "semi_annual": 2, "annual": 1, "Single": 1}
-            interval_count = interval_mapping.get(self.policy_holder.payment_interval, 1)
-            interval_payment = annual_premium / Decimal(interval_count)
-            logger.info(f"PREMIUM CALCULATION - Interval payment: {interval_payment} (Annual / {interval_count})")
-
-            annual_premium = annual_premium.quantize(Decimal('1.00'))
-            interval_payment = interval_payment.quantize(Decimal('1.00'))
+            annual_premium, interval_payment = premium_from_rates(
+                policy.policy_type,
+                sum_assured,
+                mortality_rate,
+                duration_factor,
+                base_multiplier=policy.base_multiplier,
+                adb_percentage=adb_percentage,
+                ptd_percentage=ptd_percentage,
+                loading_percentage=loading_percentage,
+                interval_count=interval_count,
+            )
             
             logger.info(f"PREMIUM CALCULATION - RESULT: annual={annual_premium}, interval={interval_payment}")
             return annual_premium, interval_payment
@@ -1508,29 +1744,53 @@ class PremiumPayment(models.Model):
             logger.error(f"PREMIUM CALCULATION - Unexpected error: {str(e)}")
             return Decimal('0.00'), Decimal('0.00')
     
-    # New method for tax calculation
-    def calculate_taxes(self):
-        """Calculate tax amounts based on Nepal regulations"""
+    def tax_breakdown(self, amount):
+        """VAT, service tax and TDS due on a payment of ``amount`` under Nepal regulations."""
         # VAT calculation (13%)
-        self.vat_amount = round(self.paid_amount * Decimal('0.13'), 2)
-        
+        vat_amount = round(amount * Decimal('0.13'), 2)
+
         # Service tax (1% for insurance in Nepal)
-        self.service_tax = round(self.paid_amount * Decimal('0.01'), 2)
-        
+        service_tax = round(amount * Decimal('0.01'), 2)
+
         # TDS calculation (if applicable, usually 15% for agent commission)
+        tds_amount = Decimal('0.00')
         if self.policy_holder.agent:
             # Calculate commission amount (typically 15-25% of premium in Nepal)
             commission_rate = getattr(self.policy_holder.agent, 'commission_rate', Decimal('15'))
-            commission_amount = (self.paid_amount * commission_rate) / Decimal('100')
-            self.tds_amount = round(commission_amount * Decimal('0.15'), 2)
-            
+            commission_amount = (amount * commission_rate) / Decimal('100')
+            tds_amount = round(commission_amount * Decimal('0.15'), 2)
+
+        return vat_amount, service_tax, tds_amount
+
+    # New method for tax calculation
+    def calculate_taxes(self):
+        """Calculate tax amounts based on Nepal regulations"""
+        self.vat_amount, self.service_tax, self.tds_amount = self.tax_breakdown(self.paid_amount)
         return self.vat_amount + self.service_tax + self.tds_amount
+
+    def generate_receipt_number(self):
+        from .sequences import allocate_receipt_numbers
+        return allocate_receipt_numbers(self.policy_holder.branch)[0]
     
-    def add_payment(self, amount):
-        """Record a premium payment."""
+    def add_payment(self, amount, receipt_number=None, payment_date=None, import_key=None):
+        """
+        Record a premium payment. The row is locked while the payment is
+        validated and posted, so concurrent payments see each other's effect.
+        ``import_key`` identifies an imported row without a receipt number.
+        """
+        from .payments import deferred_side_effects, lock_premium_payment
+
+        # Holder status and agent updates run once the lock is released
+        with deferred_side_effects(), transaction.atomic():
+            lock_premium_payment(self)
+            return self._add_payment(amount, receipt_number, payment_date, import_key)
+
+    def _add_payment(self, amount, receipt_number, payment_date, import_key=None):
         # Check if policy is surrendered
         if self.policy_holder.status == 'Surrendered':
             raise ValidationError("Cannot add payment to a surrendered policy.")
+
+        self.update_fine()
         
         # Convert to Decimal for safe operations
         amount = Decimal(str(amount))
@@ -1559,6 +1819,8 @@ class PremiumPayment(models.Model):
         if self.total_paid >= self.total_premium:
             raise ValidationError("This policy is already fully paid. No additional payments are required.")
         
+        from .payments import post_payment
+
         # Check for already paid periods
         if self.is_current_period_paid():
             if has_fine:
@@ -1566,38 +1828,27 @@ class PremiumPayment(models.Model):
                 if amount > self.fine_due:
                     raise ValidationError(f"You have a fine of {self.fine_due} due. Please pay exactly this amount.")
                 # Accept fine payment
-                self.fine_paid += amount
-                self.fine_due = Decimal('0.00')
-                self.paid_amount = amount
-                self.save()
+                post_payment(self, amount, premium_amount=Decimal('0.00'), fine_amount=amount,
+                             receipt_number=receipt_number, payment_date=payment_date, locked=True,
+                             import_key=import_key)
                 return True
             else:
                 raise ValidationError("The current payment period has already been paid. Please wait until the next payment is due.")
         
-        # Ensure all values are Decimal for safe operations
-        if isinstance(self.paid_amount, float):
-            self.paid_amount = Decimal(str(self.paid_amount))
-        if isinstance(self.total_paid, float):
-            self.total_paid = Decimal(str(self.total_paid))
-        
-        # Set the paid amount
-        self.paid_amount = amount
-        
         # Record any unpaid fine to be added to the next payment
+        fine_payment = Decimal('0.00')
         if has_fine and amount == expected_amount:
             # Just pay the premium and leave the fine for next period
             logger.info(f"Fine of {self.fine_due} will be carried over to next payment period")
         elif has_fine and amount > expected_amount:
             # Pay premium and part/all of the fine
             fine_payment = min(amount - expected_amount, self.fine_due)
-            self.fine_paid += fine_payment
-            self.fine_due -= fine_payment
-            logger.info(f"Payment includes fine of {fine_payment}. Remaining fine: {self.fine_due}")
+            logger.info(f"Payment includes fine of {fine_payment}. Remaining fine: {self.fine_due - fine_payment}")
         
-        # Update next payment date and include any remaining fine
-        self.update_next_payment_date()
-        
-        self.save()
+        # Record the payment and move the next payment date on by one interval
+        post_payment(self, amount, premium_amount=amount - fine_payment, fine_amount=fine_payment,
+                     receipt_number=receipt_number, advance_due_date=True, payment_date=payment_date,
+                     locked=True, import_key=import_key)
         
         return True
 
@@ -1618,28 +1869,22 @@ class PremiumPayment(models.Model):
         
         if self.next_payment_date:
             # Calculate next payment date from the current one
-            self.next_payment_date = self.next_payment_date.replace(
-                month=((self.next_payment_date.month - 1 + interval_months) % 12) + 1,
-                year=self.next_payment_date.year + ((self.next_payment_date.month - 1 + interval_months) // 12)
-            )
+            self.next_payment_date = add_months(self.next_payment_date, interval_months)
         else:
             # If there's no next payment date, calculate from today
             today = date.today()
-            self.next_payment_date = today.replace(
-                month=((today.month - 1 + interval_months) % 12) + 1,
-                year=today.year + ((today.month - 1 + interval_months) // 12)
-            )
+            self.next_payment_date = add_months(today, interval_months)
     
     def calculate_gsv(self):
         """Calculate Guaranteed Surrender Value (GSV)."""
         try:
-            if not self.policy_holder or not self.policy_holder.policy:
+            if not self.policy_holder or not self.policy_holder.policy_id:
                 return Decimal(0.00)
     
-            gsv_rate = self.policy_holder.policy.gsv_rates.filter(
-                min_year__lte=self.policy_holder.duration_years,
-                max_year__gte=self.policy_holder.duration_years
-            ).first()
+            gsv_rate = get_rating_tables().gsv_rate(
+                self.policy_holder.policy_id,
+                self.policy_holder.duration_years
+            )
     
             if not gsv_rate:
                 return Decimal(0.00)
@@ -1659,9 +1904,9 @@ class PremiumPayment(models.Model):
                 premiums_paid = self.policy_holder.premium_payments.count()
 
                 # Get applicable SSV configuration
-                applicable_range = self.policy_holder.policy.ssv_configs.filter(
-                    min_year__lte=duration_years, max_year__gte=duration_years
-                ).first()
+                applicable_range = get_rating_tables().ssv_config(
+                    self.policy_holder.policy_id, duration_years
+                )
 
                 if not applicable_range or premiums_paid < applicable_range.eligibility_years:
                     return Decimal('0.00')
@@ -1690,23 +1935,24 @@ class PremiumPayment(models.Model):
         # Calculate days late
         days_late = (today - self.next_payment_date).days
         
-        # Check grace period (15 days in Nepal standard practice)
-        if days_late <= 15:  # 15-day grace period
-            return Decimal('0.00')
-            
-        # Apply fine calculation - 1% per month after due date (Nepal standard)
-        monthly_rate = Decimal('0.01')  # 1% per month
-        daily_rate = monthly_rate / Decimal('30')  # Approximate daily rate
-        
-        # Fine applies after grace period
-        actual_days_late = days_late - 15
-        
         # Ensure interval_payment is Decimal
         if isinstance(self.interval_payment, float):
             self.interval_payment = Decimal(str(self.interval_payment))
             
-        fine = self.interval_payment * daily_rate * Decimal(str(actual_days_late))
-        return max(fine.quantize(Decimal('1.00')), Decimal('0.00'))
+        # 1% per month after the 15-day grace period (Nepal standard)
+        return fine_for_days_late(self.interval_payment, days_late)
+
+    def update_fine(self):
+        """
+        Charge the fine for every day the instalment is late so far, as
+        update_premium_fines does. The fine is only assessed by a policy
+        event when the grace period ends and by the weekly sweep, so a
+        payment brings it up to date first.
+        """
+        fine = self.calculate_fine()
+        if fine > 0 and fine != self.fine_due:
+            PremiumPayment.objects.filter(pk=self.pk).update(fine_due=fine)
+            self.fine_due = fine
 
     def is_current_period_paid(self):
         """Check if the current period has already been paid"""
@@ -1727,10 +1973,7 @@ class PremiumPayment(models.Model):
             policy_start = self.policy_holder.start_date
             
             # Calculate first payment date: start date + interval
-            next_payment_date = policy_start.replace(
-                month=((policy_start.month - 1 + interval_months) % 12) + 1,
-                year=policy_start.year + ((policy_start.month - 1 + interval_months) // 12)
-            )
+            next_payment_date = add_months(policy_start, interval_months)
             
             # Check if we need to calculate future periods based on difference
             if today > next_payment_date:
@@ -1740,10 +1983,7 @@ class PremiumPayment(models.Model):
                 
                 if periods_passed > 0:
                     # Adjust next payment date based on periods passed
-                    next_payment_date = next_payment_date.replace(
-                        month=((next_payment_date.month - 1 + (interval_months * periods_passed)) % 12) + 1,
-                        year=next_payment_date.year + ((next_payment_date.month - 1 + (interval_months * periods_passed)) // 12)
-                    )
+                    next_payment_date = add_months(next_payment_date, interval_months * periods_passed)
             
             # Set the calculated next payment date
             self.next_payment_date = next_payment_date
@@ -1763,10 +2003,7 @@ class PremiumPayment(models.Model):
             return self.payment_status == 'Paid'  # For single payments
             
         # Calculate the previous payment date
-        last_payment_date = self.next_payment_date.replace(
-            month=((self.next_payment_date.month - interval_months - 1) % 12) + 1,
-            year=self.next_payment_date.year - ((self.next_payment_date.month - interval_months <= 0) and 1 or 0)
-        )
+        last_payment_date = add_months(self.next_payment_date, -interval_months)
         
         # If today is after last payment date but before next payment date, current period is paid
         return today > last_payment_date and today < self.next_payment_date
@@ -1791,10 +2028,7 @@ class PremiumPayment(models.Model):
                 return False  # Single payment policy can't expire due to missed regular payments
             
             policy_start = self.policy_holder.start_date
-            self.next_payment_date = policy_start.replace(
-                month=((policy_start.month - 1 + interval_months) % 12) + 1,
-                year=policy_start.year + ((policy_start.month - 1 + interval_months) // 12)
-            )
+            self.next_payment_date = add_months(policy_start, interval_months)
         
         # Calculate days late
         days_late = (today - self.next_payment_date).days
@@ -1814,6 +2048,119 @@ class PremiumPayment(models.Model):
         
         return False
 
+    # Inputs whose changes decide which derived values save() recomputes
+    TRACKED_FIELDS = (
+        'policy_holder_id', 'annual_premium', 'interval_payment', 'total_premium',
+        'total_paid', 'paid_amount', 'payment_status', 'next_payment_date', 'fine_due', 'receipt_number',
+    )
+
+    # Derivation -> (inputs it depends on, fields it writes), in the order save() applies them
+    DERIVATIONS = {
+        'premium': (('policy_holder_id',), ('annual_premium', 'interval_payment', 'total_premium')),
+        'payment': (('paid_amount',), ('paid_amount', 'total_paid', 'vat_amount', 'service_tax',
+                                       'tds_amount', 'receipt_number')),
+        'balance': (('total_premium', 'total_paid'), ('remaining_premium', 'payment_status')),
+        'fine': (('next_payment_date', 'interval_payment', 'fine_due'), ('fine_due',)),
+        'expiry': (('next_payment_date', 'payment_status'), ('next_payment_date', 'payment_status')),
+        'gsv': (('policy_holder_id',), ('gsv_value',)),
+        'ssv': (('policy_holder_id', 'total_paid'), ('ssv_value',)),
+    }
+
+    def save(self, *args, recalculate=(), **kwargs):
+        """
+        Save the payment, recomputing only the derived values whose inputs
+        changed since it was loaded.
+
+        ``recalculate`` forces derivations regardless of changes: ``True``
+        for all of them or an iterable of names from ``DERIVATIONS``. With
+        ``update_fields`` only derivations whose fields are all being saved
+        are considered, so narrow saves skip unrelated work entirely.
+        """
+        update_fields = kwargs.get('update_fields')
+        update_fields = set(update_fields) if update_fields is not None else None
+        forced = set(self.DERIVATIONS) if recalculate is True else set(recalculate)
+
+        # Convert all monetary values to Decimal to prevent type errors
+        for field in ('total_premium', 'total_paid', 'paid_amount', 'fine_due', 'fine_paid'):
+            value = getattr(self, field)
+            if isinstance(value, float):
+                setattr(self, field, Decimal(str(value)))
+
+        for name, (inputs, outputs) in self.DERIVATIONS.items():
+            if update_fields is not None and not update_fields.issuperset(outputs):
+                continue
+            if name in forced or self.changed_fields().intersection(inputs):
+                getattr(self, f'_derive_{name}')()
+
+        pending_transaction = self.__dict__.pop('_pending_transaction', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if pending_transaction is not None:
+                pending_transaction.premium_payment = self
+                pending_transaction.save()
+        self._remember_tracked_fields(update_fields)
+
+    def _derive_premium(self):
+        self.annual_premium, self.interval_payment = self.calculate_premium()
+
+        if self.policy_holder.payment_interval == "Single":
+            self.total_premium = self.interval_payment
+        else:
+            self.total_premium = self.annual_premium * Decimal(str(self.policy_holder.duration_years))
+
+    def _derive_payment(self):
+        # Handle new payment if paid_amount is provided
+        if self.paid_amount <= 0:
+            return
+
+        # Calculate taxes
+        self.calculate_taxes()
+
+        # Each ledger row needs its own receipt; the stored one belongs to the last posting
+        if not self.receipt_number or 'receipt_number' not in self.changed_fields():
+            self.receipt_number = self.generate_receipt_number()
+
+        # Recorded in the ledger once the payment row is saved
+        self._pending_transaction = PremiumTransaction(
+            amount=self.paid_amount,
+            premium_amount=self.paid_amount,
+            vat_amount=self.vat_amount,
+            service_tax=self.service_tax,
+            tds_amount=self.tds_amount,
+            receipt_number=self.receipt_number,
+        )
+
+        # First add to total_paid
+        self.total_paid += self.paid_amount
+        self.paid_amount = Decimal('0.00')  # Reset paid_amount after adding to total_paid
+
+    def _derive_balance(self):
+        # Update remaining premium (doesn't include fines)
+        self.remaining_premium = max(self.total_premium - self.total_paid, Decimal('0.00'))
+
+        # Update payment status based on premium (not including fines)
+        if self.total_paid >= self.total_premium:
+            self.payment_status = 'Paid'
+        elif self.total_paid > 0:
+            self.payment_status = 'Partially Paid'
+        else:
+            self.payment_status = 'Unpaid'
+
+    def _derive_fine(self):
+        # Calculate and apply fine if not already set and no existing fine
+        if self.fine_due <= 0:
+            self.fine_due = self.calculate_fine()
+
+    def _derive_expiry(self):
+        # Check for policy expiry due to non-payment
+        self.check_policy_expiry()
+
+    def _derive_gsv(self):
+        self.gsv_value = self.calculate_gsv()
+
+    def _derive_ssv(self):
+        self.ssv_value = self.calculate_ssv()
+
     def __str__(self):
         return f"Premium Payment - {self.policy_holder.first_name} {self.policy_holder.last_name} ({self.payment_status})"
 
@@ -1821,6 +2168,75 @@ class PremiumPayment(models.Model):
         verbose_name = "Premium Payment"
         verbose_name_plural = "Premium Payments"
 
+class PremiumTransaction(models.Model):
+    """
+    Append-only ledger of money received against a PremiumPayment.
+
+    Each posting records how the amount was allocated between premium and
+    fine, the taxes on it and its receipt. The balances on PremiumPayment are
+    an aggregate of these rows kept current with F() updates as they are
+    posted, so concurrent postings never overwrite each other.
+    """
+    premium_payment = models.ForeignKey(
+        PremiumPayment,
+        on_delete=models.CASCADE,
+        related_name='transactions'
+    )
+    amount = models.DecimalField(max_digits=12, decimal_places=2, help_text="Total amount received")
+    premium_amount = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0.00, help_text="Part of the amount applied to premium"
+    )
+    fine_amount = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0.00, help_text="Part of the amount applied to late fines"
+    )
+    vat_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    service_tax = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    tds_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    # A receipt is posted once; re-imports and retries are rejected on this index
+    receipt_number = models.CharField(max_length=50, blank=True, null=True, unique=True)
+    # Identifies an imported row that had no receipt number, so it is posted once too
+    import_key = models.CharField(max_length=64, blank=True, null=True, unique=True, editable=False)
+    payment_date = models.DateField(default=date.today)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("Premium transactions are append-only and cannot be changed.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError("Premium transactions are append-only and cannot be deleted.")
+
+    def __str__(self):
+        return f"{self.receipt_number or 'Payment'} - {self.amount} on {self.payment_date}"
+
+    class Meta:
+        verbose_name = "Premium Transaction"
+        verbose_name_plural = "Premium Transactions"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['payment_date']),
+            models.Index(fields=['premium_payment', 'payment_date']),
+        ]
+
+class ReceiptSequence(models.Model):
+    """
+    Next unused receipt serial of a branch for one day. Keyed by branch code
+    (0 for holders without a branch) because the code is part of the receipt
+    number. Allocated in blocks; see ``app.sequences``.
+    """
+    branch_code = models.PositiveIntegerField()
+    issue_date = models.DateField()
+    next_value = models.PositiveBigIntegerField(default=1)
+
+    def __str__(self):
+        return f"Branch {self.branch_code} on {self.issue_date}: next {self.next_value}"
+
+    class Meta:
+        unique_together = ('branch_code', 'issue_date')
+        verbose_name = "Receipt Sequence"
+        verbose_name_plural = "Receipt Sequences"
+
 # Agent Report
 class AgentReport(models.Model):
     agent = models.ForeignKey(SalesAgent, on_delete=models.CASCADE)
@@ -1845,6 +2261,28 @@ class AgentReport(models.Model):
     class Meta:
         verbose_name = 'Agent Report'
         verbose_name_plural = 'Agent Reports'
+        unique_together = ('agent', 'branch', 'report_date')
+
+class AgentCounterShard(models.Model):
+    """
+    Sales of a sharded agent (``SalesAgent.counter_shards`` > 1) not yet
+    rolled up into the agent and their monthly report. Concurrent sales
+    update different rows; readers add these to the rolled-up totals.
+    """
+    agent = models.ForeignKey(SalesAgent, on_delete=models.CASCADE, related_name='counter_shards_set')
+    month = models.DateField(help_text="First day of the month the sales count towards.")
+    shard = models.PositiveSmallIntegerField()
+    policies_sold = models.IntegerField(default=0)
+    premium_collected = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_policy_date = models.DateField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.agent} {self.month:%Y-%m} shard {self.shard}"
+
+    class Meta:
+        unique_together = ('agent', 'month', 'shard')
+        verbose_name = 'Agent Counter Shard'
+        verbose_name_plural = 'Agent Counter Shards'
 
 class Loan(models.Model):
     policy_holder = models.ForeignKey('PolicyHolder', on_delete=models.CASCADE, related_name='loans')
@@ -1947,28 +2385,39 @@ class Loan(models.Model):
             })
 
     def accrue_interest(self):
-        """Accrue interest on the remaining balance."""
-        if self.loan_status != 'Active':
-            return
-
-        today = date.today()
-        days_since_last_accrual = (today - self.last_interest_date).days
-
-        if days_since_last_accrual <= 0:
+        """Accrue interest on the remaining balance up to today, recording it in the interest ledger."""
+        if self.loan_status != 'Active' or self.last_interest_date >= date.today():
             return
 
+        from .loan_interest import accrue_loan_interest
         try:
-            daily_rate = self.interest_rate / 100 / 365
-            interest = self.remaining_balance * Decimal(daily_rate) * Decimal(days_since_last_accrual)
-
-            self.accrued_interest += interest.quantize(Decimal('1.00'))
-            self.last_interest_date = today
-            self.save()
+            if accrue_loan_interest(Loan.objects.filter(pk=self.pk)):
+                self.refresh_from_db(fields=['accrued_interest', 'last_interest_date'])
         except Exception as e:
             raise ValidationError(f'Error accruing interest: {str(e)}')
 
     def __str__(self):
         return f"Loan for {self.policy_holder} - {self.loan_status}"
+class LoanInterestAccrual(models.Model):
+    """Interest accrued on a loan over the days since its previous accrual."""
+    loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name='interest_accruals')
+    accrual_date = models.DateField(help_text="Date interest was accrued up to.")
+    from_date = models.DateField(help_text="Date interest was last accrued up to before this accrual.")
+    days = models.PositiveIntegerField()
+    principal = models.DecimalField(max_digits=12, decimal_places=2, help_text="Remaining balance interest was charged on.")
+    interest_rate = models.DecimalField(max_digits=5, decimal_places=2, help_text="Annual interest rate in percentage.")
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Interest on loan {self.loan_id} to {self.accrual_date}: {self.amount}"
+
+    class Meta:
+        unique_together = ('loan', 'accrual_date')
+        ordering = ['-accrual_date']
+        verbose_name = 'Loan Interest Accrual'
+        verbose_name_plural = 'Loan Interest Accruals'
+
 #Loan Repayment Model
 class LoanRepayment(models.Model):
     loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name='repayments')
@@ -1994,6 +2443,9 @@ class LoanRepayment(models.Model):
         if self.pk and self.remaining_loan_balance > 0:
             return
         
+        # Charge the days before this repayment on the balance they were owed on
+        self.loan.accrue_interest()
+
         remaining = self.amount
 
         if self.repayment_type in ('Both', 'Interest'):
@@ -2224,10 +2676,6 @@ class PolicySurrender(models.Model):
             premium_payment = self.policy_holder.premium_payments.first()
             if not premium_payment:
                 return
-                
-            # Get GSV and SSV values from premium payment
-            self.gsv_amount = premium_payment.gsv_value
-            self.ssv_amount = premium_payment.ssv_value
             
             # Get outstanding loans
             outstanding_loans = self.policy_holder.loans.filter(
@@ -2236,48 +2684,54 @@ class PolicySurrender(models.Model):
                 total=Sum('remaining_balance') + Sum('accrued_interest')
             )['total'] or Decimal('0.00')
             
-            self.outstanding_loans = outstanding_loans
-            
-            # Calculate processing fee (typically 1-2% in Nepal)
-            processing_fee_rate = Decimal('0.01')  # 1%
-            max_surrender = max(self.gsv_amount, self.ssv_amount)
-            self.processing_fee = (max_surrender * processing_fee_rate).quantize(Decimal('1.00'))
-            
-            # Calculate TDS (tax) - typically 15% on the surrender profit in Nepal
-            # If policy surrendered after 5 years, tax is usually exempted
-            policy_duration = (date.today() - self.policy_holder.start_date).days // 365
-            
-            if policy_duration < 5 and max_surrender > 0:
-                # Calculate taxable amount (surrender value minus total premiums paid)
-                premium_payment = self.policy_holder.premium_payments.first()
-                total_premiums = premium_payment.total_paid if premium_payment else Decimal('0.00')
-                taxable_amount = max(max_surrender - total_premiums, Decimal('0.00'))
-                
-                # Apply TDS rate (15% in Nepal)
-                tds_rate = Decimal('0.15')
-                self.tax_deduction = (taxable_amount * tds_rate).quantize(Decimal('1.00'))
-            else:
-                self.tax_deduction = Decimal('0.00')
-            
-            # Calculate final surrender amount
-            self.surrender_amount = max(
-                max_surrender - self.outstanding_loans - self.processing_fee - self.tax_deduction,
-                Decimal('0.00')
-            )
-            
-            return {
-                'gsv': self.gsv_amount,
-                'ssv': self.ssv_amount,
-                'surrender_amount': self.surrender_amount,
-                'outstanding_loans': self.outstanding_loans,
-                'processing_fee': self.processing_fee,
-                'tax_deduction': self.tax_deduction
-            }
+            return self.apply_surrender_values(premium_payment, outstanding_loans)
             
         except Exception as e:
             logger.error(f"Error calculating surrender values: {str(e)}")
             raise ValidationError(f"Error calculating surrender values: {str(e)}")
     
+    def apply_surrender_values(self, premium_payment, outstanding_loans):
+        """Set the surrender values from the holder's first premium payment and their outstanding loans."""
+        # Get GSV and SSV values from premium payment
+        self.gsv_amount = premium_payment.gsv_value
+        self.ssv_amount = premium_payment.ssv_value
+        self.outstanding_loans = outstanding_loans
+        
+        # Calculate processing fee (typically 1-2% in Nepal)
+        processing_fee_rate = Decimal('0.01')  # 1%
+        max_surrender = max(self.gsv_amount, self.ssv_amount)
+        self.processing_fee = (max_surrender * processing_fee_rate).quantize(Decimal('1.00'))
+        
+        # Calculate TDS (tax) - typically 15% on the surrender profit in Nepal
+        # If policy surrendered after 5 years, tax is usually exempted
+        policy_duration = (date.today() - self.policy_holder.start_date).days // 365
+        
+        if policy_duration < 5 and max_surrender > 0:
+            # Calculate taxable amount (surrender value minus total premiums paid)
+            total_premiums = premium_payment.total_paid
+            taxable_amount = max(max_surrender - total_premiums, Decimal('0.00'))
+                
+            # Apply TDS rate (15% in Nepal)
+            tds_rate = Decimal('0.15')
+            self.tax_deduction = (taxable_amount * tds_rate).quantize(Decimal('1.00'))
+        else:
+            self.tax_deduction = Decimal('0.00')
+        
+        # Calculate final surrender amount
+        self.surrender_amount = max(
+            max_surrender - self.outstanding_loans - self.processing_fee - self.tax_deduction,
+            Decimal('0.00')
+        )
+        
+        return {
+            'gsv': self.gsv_amount,
+            'ssv': self.ssv_amount,
+            'surrender_amount': self.surrender_amount,
+            'outstanding_loans': self.outstanding_loans,
+            'processing_fee': self.processing_fee,
+            'tax_deduction': self.tax_deduction
+        }
+    
     def approve_surrender(self, user):
         """Approve surrender request and calculate final values."""
         if self.status == 'Approved':
@@ -2327,6 +2781,54 @@ class PolicySurrender(models.Model):
         
         super().save(*args, **kwargs)
     
+    @classmethod
+    def create_automatic_surrenders(cls, reasons):
+        """
+        Create approved automatic surrenders in bulk for ``{policy_holder_id:
+        reason}`` and mark the holders surrendered, as creating them one by
+        one through ``surrender_policy`` does. Returns the surrenders.
+        """
+        policy_holder_ids = sorted(reasons)
+        first_payments = {}
+        for premium_payment in PremiumPayment.objects.filter(
+            policy_holder_id__in=policy_holder_ids
+        ).only('policy_holder_id', 'gsv_value', 'ssv_value', 'total_paid').order_by('id'):
+            first_payments.setdefault(premium_payment.policy_holder_id, premium_payment)
+        outstanding_loans = dict(
+            Loan.objects.filter(policy_holder_id__in=policy_holder_ids, loan_status='Active')
+            .values('policy_holder_id')
+            .annotate(total=Sum('remaining_balance') + Sum('accrued_interest'))
+            .values_list('policy_holder_id', 'total')
+        )
+
+        surrenders = []
+        for policy_holder in PolicyHolder.objects.filter(pk__in=policy_holder_ids).only('id', 'start_date'):
+            surrender = cls(
+                policy_holder=policy_holder,
+                surrender_type='Automatic',
+                surrender_reason=reasons[policy_holder.pk],
+                status='Approved',
+                approval_date=date.today(),
+            )
+            premium_payment = first_payments.get(policy_holder.pk)
+            if premium_payment:
+                surrender.apply_surrender_values(
+                    premium_payment, outstanding_loans.get(policy_holder.pk) or Decimal('0.00')
+                )
+            surrenders.append(surrender)
+
+        with transaction.atomic():
+            cls.objects.bulk_create(surrenders)
+            PolicyHolder.objects.filter(pk__in=policy_holder_ids).update(status='Surrendered')
+            # Surrendered policies are not renewed
+            PolicyRenewal.objects.filter(policy_holder_id__in=policy_holder_ids, status='Pending').update(status='Expired')
+            # Nothing more falls due for them
+            PolicyEvent.objects.filter(policy_holder_id__in=policy_holder_ids, status='Pending').delete()
+
+        for policy_holder_id in policy_holder_ids:
+            logger.info(f"Policy {policy_holder_id} has been surrendered via Automatic")
+        return surrenders
+    
     def __str__(self):
         return f"Surrender: {self.policy_holder} - {self.status} ({self.surrender_amount})"
     
@@ -2455,14 +2957,17 @@ class PolicyRenewal(models.Model):
             self.policy_holder.save(update_fields=[
                 'start_date', 'maturity_date', 'status'
             ])
+
+            # The renewed term has its own anniversaries, maturity and renewal
+            from .policy_events import schedule_policy_events
+            schedule_policy_events([self.policy_holder_id])
             
             # Create a new premium payment record if needed
             try:
                 premium_payment = self.policy_holder.premium_payments.first()
                 if premium_payment:
-                    premium_payment.calculate_premium()
                     premium_payment.payment_status = 'Unpaid'
-                    premium_payment.save()
+                    premium_payment.save(recalculate=['premium'])
             except Exception as e:
                 logger.error(f"Error updating premium payment for renewal: {str(e)}")
             
@@ -2498,61 +3003,159 @@ class PolicyRenewal(models.Model):
             models.Index(fields=['due_date']),
         ]
 
-def save(self, *args, **kwargs):
-    if not self.pk:  # New instance
-        self.annual_premium, self.interval_payment = self.calculate_premium()
 
-        if self.policy_holder.payment_interval == "Single":
-            self.total_premium = self.interval_payment
-        else:
-            self.total_premium = self.annual_premium * Decimal(str(self.policy_holder.duration_years))
+class PolicyEvent(models.Model):
+    """
+    Next date something falls due for a policy, so the daily run reads
+    today's events instead of scanning the whole book. Each holder has at
+    most one pending event of each type; it is planned again whenever the
+    policy is created, paid, renewed or surrendered, and after the event
+    is processed (see app.policy_events).
+    """
+    EVENT_TYPE_CHOICES = [
+        ('Instalment Due', 'Instalment Due'),
+        ('Grace End', 'Grace End'),
+        ('Lapse', 'Lapse'),
+        ('Anniversary', 'Anniversary'),
+        ('Maturity', 'Maturity'),
+        ('Renewal Reminder', 'Renewal Reminder'),
+    ]
+    STATUS_CHOICES = [
+        ('Pending', 'Pending'),
+        ('Done', 'Done'),
+    ]
 
-    # Convert all monetary values to Decimal to prevent type errors
-    if isinstance(self.total_premium, float):
-        self.total_premium = Decimal(str(self.total_premium))
-    if isinstance(self.total_paid, float):
-        self.total_paid = Decimal(str(self.total_paid))
-    if isinstance(self.paid_amount, float):
-        self.paid_amount = Decimal(str(self.paid_amount))
-    if isinstance(self.fine_due, float):
-        self.fine_due = Decimal(str(self.fine_due))
-    if isinstance(self.fine_paid, float):
-        self.fine_paid = Decimal(str(self.fine_paid))
-
-    # Handle new payment if paid_amount is provided
-    if self.paid_amount > 0:
-        # Calculate taxes
-        self.calculate_taxes()
-        
-        # Generate receipt number if not provided
-        if not self.receipt_number:
-            timestamp = timezone.now().strftime('%Y%m%d%H%M%S')
-            self.receipt_number = f"RCP-{self.policy_holder.policy_number}-{timestamp}"
-            
-        # First add to total_paid
-        self.total_paid += self.paid_amount
-        self.paid_amount = Decimal('0.00')  # Reset paid_amount after adding to total_paid
-    
-    # Update remaining premium (doesn't include fines)
-    self.remaining_premium = max(self.total_premium - self.total_paid, Decimal('0.00'))
-
-    # Update payment status based on premium (not including fines)
-    if self.total_paid >= self.total_premium:
-        self.payment_status = 'Paid'
-    elif self.total_paid > 0:
-        self.payment_status = 'Partially Paid'
-    else:
-        self.payment_status = 'Unpaid'
-
-    # Calculate and apply fine if not already set and no existing fine
-    if self.fine_due <= 0:
-        self.fine_due = self.calculate_fine()
-
-    # Check for policy expiry due to non-payment
-    self.check_policy_expiry()
-
-    # --- New GSV and SSV Calculations ---
-    self.gsv_value = self.calculate_gsv()
-    self.ssv_value = self.calculate_ssv()
-        
-    super().save(*args, **kwargs)
\ No newline at end of file
+    policy_holder = models.ForeignKey(PolicyHolder, on_delete=models.CASCADE, related_name='events')
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPE_CHOICES)
+    due_date = models.DateField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Pending')
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} for policy holder {self.policy_holder_id} on {self.due_date} ({self.status})"
+
+    class Meta:
+        verbose_name = "Policy Event"
+        verbose_name_plural = "Policy Events"
+        ordering = ['due_date', 'id']
+        indexes = [
+            models.Index(fields=['due_date', 'event_type']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['policy_holder', 'event_type'],
+                condition=models.Q(status='Pending'),
+                name='unique_pending_policy_event',
+            ),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    Side effect recorded in the same transaction as the write that caused
+    it, and carried out later by the ``drain_outbox`` Celery task.
+    """
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} #{self.pk} ({'processed' if self.processed_at else 'pending'})"
+
+    class Meta:
+        verbose_name = "Outbox Event"
+        verbose_name_plural = "Outbox Events"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['processed_at', 'id']),
+        ]
+
+
+class BatchJobRun(models.Model):
+    """
+    Progress of one run of a chunked maintenance command over one shard of
+    the book. Each chunk's work commits together with its checkpoint, so a
+    failed run can be resumed after the last policy holder it handled.
+    """
+    STATUS_CHOICES = [
+        ('Running', 'Running'),
+        ('Completed', 'Completed'),
+        ('Failed', 'Failed'),
+    ]
+
+    job_name = models.CharField(max_length=100)
+    shard = models.CharField(max_length=20, default='0/1', help_text="Shard of the book processed, as i/N.")
+    as_of_date = models.DateField(help_text="Date the run treats as today, kept when it is resumed.")
+    last_key = models.PositiveBigIntegerField(default=0, help_text="Last policy holder id checkpointed.")
+    counts = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Running')
+    error = models.TextField(null=True, blank=True)
+    started_at = models.DateTimeField(auto_now_add=True)
+    checkpointed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def start(cls, job_name, shard, resume=False):
+        """
+        Begin a run of ``job_name`` over ``shard``. With ``resume``, the
+        latest unfinished run of that job and shard carries on from its
+        checkpoint, and a run already completed today is returned as is.
+        """
+        if resume:
+            latest = cls.objects.filter(job_name=job_name, shard=shard).order_by('-id').first()
+            if latest and (latest.status != 'Completed' or latest.as_of_date == date.today()):
+                if latest.status != 'Completed':
+                    latest.status, latest.error = 'Running', None
+                    latest.save(update_fields=['status', 'error'])
+                return latest
+        return cls.objects.create(job_name=job_name, shard=shard, as_of_date=date.today())
+
+    def checkpoint(self, last_key, counts):
+        """Record a chunk as done; call it inside the chunk's transaction."""
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+        self.last_key = last_key
+        self.checkpointed_at = timezone.now()
+        self.save(update_fields=['last_key', 'counts', 'checkpointed_at'])
+
+    def finish(self, error=None):
+        self.status = 'Failed' if error else 'Completed'
+        self.error = error
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'finished_at'])
+
+    def __str__(self):
+        return f"{self.job_name} {self.shard} as of {self.as_of_date} ({self.status})"
+
+    class Meta:
+        verbose_name = "Batch Job Run"
+        verbose_name_plural = "Batch Job Runs"
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['job_name', 'shard', 'id']),
+        ]
+
+
+class JobLease(models.Model):
+    """
+    A named lease held by at most one process in the cluster at a time,
+    so a maintenance job runs once however many nodes try to start it.
+    Each acquisition raises ``token``; holders renew the lease with their
+    token inside the transaction of every write, so a holder whose lease
+    expired and was taken over can no longer commit (see app.leases).
+    """
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=200, blank=True, help_text="Process holding the lease, as host:pid:id.")
+    token = models.PositiveBigIntegerField(default=0, help_text="Fencing token, raised on every acquisition.")
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} held by {self.holder or 'nobody'} until {self.expires_at}"
+
+    class Meta:
+        verbose_name = "Job Lease"
+        verbose_name_plural = "Job Leases"
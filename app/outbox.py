@@ -0,0 +1,106 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# Events handled per drain transaction
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 200)
+# Failed events are retried by later drains until they have failed this often
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5)
+
+DRAIN_KICK_CACHE_KEY = 'outbox:drain_queued'
+
+_handlers = {}
+
+
+def outbox_handler(event_type):
+    """
+    Register the function that carries out events of ``event_type``. It is
+    called with the event payload inside the transaction that marks the
+    event processed, so its database writes happen exactly once; anything
+    else it does must be safe to repeat.
+    """
+    def register(func):
+        _handlers[event_type] = func
+        return func
+    return register
+
+
+def publish(event_type, payload):
+    """Record an event in the current transaction; it is drained once that commits."""
+    publish_many([(event_type, payload)])
+
+
+def publish_many(events):
+    """Record several ``(event_type, payload)`` events with a single INSERT."""
+    OutboxEvent.objects.bulk_create(
+        [OutboxEvent(event_type=event_type, payload=payload) for event_type, payload in events]
+    )
+    transaction.on_commit(schedule_drain)
+
+
+def schedule_drain():
+    """Queue a drain unless one is already queued; the periodic drain picks up anything missed."""
+    if not cache.add(DRAIN_KICK_CACHE_KEY, True, timeout=60):
+        return
+
+    from .tasks import drain_outbox
+    try:
+        # Don't hold up the request if the broker is unreachable
+        drain_outbox.apply_async(retry=False)
+    except Exception as e:
+        logger.warning(f"OUTBOX - Could not queue drain: {str(e)}")
+
+
+def drain(batch_size=OUTBOX_BATCH_SIZE, max_batches=None):
+    """
+    Carry out pending events in id order, ``batch_size`` per transaction.
+    Concurrent drains skip each other's locked events. Returns the number
+    of events processed.
+    """
+    # Events committed from here on need a drain of their own
+    cache.delete(DRAIN_KICK_CACHE_KEY)
+    processed = 0
+    batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            # Events that fail are left for the next drain rather than retried straight away
+            events = list(
+                OutboxEvent.objects.select_for_update(skip_locked=True)
+                .filter(processed_at__isnull=True, attempts__lt=OUTBOX_MAX_ATTEMPTS, id__gt=last_id)
+                .order_by('id')[:batch_size]
+            )
+            if not events:
+                break
+            last_id = events[-1].pk
+
+            for event in events:
+                handler = _handlers.get(event.event_type)
+                try:
+                    if handler is None:
+                        raise LookupError(f"No outbox handler for {event.event_type}")
+                    # A failing handler only rolls back its own writes
+                    with transaction.atomic():
+                        handler(event.payload)
+                except Exception as e:
+                    event.attempts += 1
+                    event.last_error = str(e)
+                    logger.error(f"OUTBOX - {event} failed (attempt {event.attempts}): {str(e)}")
+                else:
+                    event.attempts += 1
+                    event.processed_at = timezone.now()
+                    processed += 1
+
+            OutboxEvent.objects.bulk_update(events, ['attempts', 'processed_at', 'last_error'])
+        batches += 1
+
+    if processed:
+        logger.info(f"OUTBOX - Processed {processed} events")
+    return processed
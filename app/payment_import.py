@@ -0,0 +1,220 @@
+import csv
+import hashlib
+import itertools
+import json
+import logging
+from collections import Counter
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .bulk import bulk_mode
+from .models import PremiumPayment, PremiumTransaction
+from .payments import PaymentLockTimeout
+
+logger = logging.getLogger(__name__)
+
+# Rows posted per transaction. Every row locks its premium payment until the
+# chunk commits, so chunks stay small enough to finish well inside the
+# payment lock timeout other postings wait for
+IMPORT_CHUNK_SIZE = getattr(settings, 'PAYMENT_IMPORT_CHUNK_SIZE', 50)
+
+FILE_FORMATS = ('csv', 'jsonl')
+
+RESULT_FIELDS = ['row', 'policy_number', 'amount', 'receipt_number', 'status', 'message']
+
+
+def detect_format(filename):
+    """Guess the file format from its extension, defaulting to CSV."""
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_payment_rows(stream, file_format='csv'):
+    """
+    Yield one dict per payment row of a text stream without reading it all
+    into memory. Rows carry ``policy_number``, ``amount`` and either a
+    ``receipt_number`` or a ``payment_date`` (YYYY-MM-DD), or both. A JSON line that
+    cannot be parsed is yielded as ``{'_error': message}``.
+    """
+    if file_format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            row = {'_error': f"Invalid JSON: {e}"}
+        if not isinstance(row, dict):
+            row = {'_error': "Expected a JSON object"}
+        yield row
+
+
+def _clean(value):
+    return str(value).strip() if value is not None else ''
+
+
+def _parse_row(row):
+    """Return ``(policy_number, amount, receipt_number, payment_date)`` or raise ValidationError."""
+    if '_error' in row:
+        raise ValidationError(row['_error'])
+
+    policy_number = _clean(row.get('policy_number'))
+    if not policy_number.isdigit():
+        raise ValidationError(f"Invalid policy number '{policy_number}'.")
+
+    try:
+        amount = Decimal(_clean(row.get('amount')))
+    except InvalidOperation:
+        raise ValidationError(f"Invalid amount '{_clean(row.get('amount'))}'.")
+    if not amount.is_finite():
+        raise ValidationError(f"Invalid amount '{amount}'.")
+
+    payment_date = _clean(row.get('payment_date'))
+    try:
+        payment_date = date.fromisoformat(payment_date) if payment_date else None
+    except ValueError:
+        raise ValidationError(f"Invalid payment date '{payment_date}', expected YYYY-MM-DD.")
+
+    receipt_number = _clean(row.get('receipt_number')) or None
+    # The import key of a row without a receipt is built from its date, which must not depend on the import day
+    if receipt_number is None and payment_date is None:
+        raise ValidationError("A payment date is required for rows without a receipt number.")
+
+    return int(policy_number), amount, receipt_number, payment_date
+
+
+def _import_key(policy_number, amount, payment_date, occurrence):
+    """
+    Ledger key of a row without a receipt number: its policy, amount and
+    payment date, and how many rows of the file carried them so far, so the
+    same file imported again maps onto the same keys.
+    """
+    identity = f'{policy_number}|{amount.quantize(Decimal("0.01"))}|{payment_date.isoformat()}|{occurrence}'
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def _import_chunk(chunk, first_row, premium_payments, occurrences):
+    """Post one chunk of rows in a single transaction and return a result per row."""
+    parsed = []
+    import_keys = []
+    for row in chunk:
+        try:
+            values = _parse_row(row)
+        except ValidationError as e:
+            parsed.append(e)
+            import_keys.append(None)
+            continue
+        parsed.append(values)
+        policy_number, amount, receipt_number, payment_date = values
+        if receipt_number:
+            import_keys.append(None)
+            continue
+        identity = (policy_number, amount, payment_date)
+        occurrences[identity] += 1
+        import_keys.append(_import_key(*identity, occurrences[identity]))
+
+    # One lookup per chunk for every policy number and receipt it mentions
+    rows = [values for values in parsed if not isinstance(values, ValidationError)]
+    payments = {}
+    for payment in premium_payments.filter(
+        policy_holder__policy_number__in={values[0] for values in rows}
+    ).select_related('policy_holder', 'policy_holder__agent').order_by('id'):
+        payments.setdefault(payment.policy_holder.policy_number, payment)
+    posted_receipts = set(PremiumTransaction.objects.filter(
+        receipt_number__in={values[2] for values in rows if values[2]}
+    ).values_list('receipt_number', flat=True))
+    posted_keys = set(PremiumTransaction.objects.filter(
+        import_key__in={import_key for import_key in import_keys if import_key}
+    ).values_list('import_key', flat=True))
+
+    results = []
+    with transaction.atomic(), bulk_mode():
+        for row_number, (row, values, import_key) in enumerate(zip(chunk, parsed, import_keys), start=first_row):
+            result = {
+                'row': row_number,
+                'policy_number': _clean(row.get('policy_number')),
+                'amount': _clean(row.get('amount')),
+                'receipt_number': _clean(row.get('receipt_number')),
+                'status': 'error',
+                'message': '',
+            }
+            results.append(result)
+            if isinstance(values, ValidationError):
+                result['message'] = "; ".join(values.messages)
+                continue
+
+            policy_number, amount, receipt_number, payment_date = values
+            if receipt_number and receipt_number in posted_receipts:
+                result['status'] = 'duplicate'
+                result['message'] = "Receipt already posted."
+                continue
+            if import_key and import_key in posted_keys:
+                result['status'] = 'duplicate'
+                result['message'] = "Payment already imported."
+                continue
+            payment = payments.get(policy_number)
+            if payment is None:
+                result['message'] = "No premium payment found for this policy number."
+                continue
+
+            try:
+                # add_payment runs in its own savepoint, so a failed row leaves the rest of the chunk intact
+                payment.add_payment(
+                    amount, receipt_number=receipt_number, payment_date=payment_date, import_key=import_key
+                )
+            except ValidationError as e:
+                result['message'] = "; ".join(e.messages)
+                continue
+            except PaymentLockTimeout as e:
+                result['message'] = str(e)
+                continue
+
+            result['status'] = 'posted'
+            result['receipt_number'] = payment.receipt_number
+            posted_receipts.add(payment.receipt_number)
+            posted_keys.add(import_key)
+    return results
+
+
+def import_payments(rows, results, chunk_size=IMPORT_CHUNK_SIZE, premium_payments=None):
+    """
+    Post a stream of payment rows, ``chunk_size`` rows per transaction, and
+    write one CSV result line per row to the ``results`` text stream.
+
+    Each row is validated with the same rules as ``PremiumPayment.add_payment``.
+    Rows whose receipt number is already in the ledger are reported as
+    duplicates, as are rows without one whose policy, amount, payment date
+    and occurrence in the file were imported before, so a file can be
+    re-imported safely. Rows without a receipt number must therefore carry
+    a payment date; they are rejected otherwise rather than keyed on the
+    day of the import. ``premium_payments`` restricts which payments rows
+    may be posted to. Returns a Counter of row statuses.
+    """
+    if premium_payments is None:
+        premium_payments = PremiumPayment.objects.all()
+
+    writer = csv.DictWriter(results, fieldnames=RESULT_FIELDS)
+    writer.writeheader()
+    counts = Counter()
+    occurrences = Counter()
+    rows = iter(rows)
+    first_row = 1
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        for result in _import_chunk(chunk, first_row, premium_payments, occurrences):
+            writer.writerow(result)
+            counts[result['status']] += 1
+        first_row += len(chunk)
+        logger.info(f"PAYMENT IMPORT - Processed {first_row - 1} rows: {dict(counts)}")
+    return counts
@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Case, Count, F, Sum, Value, When
+from django.db.models.functions import Greatest
+
+from .models import PolicyHolder, PremiumPayment, PremiumTransaction
+from .outbox import publish_many
+from .policy_events import schedule_policy_events
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+
+_deferred = threading.local()
+
+# PremiumPayment fields maintained from the ledger
+BALANCE_FIELDS = [
+    'total_paid', 'remaining_premium', 'payment_status', 'fine_due', 'fine_paid',
+    'next_payment_date', 'vat_amount', 'service_tax', 'tds_amount', 'receipt_number',
+]
+
+# Fields a payment is validated against, reloaded when its row is locked
+LOCKED_FIELDS = BALANCE_FIELDS + ['total_premium', 'interval_payment']
+
+# Longest one attempt waits for another posting's row lock (PostgreSQL only)
+PAYMENT_LOCK_TIMEOUT_MS = getattr(settings, 'PAYMENT_LOCK_TIMEOUT_MS', 2000)
+# Further attempts before giving up with PaymentLockTimeout
+PAYMENT_LOCK_RETRIES = getattr(settings, 'PAYMENT_LOCK_RETRIES', 2)
+# Lock waits longer than this many seconds are logged and counted as slow
+PAYMENT_LOCK_SLOW_WAIT = getattr(settings, 'PAYMENT_LOCK_SLOW_WAIT', 0.5)
+
+LOCK_METRICS_CACHE_PREFIX = 'payments:lock_waits:'
+LOCK_METRICS = ('acquired', 'wait_ms', 'slow', 'timeouts')
+
+
+class PaymentLockTimeout(Exception):
+    """A premium payment stayed locked by other postings for too long."""
+
+
+def _record_lock_metric(name, value=1):
+    key = LOCK_METRICS_CACHE_PREFIX + name
+    try:
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            if not cache.add(key, value, timeout=None):
+                cache.incr(key, value)
+    except Exception as e:
+        # Metrics must never fail a payment
+        logger.warning(f"Could not record payment lock metric {name}: {str(e)}")
+
+
+def lock_wait_metrics():
+    """Lock-wait counters shared by every worker: acquisitions, total wait, slow waits and timeouts."""
+    values = cache.get_many([LOCK_METRICS_CACHE_PREFIX + name for name in LOCK_METRICS])
+    return {name: values.get(LOCK_METRICS_CACHE_PREFIX + name, 0) for name in LOCK_METRICS}
+
+
+@contextmanager
+def _lock_timeout(connection):
+    """Bound how long statements in the block wait for row locks."""
+    if connection.vendor != 'postgresql':
+        # Other backends wait for their own configured timeout
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT current_setting('lock_timeout'), set_config('lock_timeout', %s, true)",
+            [f'{PAYMENT_LOCK_TIMEOUT_MS}ms'],
+        )
+        previous = cursor.fetchone()[0]
+    yield
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT set_config('lock_timeout', %s, true)", [previous])
+
+
+def lock_premium_payment(premium_payment):
+    """
+    Lock the premium payment row until the current transaction ends and load
+    its current balances into ``premium_payment``. Must be called inside
+    ``transaction.atomic()``; raises PaymentLockTimeout if the row stays
+    locked through every attempt.
+    """
+    connection = transaction.get_connection()
+    locked = PremiumPayment.objects.select_for_update()
+    for attempt in range(1, PAYMENT_LOCK_RETRIES + 2):
+        started = time.monotonic()
+        try:
+            # A failed wait only rolls back this savepoint, not the caller's transaction
+            with transaction.atomic(), _lock_timeout(connection):
+                premium_payment.refresh_from_db(fields=LOCKED_FIELDS, from_queryset=locked)
+        except OperationalError as e:
+            _record_lock_metric('timeouts')
+            logger.warning(f"Lock wait on premium_payment_id={premium_payment.pk} timed out after "
+                           f"{time.monotonic() - started:.2f}s (attempt {attempt})")
+            error = e
+            continue
+
+        waited = time.monotonic() - started
+        _record_lock_metric('acquired')
+        _record_lock_metric('wait_ms', int(waited * 1000))
+        if waited >= PAYMENT_LOCK_SLOW_WAIT:
+            _record_lock_metric('slow')
+            logger.warning(f"Waited {waited:.2f}s for lock on premium_payment_id={premium_payment.pk}")
+        return
+
+    raise PaymentLockTimeout(
+        f"Premium payment {premium_payment.pk} is busy with other payments, please retry."
+    ) from error
+
+
+def holder_payment_status(premium_payment):
+    """Policy holder payment status implied by a premium payment's balances."""
+    if premium_payment.total_paid >= premium_payment.total_premium:
+        return 'Paid'
+    if premium_payment.total_paid > 0:
+        return 'Partially Paid'
+    return 'Unpaid'
+
+
+def _advance_next_payment_date(premium_payment):
+    """
+    Move the next payment date on by one interval. The update only applies if
+    the date is still the one it was computed from, so concurrent postings
+    each advance it once instead of overwriting each other.
+    """
+    payments = PremiumPayment.objects.filter(pk=premium_payment.pk)
+    while True:
+        current = payments.values_list('next_payment_date', flat=True).get()
+        premium_payment.next_payment_date = current
+        premium_payment.update_next_payment_date()
+        if premium_payment.next_payment_date == current:
+            return
+        if payments.filter(next_payment_date=current).update(next_payment_date=premium_payment.next_payment_date):
+            return
+
+
+def post_payment(premium_payment, amount, premium_amount=None, fine_amount=ZERO,
+                 receipt_number=None, advance_due_date=False, payment_date=None, locked=False, import_key=None):
+    """
+    Record money received against a premium payment.
+
+    Appends a PremiumTransaction and applies it to the cached balances on
+    the PremiumPayment with F() expressions, so postings for the same policy
+    never overwrite each other. ``premium_amount`` defaults to everything not
+    allocated to fines and ``payment_date`` to today. Returns the transaction;
+    the balances on ``premium_payment`` are refreshed from the database.
+    Pass ``locked=True`` if the caller already holds the row lock. Raises
+    ValidationError if ``receipt_number`` or ``import_key`` is already in
+    the ledger.
+    """
+    amount = Decimal(str(amount))
+    fine_amount = Decimal(str(fine_amount))
+    premium_amount = amount - fine_amount if premium_amount is None else Decimal(str(premium_amount))
+
+    vat_amount, service_tax, tds_amount = premium_payment.tax_breakdown(amount)
+    receipt_number = receipt_number or premium_payment.generate_receipt_number()
+
+    try:
+        with transaction.atomic():
+            if not locked:
+                lock_premium_payment(premium_payment)
+
+            # Column references on the right-hand side see the values before this update
+            new_total_paid = F('total_paid') + premium_amount
+            PremiumPayment.objects.filter(pk=premium_payment.pk).update(
+                total_paid=new_total_paid,
+                remaining_premium=Greatest(F('total_premium') - new_total_paid, Value(ZERO)),
+                payment_status=Case(
+                    When(total_premium__lte=new_total_paid, then=Value('Paid')),
+                    When(total_paid__gt=-premium_amount, then=Value('Partially Paid')),
+                    default=Value('Unpaid'),
+                ),
+                fine_paid=F('fine_paid') + fine_amount,
+                fine_due=Greatest(F('fine_due') - fine_amount, Value(ZERO)),
+                vat_amount=vat_amount,
+                service_tax=service_tax,
+                tds_amount=tds_amount,
+                receipt_number=receipt_number,
+            )
+            if advance_due_date:
+                _advance_next_payment_date(premium_payment)
+
+            premium_payment.refresh_from_db(fields=BALANCE_FIELDS)
+            premium_transaction = PremiumTransaction.objects.create(
+                premium_payment=premium_payment,
+                amount=amount,
+                premium_amount=premium_amount,
+                fine_amount=fine_amount,
+                vat_amount=vat_amount,
+                service_tax=service_tax,
+                tds_amount=tds_amount,
+                receipt_number=receipt_number,
+                import_key=import_key,
+                payment_date=payment_date or date.today(),
+            )
+    except IntegrityError:
+        # Only this savepoint is rolled back, so the caller's transaction can carry on
+        premium_payment.refresh_from_db(fields=BALANCE_FIELDS)
+        if import_key and PremiumTransaction.objects.filter(import_key=import_key).exists():
+            raise ValidationError("Payment already imported.")
+        raise ValidationError(f"Receipt {receipt_number} has already been posted.")
+
+    logger.info(f"Posted payment {receipt_number}: premium={premium_amount}, fine={fine_amount} "
+                f"for premium_payment_id={premium_payment.pk}")
+    return premium_transaction
+
+
+@contextmanager
+def deferred_side_effects():
+    """
+    Hold back the holder status updates and agent report events of payments
+    posted inside the block and apply them on exit, once per premium payment
+    and payment date with the amounts summed. Holder statuses are written
+    with queryset updates, so PolicyHolder signals do not fire for them.
+    """
+    if getattr(_deferred, 'pending', None) is not None:
+        # Already deferring; the outermost block applies everything
+        yield
+        return
+
+    _deferred.pending = {}
+    try:
+        yield
+        pending = _deferred.pending
+    finally:
+        _deferred.pending = None
+
+    # One UPDATE per status instead of a full save of every holder
+    holders_by_status = {}
+    for premium_payment, _ in pending.values():
+        holders_by_status.setdefault(holder_payment_status(premium_payment), []).append(
+            premium_payment.policy_holder
+        )
+    for payment_status, holders in holders_by_status.items():
+        PolicyHolder.objects.filter(pk__in=[holder.pk for holder in holders]).update(payment_status=payment_status)
+        for holder in holders:
+            holder.payment_status = payment_status
+    schedule_policy_events(premium_payment.policy_holder_id for premium_payment, _ in pending.values())
+
+    events = [
+        premium_collected_event(premium_payment, premium_amount, payment_date)
+        for (_, payment_date), (premium_payment, premium_amount) in pending.items()
+    ]
+    if any(events):
+        publish_many([event for event in events if event])
+
+
+def premium_collected_event(premium_payment, premium_amount, payment_date):
+    """
+    Outbox event crediting premium paid on ``payment_date`` to the holder's
+    agent, or None if there is no agent or nothing to credit.
+    """
+    if not premium_payment.policy_holder.agent_id or premium_amount <= 0:
+        return None
+    return 'premium.collected', {
+        'premium_payment_id': premium_payment.pk,
+        'premium_amount': str(premium_amount),
+        'collected_on': payment_date.isoformat(),
+    }
+
+
+def defer_side_effects(premium_transaction):
+    """Queue the side effects of a new transaction if a deferred block is open; returns whether it was."""
+    pending = getattr(_deferred, 'pending', None)
+    if pending is None:
+        return False
+    # Agents are credited per payment date, so a back-dated payment counts in its own month
+    key = (premium_transaction.premium_payment_id, premium_transaction.payment_date)
+    _, premium_amount = pending.get(key, (None, ZERO))
+    pending[key] = (
+        premium_transaction.premium_payment, premium_amount + premium_transaction.premium_amount
+    )
+    return True
+
+
+def collections(start_date, end_date=None):
+    """Totals collected between two dates (inclusive), from the ledger alone."""
+    return PremiumTransaction.objects.filter(
+        payment_date__range=(start_date, end_date or start_date)
+    ).aggregate(
+        transactions=Count('id'),
+        amount=Sum('amount'),
+        premium=Sum('premium_amount'),
+        fines=Sum('fine_amount'),
+        vat=Sum('vat_amount'),
+        service_tax=Sum('service_tax'),
+        tds=Sum('tds_amount'),
+    )
@@ -0,0 +1,256 @@
+import logging
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .bonuses import BONUS_CATCH_UP_DAYS, anniversary_in, latest_anniversary
+from .constants import LAPSE_DAYS, PAYMENT_INTERVAL_MONTHS
+from .fines import GRACE_PERIOD_DAYS, add_months
+from .maintenance import MAINTENANCE_JOBS, RENEWAL_NOTICE_DAYS
+from .models import PolicyEvent, PolicyHolder, PolicyRenewal, PremiumPayment
+
+logger = logging.getLogger(__name__)
+
+# Policy holders planned, or processed, per transaction
+POLICY_EVENT_CHUNK_SIZE = getattr(settings, 'POLICY_EVENT_CHUNK_SIZE', 1000)
+
+DUE_PAYMENT_STATUSES = ('Unpaid', 'Partially Paid')
+
+
+def _chunks(values, size=POLICY_EVENT_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _next_anniversary(start_date, from_date):
+    """The first anniversary of ``start_date`` on or after ``from_date``; the start date itself is not one."""
+    from_date = max(from_date, start_date + timedelta(days=1))
+    anniversary = anniversary_in(start_date, from_date.year)
+    return anniversary if anniversary >= from_date else anniversary_in(start_date, from_date.year + 1)
+
+
+def _due_dates(policy_holder_ids):
+    """
+    ``{policy_holder_id: (earliest unpaid instalment date, lapse date)}``.
+    Instalments without a date fall due one interval after the policy
+    start, as update_premium_fines fills them in. Lapses count from the
+    latest instalment date or the earliest unpaid one, whichever is first,
+    and only from dates already recorded, as check_policy_expiry does.
+    """
+    due_dates = {}
+    for policy_holder_id, payment_status, next_payment_date, start_date, interval in (
+        PremiumPayment.objects.filter(policy_holder_id__in=policy_holder_ids).values_list(
+            'policy_holder_id', 'payment_status', 'next_payment_date',
+            'policy_holder__start_date', 'policy_holder__payment_interval',
+        )
+    ):
+        earliest_unpaid, earliest_recorded_unpaid, latest = due_dates.get(policy_holder_id, (None, None, None))
+        unpaid = payment_status in DUE_PAYMENT_STATUSES
+        if next_payment_date is not None:
+            latest = max(latest or next_payment_date, next_payment_date)
+            if unpaid:
+                earliest_recorded_unpaid = min(earliest_recorded_unpaid or next_payment_date, next_payment_date)
+        elif PAYMENT_INTERVAL_MONTHS.get(interval) and start_date:
+            next_payment_date = add_months(start_date, PAYMENT_INTERVAL_MONTHS[interval])
+        if unpaid and next_payment_date is not None:
+            earliest_unpaid = min(earliest_unpaid or next_payment_date, next_payment_date)
+        due_dates[policy_holder_id] = (earliest_unpaid, earliest_recorded_unpaid, latest)
+
+    return {
+        policy_holder_id: (earliest_unpaid, min(filter(None, (earliest_recorded_unpaid, latest)), default=None))
+        for policy_holder_id, (earliest_unpaid, earliest_recorded_unpaid, latest) in due_dates.items()
+    }
+
+
+def _holder_events(policy_holder, due_dates, renewals, processed, from_date):
+    """
+    Yield ``(event_type, due_date)`` for the next occurrence of each event
+    due for one holder. ``processed`` maps event types to the latest due
+    date already processed for the holder; occurrences up to that date are
+    not planned again.
+    """
+    policy_holder_id, status, start_date, maturity_date, payment_interval = policy_holder
+    if status not in ('Active', 'Pending'):
+        return
+    earliest_unpaid, lapse_from = due_dates.get(policy_holder_id, (None, None))
+    renewal_due_dates, renewal_lapse_date = renewals.get(policy_holder_id, ((), None))
+
+    def unprocessed(event_type, due_date):
+        last_processed = processed.get(event_type)
+        return last_processed is None or due_date > last_processed
+
+    if earliest_unpaid is not None:
+        if earliest_unpaid >= from_date and unprocessed('Instalment Due', earliest_unpaid):
+            yield 'Instalment Due', earliest_unpaid
+        # The fine is charged once when the grace period ends; after that
+        # PremiumPayment.add_payment and the weekly sweep keep it current,
+        # so overdue holders do not get an event every day
+        grace_end = earliest_unpaid + timedelta(days=GRACE_PERIOD_DAYS + 1)
+        if unprocessed('Grace End', grace_end):
+            yield 'Grace End', max(grace_end, from_date)
+    if lapse_from is not None:
+        lapse_date = lapse_from + timedelta(days=LAPSE_DAYS + 1)
+        if unprocessed('Lapse', lapse_date):
+            yield 'Lapse', max(lapse_date, from_date)
+
+    if status != 'Active':
+        return
+    if start_date:
+        last_processed = processed.get('Anniversary')
+        after = from_date if last_processed is None else max(from_date, last_processed + timedelta(days=1))
+        anniversary = _next_anniversary(start_date, after)
+        # A recent anniversary is still credited, as update_bonuses catches it up
+        last_anniversary = latest_anniversary(start_date, from_date)
+        if (last_anniversary > start_date and (from_date - last_anniversary).days <= BONUS_CATCH_UP_DAYS
+                and unprocessed('Anniversary', last_anniversary)):
+            anniversary = from_date
+        yield 'Anniversary', anniversary
+    # check_renewals both raises the renewal and expires it once its grace period has passed
+    renewal_dates = [renewal_lapse_date] if renewal_lapse_date else []
+    if maturity_date:
+        if unprocessed('Maturity', maturity_date):
+            yield 'Maturity', max(maturity_date, from_date)
+        if payment_interval == 'annual' and maturity_date >= from_date and maturity_date not in renewal_due_dates:
+            renewal_dates.append(maturity_date - timedelta(days=RENEWAL_NOTICE_DAYS))
+    if renewal_dates and unprocessed('Renewal Reminder', min(renewal_dates)):
+        yield 'Renewal Reminder', max(min(renewal_dates), from_date)
+
+
+def plan_policy_events(policy_holder_ids, from_date=None):
+    """
+    Replace the pending events of ``policy_holder_ids`` with the next
+    occurrence of each event on or after ``from_date`` (default today).
+    Events already overdue are planned for ``from_date``, so the next
+    daily run picks them up, unless a run already processed them: the
+    holders' done events record how far each event type has been
+    processed, so replanning after a run, whenever and by whatever save,
+    does not bring back a grace period or anniversary it handled.
+    Returns the number of events planned.
+    """
+    from_date = from_date or date.today()
+    planned = 0
+    for chunk in _chunks(sorted(set(policy_holder_ids))):
+        with transaction.atomic():
+            policy_holders = PolicyHolder.objects.filter(pk__in=chunk).values_list(
+                'pk', 'status', 'start_date', 'maturity_date', 'payment_interval'
+            )
+            due_dates = _due_dates(chunk)
+            renewals = {}
+            for policy_holder_id, due_date, status, grace_period_end in PolicyRenewal.objects.filter(
+                policy_holder_id__in=chunk, status__in=['Pending', 'Renewed']
+            ).values_list('policy_holder_id', 'due_date', 'status', 'grace_period_end'):
+                renewal_due_dates, lapse_date = renewals.get(policy_holder_id, (set(), None))
+                renewal_due_dates.add(due_date)
+                if status == 'Pending' and grace_period_end:
+                    lapse_date = min(filter(None, (lapse_date, grace_period_end + timedelta(days=1))))
+                renewals[policy_holder_id] = (renewal_due_dates, lapse_date)
+            processed = {}
+            for policy_holder_id, event_type, last_processed in PolicyEvent.objects.filter(
+                policy_holder_id__in=chunk, status='Done'
+            ).values('policy_holder_id', 'event_type').annotate(last_processed=Max('due_date')).values_list(
+                'policy_holder_id', 'event_type', 'last_processed'
+            ):
+                processed.setdefault(policy_holder_id, {})[event_type] = last_processed
+
+            events = [
+                PolicyEvent(policy_holder_id=policy_holder[0], event_type=event_type, due_date=due_date)
+                for policy_holder in policy_holders
+                for event_type, due_date in _holder_events(
+                    policy_holder, due_dates, renewals, processed.get(policy_holder[0], {}), from_date
+                )
+            ]
+            PolicyEvent.objects.filter(policy_holder_id__in=chunk, status='Pending').delete()
+            PolicyEvent.objects.bulk_create(events)
+        planned += len(events)
+    return planned
+
+
+def schedule_policy_events(policy_holder_ids):
+    """Plan the events of ``policy_holder_ids`` once the current transaction commits."""
+    policy_holder_ids = set(policy_holder_ids)
+    if policy_holder_ids:
+        transaction.on_commit(lambda: plan_policy_events(policy_holder_ids))
+
+
+def instalments_due(policy_holders, as_of_date):
+    """Note the instalments falling due; reminders go out from here."""
+    due = 0
+    for policy_number in policy_holders.values_list('policy_number', flat=True):
+        # Send reminder notification logic would go here
+        logger.info(f"Instalment due on {as_of_date} for policy {policy_number}")
+        due += 1
+    return {'due': due}
+
+
+def mature_policies(policy_holders, as_of_date):
+    """Surrender the Active policies that have reached maturity."""
+    matured = 0
+    for policy_holder in policy_holders.filter(status='Active', maturity_date__lte=as_of_date):
+        if policy_holder.check_for_maturity():
+            matured += 1
+    return {'matured': matured}
+
+
+# Job run for each event type, in the nightly pipeline's order: fines
+# before lapses, and only policies still active get bonuses, maturity and
+# renewals
+EVENT_JOBS = {
+    'Instalment Due': instalments_due,
+    'Grace End': MAINTENANCE_JOBS['update_premium_fines'],
+    'Lapse': MAINTENANCE_JOBS['check_policy_expiry'],
+    'Anniversary': MAINTENANCE_JOBS['update_bonuses'],
+    'Maturity': mature_policies,
+    'Renewal Reminder': MAINTENANCE_JOBS['check_renewals'],
+}
+
+
+def run_due_events(as_of_date=None, chunk_size=POLICY_EVENT_CHUNK_SIZE, lease=None):
+    """
+    Process the pending events due on or before ``as_of_date`` (default
+    today), ``chunk_size`` policy holders per transaction. Each event type
+    runs its maintenance job on just the holders it is due for; the events
+    are then marked done and the holders' next events planned from the
+    following day. With ``lease``, a chunk only commits while that lease is
+    still held. Returns ``{event_type: counts}``.
+    """
+    as_of_date = as_of_date or date.today()
+    due_events = PolicyEvent.objects.filter(status='Pending', due_date__lte=as_of_date)
+    summary = {}
+    last_id = 0
+
+    from .bulk import bulk_mode
+
+    while True:
+        with transaction.atomic(), bulk_mode():
+            if lease is not None:
+                lease.renew()
+            chunk = list(
+                due_events.filter(policy_holder_id__gt=last_id).order_by('policy_holder_id')
+                .values_list('policy_holder_id', flat=True).distinct()[:chunk_size]
+            )
+            if not chunk:
+                break
+            last_id = chunk[-1]
+
+            events = due_events.filter(policy_holder_id__in=chunk)
+            holders_by_type = {}
+            for event_type, policy_holder_id in events.values_list('event_type', 'policy_holder_id'):
+                holders_by_type.setdefault(event_type, set()).add(policy_holder_id)
+            for event_type, job in EVENT_JOBS.items():
+                if event_type not in holders_by_type:
+                    continue
+                counts = job(PolicyHolder.objects.filter(pk__in=holders_by_type[event_type]), as_of_date)
+                totals = summary.setdefault(event_type, {})
+                for name, count in counts.items():
+                    totals[name] = totals.get(name, 0) + count
+
+            # Done events are what keeps the occurrences just processed from being planned again
+            events.update(status='Done', processed_at=timezone.now())
+            plan_policy_events(chunk, as_of_date + timedelta(days=1))
+
+    logger.info(f"POLICY EVENTS - Processed events due by {as_of_date}: {summary}")
+    return summary
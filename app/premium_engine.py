@@ -0,0 +1,206 @@
+import logging
+from decimal import Decimal
+
+import numpy as np
+from django.core.exceptions import ValidationError
+
+from .constants import PAYMENT_INTERVAL_COUNTS
+from .rating_tables import get_rating_tables
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('1.00')
+
+# Float results closer than this (relative, in paisa) to a half-paisa are
+# recomputed in Decimal so the rounding matches calculate_premium exactly.
+TIE_TOLERANCE = 1e-9
+
+
+def base_rate_from_rates(policy_type, mortality_rate, duration_factor, base_multiplier=1):
+    """
+    Premium per 1000 of sum assured before riders and loading.
+
+    The product is exact in Decimal, so pricing from a stored base rate gives
+    the same result as pricing from the underlying rates.
+    """
+    if policy_type == "Endownment":
+        return Decimal(mortality_rate) * Decimal(base_multiplier) * Decimal(duration_factor)
+    elif policy_type == "Term":
+        return Decimal(mortality_rate)
+    raise ValidationError(f"Unsupported policy type: {policy_type}")
+
+
+def premium_from_base_rate(sum_assured, base_rate, adb_percentage=0, ptd_percentage=0,
+                           loading_percentage=0, interval_count=1):
+    """
+    Annual and interval premium from a base rate per 1000 of sum assured.
+
+    Riders are charged when their percentage is non-zero and the underwriting
+    loading applies to the mortality-based part only. Both amounts are
+    rounded to paisa.
+    """
+    adjusted_premium = (sum_assured * Decimal(base_rate)) / Decimal(1000)
+
+    adb_charge = (sum_assured * Decimal(adb_percentage)) / Decimal(100)
+    ptd_charge = (sum_assured * Decimal(ptd_percentage)) / Decimal(100)
+
+    premium_loading = Decimal('0.00')
+    if loading_percentage and loading_percentage > 0:
+        premium_loading = (adjusted_premium * Decimal(loading_percentage)) / Decimal('100.00')
+
+    annual_premium = adjusted_premium + adb_charge + ptd_charge + premium_loading
+    interval_payment = annual_premium / Decimal(interval_count)
+
+    return annual_premium.quantize(CENT), interval_payment.quantize(CENT)
+
+
+def premium_from_rates(policy_type, sum_assured, mortality_rate, duration_factor,
+                       base_multiplier=1, adb_percentage=0, ptd_percentage=0,
+                       loading_percentage=0, interval_count=1):
+    """Annual and interval premium for one set of rating inputs."""
+    return premium_from_base_rate(
+        sum_assured,
+        base_rate_from_rates(policy_type, mortality_rate, duration_factor, base_multiplier),
+        adb_percentage=adb_percentage,
+        ptd_percentage=ptd_percentage,
+        loading_percentage=loading_percentage,
+        interval_count=interval_count,
+    )
+
+
+def cents_to_decimal(cents):
+    """Convert an integer amount of paisa to a 2dp Decimal."""
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def _as_float(values):
+    return np.array([np.nan if v is None else float(v) for v in values], dtype=float)
+
+
+def _interval_lookup(index, keys, attr):
+    """Vectorised IntervalIndex lookup returning ``attr`` of the matched rows (NaN if none)."""
+    result = np.full(len(keys), np.nan)
+    if index is None or not index.starts:
+        return result
+
+    starts = np.asarray(index.starts, dtype=float)
+    values = _as_float(getattr(row, attr) if row is not None else None for row in index.values)
+
+    valid = ~np.isnan(keys)
+    positions = np.searchsorted(starts, keys[valid], side='right') - 1
+    found = np.where(positions >= 0, values[np.clip(positions, 0, None)], np.nan)
+    result[valid] = found
+    return result
+
+
+def _round_half_even_cents(amounts):
+    """Round rupee amounts to paisa, flagging values too close to a tie to trust."""
+    scaled = amounts * 100
+    fraction = scaled - np.floor(scaled)
+    near_tie = np.abs(fraction - 0.5) <= TIE_TOLERANCE * np.maximum(np.abs(scaled), 1)
+    return np.rint(scaled), near_tie
+
+
+class PremiumBatch:
+    """
+    Column-oriented premium calculation for many policies at once.
+
+    Each argument is a sequence with one entry per policy, using the same
+    inputs as ``PremiumPayment.calculate_premium``. After construction,
+    ``annual_cents`` and ``interval_cents`` hold the rounded premiums in paisa
+    and ``rated`` marks rows for which a premium could be determined; the
+    remaining rows are the ones calculate_premium would price at 0.00 or
+    reject.
+    """
+
+    def __init__(self, age, sum_assured, duration_years, policy_type, base_multiplier,
+                 include_adb, adb_percentage, include_ptd, ptd_percentage,
+                 loading_percentage, payment_interval, rating_tables=None):
+        self.rating_tables = rating_tables or get_rating_tables()
+        self._inputs = dict(
+            age=list(age),
+            sum_assured=list(sum_assured),
+            duration_years=list(duration_years),
+            policy_type=list(policy_type),
+            base_multiplier=list(base_multiplier),
+            adb_percentage=[p if inc else 0 for inc, p in zip(include_adb, adb_percentage)],
+            ptd_percentage=[p if inc else 0 for inc, p in zip(include_ptd, ptd_percentage)],
+            loading_percentage=[p or 0 for p in loading_percentage],
+            interval_count=[PAYMENT_INTERVAL_COUNTS.get(i, 1) for i in payment_interval],
+        )
+        self._calculate()
+
+    def __len__(self):
+        return len(self.rated)
+
+    def _calculate(self):
+        inputs = self._inputs
+        ages = _as_float(inputs['age'])
+        durations = _as_float(inputs['duration_years'])
+        sums = _as_float(inputs['sum_assured'])
+        multipliers = _as_float(inputs['base_multiplier'])
+        adb = _as_float(inputs['adb_percentage'])
+        ptd = _as_float(inputs['ptd_percentage'])
+        loading = _as_float(inputs['loading_percentage'])
+        counts = np.asarray(inputs['interval_count'], dtype=float)
+        policy_types = np.asarray(inputs['policy_type'], dtype=object)
+
+        mortality = _interval_lookup(self.rating_tables.mortality, ages, 'rate')
+        factors = np.full(len(ages), np.nan)
+        for policy_type in set(inputs['policy_type']):
+            rows = policy_types == policy_type
+            factors[rows] = _interval_lookup(
+                self.rating_tables.duration_factors.get(policy_type), durations[rows], 'factor'
+            )
+
+        is_endowment = policy_types == "Endownment"
+        is_term = policy_types == "Term"
+
+        base = sums * mortality / 1000
+        adjusted = np.where(is_endowment, base * multipliers * factors, base)
+        premium_loading = np.where(loading > 0, adjusted * loading / 100, 0.0)
+        annual = adjusted + sums * adb / 100 + sums * ptd / 100 + premium_loading
+        interval = annual / counts
+
+        with np.errstate(invalid='ignore'):
+            self.rated = (
+                (ages > 0) & (sums > 0)
+                & ~np.isnan(mortality) & ~np.isnan(factors)
+                & (is_endowment | is_term)
+                & ~np.isnan(annual)
+            )
+
+        annual_cents, annual_ties = _round_half_even_cents(np.where(self.rated, annual, 0.0))
+        interval_cents, interval_ties = _round_half_even_cents(np.where(self.rated, interval, 0.0))
+        self.annual_cents = annual_cents.astype(np.int64)
+        self.interval_cents = interval_cents.astype(np.int64)
+
+        self.exact_rows = np.flatnonzero(self.rated & (annual_ties | interval_ties))
+        for row in self.exact_rows:
+            annual_premium, interval_payment = self._exact(row)
+            self.annual_cents[row] = int(annual_premium * 100)
+            self.interval_cents[row] = int(interval_payment * 100)
+
+        if len(self.exact_rows):
+            logger.info(f"PREMIUM BATCH - Recomputed {len(self.exact_rows)} near-tie rows in Decimal")
+
+    def _exact(self, row):
+        inputs = self._inputs
+        policy_type = inputs['policy_type'][row]
+        return premium_from_rates(
+            policy_type,
+            Decimal(inputs['sum_assured'][row]),
+            self.rating_tables.mortality_rate(inputs['age'][row]).rate,
+            self.rating_tables.duration_factor(policy_type, inputs['duration_years'][row]).factor,
+            base_multiplier=inputs['base_multiplier'][row],
+            adb_percentage=inputs['adb_percentage'][row],
+            ptd_percentage=inputs['ptd_percentage'][row],
+            loading_percentage=inputs['loading_percentage'][row],
+            interval_count=inputs['interval_count'][row],
+        )
+
+    def annual_premium(self, row):
+        return cents_to_decimal(self.annual_cents[row])
+
+    def interval_payment(self, row):
+        return cents_to_decimal(self.interval_cents[row])
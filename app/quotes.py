@@ -0,0 +1,187 @@
+import functools
+import itertools
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from .constants import PAYMENT_INTERVAL_COUNTS
+from .premium_engine import CENT, PremiumBatch, premium_from_base_rate, premium_from_rates
+from .rating_tables import get_rating_tables
+
+# Maximum number of distinct quotes kept in memory per process
+QUOTE_CACHE_SIZE = getattr(settings, 'PREMIUM_QUOTE_CACHE_SIZE', 10000)
+
+_cache_lock = threading.Lock()
+_cached_snapshot_id = None
+
+
+def _total_premium(annual_premium, interval_payment, payment_interval, duration_years):
+    if payment_interval == "Single":
+        return interval_payment
+    return annual_premium * Decimal(str(duration_years))
+
+
+@functools.lru_cache(maxsize=QUOTE_CACHE_SIZE)
+def _quote(rating_tables, policy_id, age, sum_assured, duration_years, payment_interval,
+           include_adb, include_ptd, loading_percentage):
+    policy = rating_tables.policy(policy_id)
+    interval_count = PAYMENT_INTERVAL_COUNTS.get(payment_interval, 1)
+    adb_percentage = policy.adb_percentage if include_adb else 0
+    ptd_percentage = policy.ptd_percentage if include_ptd else 0
+
+    base_rate = rating_tables.base_rate(policy_id, age, duration_years)
+    if base_rate is not None:
+        annual_premium, interval_payment = premium_from_base_rate(
+            sum_assured,
+            base_rate,
+            adb_percentage=adb_percentage,
+            ptd_percentage=ptd_percentage,
+            loading_percentage=loading_percentage,
+            interval_count=interval_count,
+        )
+        return annual_premium, interval_payment, _total_premium(
+            annual_premium, interval_payment, payment_interval, duration_years
+        )
+
+    mortality_rate = rating_tables.mortality_rate(age)
+    duration_factor = rating_tables.duration_factor(policy.policy_type, duration_years)
+    if not mortality_rate or mortality_rate.rate is None or not duration_factor:
+        return None
+
+    annual_premium, interval_payment = premium_from_rates(
+        policy.policy_type,
+        sum_assured,
+        mortality_rate.rate,
+        duration_factor.factor,
+        base_multiplier=policy.base_multiplier,
+        adb_percentage=adb_percentage,
+        ptd_percentage=ptd_percentage,
+        loading_percentage=loading_percentage,
+        interval_count=interval_count,
+    )
+    return annual_premium, interval_payment, _total_premium(
+        annual_premium, interval_payment, payment_interval, duration_years
+    )
+
+
+def quote_premium(policy_id, age, sum_assured, duration_years, payment_interval="annual",
+                  include_adb=None, include_ptd=None, loading_percentage=0):
+    """
+    Quote a premium without creating or saving anything.
+
+    Riders default to the policy's own ADB/PTD settings. Results are memoised
+    per rating-table snapshot, so repeated quotes for the same inputs are
+    served from memory. Returns ``None`` when no mortality rate or duration
+    factor covers the inputs.
+    """
+    global _cached_snapshot_id
+
+    rating_tables = get_rating_tables()
+    policy = rating_tables.policy(int(policy_id))
+    if policy is None:
+        raise ValidationError(f"Insurance policy {policy_id} does not exist.")
+
+    # Entries from an older snapshot can never be hit again, so drop them
+    with _cache_lock:
+        if _cached_snapshot_id != rating_tables.snapshot_id:
+            _quote.cache_clear()
+            _cached_snapshot_id = rating_tables.snapshot_id
+
+    result = _quote(
+        rating_tables,
+        policy.pk,
+        int(age),
+        Decimal(sum_assured).quantize(CENT),
+        int(duration_years),
+        payment_interval,
+        policy.include_adb if include_adb is None else bool(include_adb),
+        policy.include_ptd if include_ptd is None else bool(include_ptd),
+        Decimal(loading_percentage or 0).quantize(CENT),
+    )
+    if result is None:
+        return None
+
+    annual_premium, interval_payment, total_premium = result
+    return {
+        'annual_premium': annual_premium,
+        'interval_payment': interval_payment,
+        'total_premium': total_premium,
+    }
+
+
+def quote_for_policy_holder(policy_holder):
+    """Quote the current premium of an existing policy holder."""
+    loading_percentage = Decimal('0.00')
+    if hasattr(policy_holder, 'underwriting'):
+        loading_percentage = policy_holder.underwriting.premium_loading_percentage
+
+    return quote_premium(
+        policy_holder.policy_id,
+        policy_holder.age,
+        policy_holder.sum_assured,
+        policy_holder.duration_years,
+        policy_holder.payment_interval,
+        loading_percentage=loading_percentage,
+    )
+
+
+def quote_matrix(policy_id, age, durations, sums_assured, payment_intervals=("annual",),
+                 include_adb=None, include_ptd=None, loading_percentage=0):
+    """
+    Quote every combination of duration, sum assured and payment interval for
+    one applicant in a single vectorised pass.
+
+    Returns one dict per cell, in duration, sum assured, interval order. The
+    premium amounts of a cell are ``None`` when no rate covers it.
+    """
+    rating_tables = get_rating_tables()
+    policy = rating_tables.policy(int(policy_id))
+    if policy is None:
+        raise ValidationError(f"Insurance policy {policy_id} does not exist.")
+
+    include_adb = policy.include_adb if include_adb is None else bool(include_adb)
+    include_ptd = policy.include_ptd if include_ptd is None else bool(include_ptd)
+    cells = [
+        (int(duration), Decimal(sum_assured).quantize(CENT), payment_interval)
+        for duration, sum_assured, payment_interval
+        in itertools.product(durations, sums_assured, payment_intervals)
+    ]
+    if not cells:
+        return []
+
+    count = len(cells)
+    batch = PremiumBatch(
+        age=[int(age)] * count,
+        sum_assured=[cell[1] for cell in cells],
+        duration_years=[cell[0] for cell in cells],
+        policy_type=[policy.policy_type] * count,
+        base_multiplier=[policy.base_multiplier] * count,
+        include_adb=[include_adb] * count,
+        adb_percentage=[policy.adb_percentage] * count,
+        include_ptd=[include_ptd] * count,
+        ptd_percentage=[policy.ptd_percentage] * count,
+        loading_percentage=[Decimal(loading_percentage or 0)] * count,
+        payment_interval=[cell[2] for cell in cells],
+        rating_tables=rating_tables,
+    )
+
+    matrix = []
+    for row, (duration_years, sum_assured, payment_interval) in enumerate(cells):
+        cell = {
+            'duration_years': duration_years,
+            'sum_assured': sum_assured,
+            'payment_interval': payment_interval,
+            'annual_premium': None,
+            'interval_payment': None,
+            'total_premium': None,
+        }
+        if batch.rated[row]:
+            cell['annual_premium'] = batch.annual_premium(row)
+            cell['interval_payment'] = batch.interval_payment(row)
+            cell['total_premium'] = _total_premium(
+                cell['annual_premium'], cell['interval_payment'], payment_interval, duration_years
+            )
+        matrix.append(cell)
+    return matrix
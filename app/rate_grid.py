@@ -0,0 +1,133 @@
+import hashlib
+import logging
+
+from django.db import transaction
+
+from .premium_engine import base_rate_from_rates
+from .rating_tables import RatingTables, current_version, invalidate_rating_tables
+
+logger = logging.getLogger(__name__)
+
+BULK_CREATE_BATCH_SIZE = 2000
+
+
+def _segments(index):
+    """Yield ``(first, last, row)`` for every rated segment of an IntervalIndex."""
+    if index is None:
+        return
+    for position, row in enumerate(index.values):
+        if row is not None:
+            # A rated segment is always followed by the start of the next one
+            yield index.starts[position], index.starts[position + 1] - 1, row
+
+
+def policy_grid_digest(rating_tables, policy):
+    """Fingerprint of every input the policy's grid rows are derived from."""
+    parts = [policy.policy_type, str(policy.base_multiplier)]
+    parts += [f"m{first}-{last}:{row.rate}" for first, last, row in _segments(rating_tables.mortality)]
+    parts += [
+        f"d{first}-{last}:{row.factor}"
+        for first, last, row in _segments(rating_tables.duration_factors.get(policy.policy_type))
+    ]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+def grid_rows(rating_tables, policy, digest):
+    """Build the PremiumRateGrid rows for one policy."""
+    from .models import PremiumRateGrid
+
+    if policy.policy_type not in ("Endownment", "Term"):
+        return []
+
+    durations = list(_segments(rating_tables.duration_factors.get(policy.policy_type)))
+    rows = []
+    for age_first, age_last, mortality_rate in _segments(rating_tables.mortality):
+        if mortality_rate.rate is None:
+            continue
+        for duration_first, duration_last, duration_factor in durations:
+            base_rate = base_rate_from_rates(
+                policy.policy_type, mortality_rate.rate, duration_factor.factor, policy.base_multiplier
+            )
+            rows.extend(
+                PremiumRateGrid(
+                    policy_id=policy.pk,
+                    age=age,
+                    duration_years=duration,
+                    base_rate=base_rate,
+                    source_digest=digest,
+                )
+                for age in range(age_first, age_last + 1)
+                for duration in range(duration_first, duration_last + 1)
+            )
+    return rows
+
+
+def load_rate_grid(rating_tables):
+    """
+    Return ``{(policy_id, age, duration_years): base_rate}`` for the policies
+    whose grid is current with ``rating_tables``. Policies with a stale or
+    missing grid are left out so callers fall back to the rating tables.
+    """
+    from .models import PremiumRateGrid
+
+    digests = {
+        policy_id: policy_grid_digest(rating_tables, policy)
+        for policy_id, policy in rating_tables.policies.items()
+    }
+    stored = PremiumRateGrid.objects.values_list('policy_id', 'source_digest').distinct()
+    current = [policy_id for policy_id, digest in stored if digests.get(policy_id) == digest]
+    if not current:
+        return {}
+
+    rows = PremiumRateGrid.objects.filter(policy_id__in=current).values_list(
+        'policy_id', 'age', 'duration_years', 'base_rate'
+    )
+    return {(policy_id, age, duration): base_rate for policy_id, age, duration, base_rate in rows}
+
+
+def rebuild_premium_rate_grid(policy_ids=None):
+    """
+    Rebuild the grid rows of every policy whose inputs changed since its grid
+    was built. Returns the number of policies rebuilt.
+    """
+    from .models import PremiumRateGrid
+
+    # Load fresh rather than reuse this process's snapshot, which may be stale
+    rating_tables = RatingTables(current_version(), with_rate_grid=False)
+    stored = dict(PremiumRateGrid.objects.values_list('policy_id', 'source_digest').distinct())
+
+    rebuilt = 0
+    for policy_id, policy in rating_tables.policies.items():
+        if policy_ids is not None and policy_id not in policy_ids:
+            continue
+        digest = policy_grid_digest(rating_tables, policy)
+        if stored.get(policy_id) == digest:
+            continue
+
+        rows = grid_rows(rating_tables, policy, digest)
+        if not rows and policy_id not in stored:
+            continue
+        with transaction.atomic():
+            PremiumRateGrid.objects.filter(policy_id=policy_id).delete()
+            PremiumRateGrid.objects.bulk_create(rows, batch_size=BULK_CREATE_BATCH_SIZE)
+        rebuilt += 1
+        logger.info(f"RATE GRID - Rebuilt {len(rows)} rows for policy {policy_id}")
+
+    if rebuilt:
+        # Workers reload their snapshot, and with it the new grid rows
+        invalidate_rating_tables()
+    return rebuilt
+
+
+def schedule_rate_grid_rebuild():
+    """Queue a background grid rebuild once the current transaction commits."""
+    def dispatch():
+        from .tasks import rebuild_rate_grid
+        try:
+            # Don't hold up the request if the broker is unreachable
+            rebuild_rate_grid.apply_async(retry=False)
+        except Exception as e:
+            # The grid is only an accelerator; stale policies are priced from the rating tables
+            logger.warning(f"RATE GRID - Could not queue rebuild: {str(e)}")
+
+    transaction.on_commit(dispatch)
@@ -0,0 +1,262 @@
+import bisect
+import itertools
+import logging
+import threading
+import time
+import uuid
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+VERSION_CACHE_KEY = 'rating_tables:version'
+
+# How often (seconds) a process re-reads the shared version stamp
+VERSION_CHECK_INTERVAL = getattr(settings, 'RATING_TABLES_VERSION_CHECK_INTERVAL', 5)
+
+
+class IntervalIndex:
+    """
+    Lookup structure for inclusive integer ranges such as age or year bands.
+
+    Entries are ``(low, high, priority, value)``. Overlapping ranges are
+    resolved up front so that the entry with the lowest priority wins, which
+    mirrors ``.filter(low__lte=x, high__gte=x).first()`` on an ordered queryset.
+    """
+
+    def __init__(self, entries):
+        entries = [e for e in entries if e[0] is not None and e[1] is not None and e[0] <= e[1]]
+        boundaries = sorted({e[0] for e in entries} | {e[1] + 1 for e in entries})
+
+        self.starts = []
+        self.values = []
+        for start in boundaries:
+            covering = [e for e in entries if e[0] <= start <= e[1]]
+            winner = min(covering, key=lambda e: e[2])[3] if covering else None
+            # Merge neighbouring segments that resolve to the same value
+            if self.values and self.values[-1] is winner:
+                continue
+            self.starts.append(start)
+            self.values.append(winner)
+
+    def lookup(self, key):
+        if key is None:
+            return None
+        position = bisect.bisect_right(self.starts, key) - 1
+        if position < 0:
+            return None
+        return self.values[position]
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not None)
+
+
+class RatingTableSet:
+    """
+    Interval indexes over the rate rows of one rating table version
+    (``None`` for the unversioned tables).
+    """
+
+    def __init__(self, rating_version_id):
+        from .models import MortalityRate, DurationFactor, BonusRate
+
+        self.rating_version_id = rating_version_id
+        self.mortality = IntervalIndex(
+            (row.age_group_start, row.age_group_end, (row.pk,), row)
+            for row in MortalityRate.objects.filter(rating_version_id=rating_version_id)
+        )
+        self.duration_factors = self._group(
+            DurationFactor.objects.filter(rating_version_id=rating_version_id), 'policy_type',
+            lambda row: (row.min_duration, row.max_duration, (row.min_duration, row.pk), row)
+        )
+        self.gsv_rates, self.ssv_configs = self.policy_rates(rating_version_id)
+        self.bonus_rates = self._group(
+            BonusRate.objects.filter(rating_version_id=rating_version_id), 'policy_type',
+            lambda row: (row.min_year, row.max_year, (row.min_year, row.pk), row)
+        )
+
+    @classmethod
+    def policy_rates(cls, rating_version_id):
+        """``(gsv_rates, ssv_configs)`` of a version, indexed by policy id."""
+        from .models import GSVRate, SSVConfig
+
+        return tuple(
+            cls._group(
+                model.objects.filter(rating_version_id=rating_version_id), 'policy_id',
+                lambda row: (row.min_year, row.max_year, (row.pk,), row)
+            )
+            for model in (GSVRate, SSVConfig)
+        )
+
+    @staticmethod
+    def _group(queryset, key_field, to_entry):
+        grouped = {}
+        for row in queryset:
+            grouped.setdefault(getattr(row, key_field), []).append(to_entry(row))
+        return {key: IntervalIndex(entries) for key, entries in grouped.items()}
+
+
+# Activated versions never change, so their tables are kept for the life of the process
+_version_sets = {}
+
+
+def get_rating_table_set(rating_version_id):
+    """Return the tables of a version, loading an activated version only once."""
+    if rating_version_id is None:
+        return RatingTableSet(None)
+    table_set = _version_sets.get(rating_version_id)
+    if table_set is None:
+        table_set = _version_sets[rating_version_id] = RatingTableSet(rating_version_id)
+    return table_set
+
+
+_snapshot_ids = itertools.count(1)
+
+
+class RatingTables:
+    """
+    Immutable in-memory snapshot of the premium reference tables in force on
+    a given date.
+
+    ``version`` is the shared stamp the snapshot was loaded under and
+    ``snapshot_id`` identifies this particular load within the process, so
+    results derived from a snapshot can be keyed on it. ``rating_version_id``
+    is the RatingTableVersion in force (``None`` for the unversioned tables)
+    and ``rate_grid`` holds the precomputed base rates of policies whose
+    PremiumRateGrid is current.
+
+    GSV rates and SSV configs of a policy the version in force has no rows
+    for, such as a product added after the version was published, are
+    read from the policy's unversioned rows.
+    """
+
+    def __init__(self, version, on_date=None, with_rate_grid=True):
+        from .models import InsurancePolicy, RatingTableVersion
+
+        self.version = version
+        self.snapshot_id = next(_snapshot_ids)
+
+        self.policies = {policy.pk: policy for policy in InsurancePolicy.objects.all()}
+
+        self.schedule = list(
+            RatingTableVersion.objects.filter(is_active=True)
+            .order_by('effective_date', 'activated_at', 'id')
+            .values_list('effective_date', 'id')
+        )
+        scheduled = {version_id for _, version_id in self.schedule}
+        for version_id in list(_version_sets):
+            if version_id not in scheduled:
+                _version_sets.pop(version_id, None)
+
+        self.rating_version_id = self.version_in_force(on_date or date.today())
+        table_set = get_rating_table_set(self.rating_version_id)
+        self.mortality = table_set.mortality
+        self.duration_factors = table_set.duration_factors
+        self.gsv_rates = table_set.gsv_rates
+        self.ssv_configs = table_set.ssv_configs
+        if self.rating_version_id is not None:
+            gsv_rates, ssv_configs = RatingTableSet.policy_rates(None)
+            self.gsv_rates = {**gsv_rates, **self.gsv_rates}
+            self.ssv_configs = {**ssv_configs, **self.ssv_configs}
+        self.bonus_rates = table_set.bonus_rates
+
+        self.rate_grid = {}
+        if with_rate_grid:
+            from .rate_grid import load_rate_grid
+            self.rate_grid = load_rate_grid(self)
+
+    def version_in_force(self, on_date):
+        """Id of the activated version effective on ``on_date``, or None for the unversioned tables."""
+        position = bisect.bisect_right(self.schedule, (on_date, float('inf'))) - 1
+        return self.schedule[position][1] if position >= 0 else None
+
+    @staticmethod
+    def _lookup(indexes, key, value):
+        index = indexes.get(key)
+        return index.lookup(value) if index else None
+
+    def policy(self, policy_id):
+        """InsurancePolicy row by id."""
+        return self.policies.get(policy_id)
+
+    def base_rate(self, policy_id, age, duration):
+        """Precomputed premium per 1000 sum assured, or None if not in the grid."""
+        return self.rate_grid.get((policy_id, age, duration))
+
+    def mortality_rate(self, age):
+        """MortalityRate row whose age group contains ``age``."""
+        return self.mortality.lookup(age)
+
+    def duration_factor(self, policy_type, duration):
+        """DurationFactor row for the policy type whose range contains ``duration``."""
+        return self._lookup(self.duration_factors, policy_type, duration)
+
+    def gsv_rate(self, policy_id, year):
+        """GSVRate row of the policy whose year range contains ``year``."""
+        return self._lookup(self.gsv_rates, policy_id, year)
+
+    def ssv_config(self, policy_id, year):
+        """SSVConfig row of the policy whose year range contains ``year``."""
+        return self._lookup(self.ssv_configs, policy_id, year)
+
+    def bonus_rate(self, policy_type, year):
+        """BonusRate row for the policy type whose year range contains ``year``."""
+        return self._lookup(self.bonus_rates, policy_type, year)
+
+
+_lock = threading.Lock()
+_tables = None
+_checked_at = 0.0
+
+
+def current_version():
+    """Return the shared version stamp, creating one if the cache has none."""
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def get_rating_tables():
+    """
+    Return the rating tables in force today for this process, reloading them
+    when another process has published a new version stamp or a newer
+    rating table version has taken effect.
+    """
+    global _tables, _checked_at
+
+    tables = _tables
+    now = time.monotonic()
+    if tables is not None and now - _checked_at < VERSION_CHECK_INTERVAL:
+        return tables
+
+    with _lock:
+        # Read the stamp before loading so a concurrent change forces another reload
+        version = current_version()
+        today = date.today()
+        if (_tables is None or _tables.version != version
+                or _tables.rating_version_id != _tables.version_in_force(today)):
+            _tables = RatingTables(version, today)
+            logger.info(f"Loaded rating tables version {version} (rating version {_tables.rating_version_id})")
+        _checked_at = now
+        return _tables
+
+
+def _publish_new_version():
+    global _tables
+    cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, timeout=None)
+    _tables = None
+
+
+def invalidate_rating_tables():
+    """
+    Drop this process's tables immediately and publish a new version stamp
+    for the other workers once the current transaction commits.
+    """
+    global _tables
+    _tables = None
+    transaction.on_commit(_publish_new_version)
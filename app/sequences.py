@@ -0,0 +1,166 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import PolicyHolder, PolicyNumberSequence, ReceiptSequence
+
+logger = logging.getLogger(__name__)
+
+# Serials reserved per trip to the database
+POLICY_NUMBER_BLOCK_SIZE = getattr(settings, 'POLICY_NUMBER_BLOCK_SIZE', 20)
+RECEIPT_NUMBER_BLOCK_SIZE = getattr(settings, 'RECEIPT_NUMBER_BLOCK_SIZE', 100)
+
+
+class SequenceAllocator:
+    """
+    Hands out increasing numbers from counter rows, like a database sequence.
+
+    ``model`` has a ``next_value`` field and one row per key (the keyword
+    arguments of ``allocate``). Numbers are reserved a block at a time with a
+    single UPDATE and then assigned from memory, so concurrent processes never
+    read-and-increment the same row.
+
+    A block reserved inside a transaction is only used by that transaction
+    until it commits, after which the rest of it is shared with the whole
+    process; if the transaction rolls back, the reservation is undone with
+    it. Numbers left in a block when the process exits are never issued.
+    """
+
+    def __init__(self, model, block_size, initial_value=None):
+        self.model = model
+        self.block_size = block_size
+        self.initial_value = initial_value or (lambda **key: 1)
+        self._blocks = {}
+        self._lock = threading.Lock()
+        self._held = threading.local()
+
+    def allocate(self, count=1, **key):
+        """Return ``count`` unused numbers for ``key`` in increasing order."""
+        cache_key = tuple(sorted(key.items()))
+        numbers = []
+        with self._lock:
+            self._take(self._blocks.get(cache_key, []), count, numbers)
+        if len(numbers) < count:
+            self._take(self._held_blocks(cache_key), count, numbers)
+
+        needed = count - len(numbers)
+        if needed:
+            start, end = self._reserve(key, max(needed, self.block_size))
+            numbers.extend(range(start, start + needed))
+            if start + needed < end:
+                self._hold(cache_key, [start + needed, end])
+        return numbers
+
+    @staticmethod
+    def _take(blocks, count, numbers):
+        """Move numbers from the front of ``blocks`` (``[next, end)`` lists) into ``numbers``."""
+        while blocks and len(numbers) < count:
+            block = blocks[0]
+            taken = min(block[1] - block[0], count - len(numbers))
+            numbers.extend(range(block[0], block[0] + taken))
+            block[0] += taken
+            if block[0] == block[1]:
+                blocks.pop(0)
+
+    def _share(self, cache_key, block):
+        with self._lock:
+            self._blocks.setdefault(cache_key, []).append(block)
+
+    def _hold(self, cache_key, block):
+        """Keep the rest of a block reserved by the current transaction."""
+        if not transaction.get_connection().in_atomic_block:
+            self._share(cache_key, block)
+            return
+
+        held = self._held_by_key().setdefault(cache_key, [])
+
+        def share():
+            held[:] = [entry for entry in held if entry[1] is not share]
+            if block[0] < block[1]:
+                self._share(cache_key, block)
+
+        held.append((block, share))
+        transaction.on_commit(share)
+
+    def _held_by_key(self):
+        if not hasattr(self._held, 'blocks'):
+            self._held.blocks = {}
+        return self._held.blocks
+
+    def _held_blocks(self, cache_key):
+        """Unused blocks reserved by this thread's transaction, while it is still open."""
+        held = self._held_by_key().get(cache_key)
+        if not held:
+            return []
+        # A rollback discards the commit callbacks registered since, and with them the reservation
+        pending = {id(entry[1]) for entry in transaction.get_connection().run_on_commit}
+        held[:] = [entry for entry in held if id(entry[1]) in pending]
+        return [block for block, _ in held if block[0] < block[1]]
+
+    def _reserve(self, key, size):
+        """Reserve ``size`` numbers with one UPDATE and return the ``[start, end)`` range."""
+        rows = self.model.objects.filter(**key)
+        with transaction.atomic():
+            if not rows.update(next_value=F('next_value') + size):
+                try:
+                    # First use of this key; whoever creates the row first seeds it
+                    with transaction.atomic():
+                        self.model.objects.create(next_value=self.initial_value(**key), **key)
+                except IntegrityError:
+                    pass
+                rows.update(next_value=F('next_value') + size)
+            # The UPDATE holds the row lock, so this reads our own increment
+            end = rows.values_list('next_value', flat=True).get()
+        logger.debug(f"Reserved {self.model.__name__} {dict(key)} numbers {end - size} to {end - 1}")
+        return end - size, end
+
+    def reset(self):
+        """Forget the blocks held by this process."""
+        with self._lock:
+            self._blocks.clear()
+        self._held_by_key().clear()
+
+
+def _first_policy_serial(company_id, branch_id):
+    """Serial after the highest policy number issued before the branch had a sequence."""
+    last_number = PolicyHolder.objects.filter(
+        company_id=company_id, branch_id=branch_id
+    ).exclude(policy_number__isnull=True).order_by('-policy_number').values_list('policy_number', flat=True).first()
+    return int(str(last_number)[-5:]) + 1 if last_number else 1
+
+
+_policy_numbers = SequenceAllocator(PolicyNumberSequence, POLICY_NUMBER_BLOCK_SIZE, _first_policy_serial)
+
+
+def allocate_policy_numbers(company, branch, count=1):
+    """Return ``count`` new policy numbers for a company branch."""
+    serials = _policy_numbers.allocate(count, company_id=company.pk, branch_id=branch.pk)
+    return [int(f"{company.company_code}{branch.branch_code}{str(serial).zfill(5)}") for serial in serials]
+
+
+_receipt_numbers = SequenceAllocator(ReceiptSequence, RECEIPT_NUMBER_BLOCK_SIZE)
+
+
+def receipt_number_prefix(branch, day):
+    """Common prefix of every receipt issued by a branch on a day, for range queries."""
+    branch_code = branch.branch_code if branch else 0
+    return f"RCP-{str(branch_code).zfill(3)}-{day:%Y%m%d}-"
+
+
+def allocate_receipt_numbers(branch, count=1, day=None):
+    """
+    Return ``count`` new receipt numbers of a branch (``None`` for holders
+    without one) for ``day``, today by default. Receipt numbers are unique
+    but not ordered: each process reserves serials in blocks, so a receipt
+    issued later can carry a lower serial than one issued earlier.
+    """
+    day = day or timezone.localdate()
+    serials = _receipt_numbers.allocate(
+        count, branch_code=branch.branch_code if branch else 0, issue_date=day
+    )
+    prefix = receipt_number_prefix(branch, day)
+    return [f"{prefix}{str(serial).zfill(6)}" for serial in serials]
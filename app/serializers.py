@@ -1,3 +1,4 @@
+from decimal import Decimal
 from rest_framework import serializers
 from .models import (
     InsurancePolicy,
@@ -13,6 +14,7 @@ from .models import (
     Underwriting,
     Company
 )
+from .rating_tables import get_rating_tables
 class CompanySerializer(serializers.ModelSerializer):
     class Meta:
         model = Company
@@ -47,15 +49,6 @@ class PolicyHolderSerializer(serializers.ModelSerializer):
             )
         return value
     
-
-    def create(self, validated_data):
-        branch = validated_data['branch']
-        company = validated_data['company']
-        last_policy = PolicyHolder.objects.filter(branch=branch, company=company).order_by('id').last()
-        last_number = int(last_policy.policy_number[-6:]) if last_policy else 0
-        validated_data['policy_number'] = f"{company.company_code}{branch.branch_code}{str(last_number + 1).zfill(6)}"
-        return super().create(validated_data)
-
     def to_representation(self, instance):
         ret = super().to_representation(instance)
         ret['agent'] = SalesAgentSerializer(instance.agent).data
@@ -175,3 +168,68 @@ class UnderwritingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Underwriting
         fields = '__all__'
+
+
+class PremiumQuoteSerializer(serializers.Serializer):
+    policy = serializers.IntegerField()
+    age = serializers.IntegerField(min_value=18, max_value=60, required=False)
+    date_of_birth = serializers.DateField(required=False)
+    sum_assured = serializers.DecimalField(max_digits=12, decimal_places=2)
+    duration_years = serializers.IntegerField(min_value=1)
+    payment_interval = serializers.ChoiceField(
+        choices=["Single", "quarterly", "semi_annual", "annual"], default="annual"
+    )
+    include_adb = serializers.BooleanField(required=False, allow_null=True, default=None)
+    include_ptd = serializers.BooleanField(required=False, allow_null=True, default=None)
+    loading_percentage = serializers.DecimalField(max_digits=5, decimal_places=2, min_value=Decimal('0'), default=Decimal('0'))
+
+    def validate_policy(self, value):
+        # Resolved from the cached rating tables so quoting needs no queries
+        policy = get_rating_tables().policy(value)
+        if policy is None:
+            raise serializers.ValidationError(f"Insurance policy {value} does not exist.")
+        return policy
+
+    def _resolve_age(self, data):
+        if data.get('age') is None:
+            if not data.get('date_of_birth'):
+                raise serializers.ValidationError("Either age or date_of_birth is required.")
+            data['age'] = PolicyHolder(date_of_birth=data['date_of_birth']).calculate_age()
+            if data['age'] < 18 or data['age'] > 60:
+                raise serializers.ValidationError(
+                    {'date_of_birth': f"Age must be between 18 and 60. Current age: {data['age']}."}
+                )
+        return data
+
+    def _check_sum_assured(self, policy, value):
+        if value < policy.min_sum_assured or value > policy.max_sum_assured:
+            raise serializers.ValidationError(
+                {'sum_assured': f"Sum assured must be between {policy.min_sum_assured} and {policy.max_sum_assured}."}
+            )
+
+    def validate(self, data):
+        data = self._resolve_age(data)
+        self._check_sum_assured(data['policy'], data['sum_assured'])
+        return data
+
+
+class PremiumQuoteMatrixSerializer(PremiumQuoteSerializer):
+    sum_assured = None
+    duration_years = None
+    payment_interval = None
+    sums_assured = serializers.ListField(
+        child=serializers.DecimalField(max_digits=12, decimal_places=2), min_length=1, max_length=50
+    )
+    durations = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), min_length=1, max_length=50
+    )
+    payment_intervals = serializers.ListField(
+        child=serializers.ChoiceField(choices=["Single", "quarterly", "semi_annual", "annual"]),
+        min_length=1, max_length=4, default=["annual"]
+    )
+
+    def validate(self, data):
+        data = self._resolve_age(data)
+        for sum_assured in data['sums_assured']:
+            self._check_sum_assured(data['policy'], sum_assured)
+        return data
@@ -1,4 +1,4 @@
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.db import transaction, DatabaseError, IntegrityError
@@ -15,7 +15,6 @@ from .models import (
     Underwriting, 
     PremiumPayment, 
     InsurancePolicy, 
-    AgentReport, 
     AgentApplication, 
     SalesAgent,
     Loan,
@@ -28,8 +27,22 @@ from .models import (
     UserProfile,
     Bonus,
     Commission,
-    PolicySurrender
+    PolicySurrender,
+    MortalityRate,
+    DurationFactor,
+    GSVRate,
+    SSVConfig,
+    BonusRate,
+    RatingTableVersion,
+    check_rating_version_editable,
 )
+from .rating_tables import invalidate_rating_tables
+from .rate_grid import schedule_rate_grid_rebuild
+from .payments import defer_side_effects, holder_payment_status, premium_collected_event
+from .outbox import outbox_handler, publish
+from .bulk import defer_payment_status, defer_policy_holder_save, in_bulk_mode
+from .agent_counters import record_sales
+from .policy_events import schedule_policy_events
 import random
 
 # Configure logger
@@ -56,66 +69,224 @@ def transaction_retry(max_attempts=3, delay=1):
         return wrapper
     return decorator
 
-# Signal dispatch order control with dispatch_uid
-@receiver(post_save, sender=PolicyHolder, dispatch_uid="policy_holder_post_save_handler")
-def policy_holder_post_save(sender, instance, created, **kwargs):
-    if getattr(instance, '_skip_signal', False):
+# PolicyHolder post-save pipeline
+#
+# One receiver runs the stages below in order. A stage runs when the holder
+# is created or one of its input fields changed, and stages share the
+# related rows they load instead of each querying them again.
+
+UNDERWRITING_INPUTS = {
+    'status', 'date_of_birth', 'occupation_id', 'smoker', 'alcoholic', 'exercise_frequency',
+    'work_environment_risk', 'health_history', 'family_medical_history', 'natural_hazard_exposure',
+    'sum_assured', 'policy_id',
+}
+PREMIUM_INPUTS = {
+    'status', 'policy_id', 'sum_assured', 'duration_years', 'date_of_birth', 'payment_interval',
+    'include_adb', 'include_ptd',
+}
+POLICY_EVENT_INPUTS = {'status', 'duration_years', 'payment_interval'}
+
+
+class PolicyHolderSaveContext:
+    """State shared by the pipeline stages of one PolicyHolder save."""
+
+    def __init__(self, policy_holder, created, changed):
+        self.policy_holder = policy_holder
+        self.created = created
+        self.changed = changed
+        self.premium_rated = False
+        self._premium_payment = None
+
+    @property
+    def premium_payment(self):
+        if self._premium_payment is None:
+            self._premium_payment = self.policy_holder.premium_payments.first()
+        return self._premium_payment
+
+    @premium_payment.setter
+    def premium_payment(self, premium_payment):
+        self._premium_payment = premium_payment
+
+    def underwriting(self):
+        try:
+            return self.policy_holder.underwriting
+        except Underwriting.DoesNotExist:
+            return None
+
+
+def queue_user_account(context):
+    """Queue a login for a new holder; see create_policy_holder_user."""
+    policy_holder = context.policy_holder
+    if context.created and policy_holder.phone_number and not policy_holder.user_id:
+        publish('policy_holder.created', {'policy_holder_id': policy_holder.pk})
+
+
+@outbox_handler('policy_holder.created')
+def create_policy_holder_user(payload):
+    """Give a new holder a login, using their phone number as the username."""
+    policy_holder = PolicyHolder.objects.get(pk=payload['policy_holder_id'])
+    if policy_holder.user_id or not policy_holder.phone_number:
         return
 
-    try:
-        instance._skip_signal = True  # Prevent recursion
+    user = User.objects.filter(username=policy_holder.phone_number).first()
+    if user is None:
+        # A random password; they can reset it later via OTP
+        user = User.objects.create_user(
+            username=policy_holder.phone_number,
+            email=policy_holder.email,
+            password=''.join([str(random.randint(0, 9)) for _ in range(8)]),
+            first_name=policy_holder.first_name,
+            last_name=policy_holder.last_name
+        )
+        logger.info(f"Created user account for policy holder {policy_holder.id}")
 
-        # Create/update underwriting
-        if instance.status in ['Pending', 'Active']:
-            underwriting, created = Underwriting.objects.get_or_create(policy_holder=instance)
-            underwriting.save()
+    # Nothing else depends on the link, so skip a full save and the pipeline
+    PolicyHolder.objects.filter(pk=policy_holder.pk).update(user=user)
 
-        # Create/update premium payment
-        if instance.status in ['Approved', 'Active']:
-            premium, created = PremiumPayment.objects.get_or_create(policy_holder=instance)
-            premium.save()
 
-        # Calculate maturity date
-        if created or not instance.maturity_date:
-            instance.maturity_date = instance.calculate_maturity_date()
-            instance.save(update_fields=['maturity_date'])
+def queue_agent_sale(context):
+    """Queue crediting the agent once the holder is issued a policy number; see agent_policy_sold."""
+    policy_holder = context.policy_holder
+    if 'policy_number' in context.changed and policy_holder.policy_number and policy_holder.agent_id:
+        publish('policy.sold', {'policy_holder_id': policy_holder.pk})
 
-    except Exception as e:
-        logger.error(f"Error in policy_holder_post_save for policy ID {instance.id}: {str(e)}")
+
+@outbox_handler('policy.sold')
+def agent_policy_sold(payload):
+    policy_holder = PolicyHolder.objects.select_related('agent').get(pk=payload['policy_holder_id'])
+    if policy_holder.agent:
+        update_agent_stats(policy_holder)
+
+
+def sync_underwriting(context):
+    """Create the underwriting of a holder under review and reassess it when risk inputs change."""
+    policy_holder = context.policy_holder
+    if policy_holder.status not in ('Pending', 'Approved', 'Active'):
+        return
+    if not context.created and not context.changed & UNDERWRITING_INPUTS:
+        return
+
+    underwriting = None if context.created else context.underwriting()
+    if underwriting is None:
+        Underwriting.objects.create(policy_holder=policy_holder)
+        return
+
+    # Saving reassesses the risk and re-rates an existing premium with the new loading
+    underwriting.save()
+    context.premium_rated = context.premium_payment is not None
+
+
+def sync_premium_payment(context):
+    """Create the premium payment of an approved holder and re-rate it when its inputs change."""
+    policy_holder = context.policy_holder
+    if policy_holder.status not in ('Approved', 'Active'):
+        return
+    if not context.created and not context.changed & PREMIUM_INPUTS:
+        return
+
+    if context.premium_payment is None:
+        # A new payment rates itself from the holder and any underwriting loading
+        context.premium_payment = PremiumPayment.objects.create(policy_holder=policy_holder)
+        logger.info(f"Created premium payment for {policy_holder.id}: "
+                    f"annual={context.premium_payment.annual_premium}, total={context.premium_payment.total_premium}")
+    elif not context.premium_rated:
+        context.premium_payment.save(recalculate=['premium'])
+
+
+def sync_policy_events(context):
+    """Plan the holder's events again when its status or term changes."""
+    if context.created or context.changed & POLICY_EVENT_INPUTS:
+        schedule_policy_events([context.policy_holder.pk])
+
+
+POLICY_HOLDER_PIPELINE = (
+    queue_user_account,
+    queue_agent_sale,
+    sync_underwriting,
+    sync_premium_payment,
+    sync_policy_events,
+)
+
+
+@receiver(post_save, sender=PolicyHolder, dispatch_uid="policy_holder_post_save_handler")
+def policy_holder_post_save(sender, instance, created, update_fields=None, **kwargs):
+    """Run the PolicyHolder pipeline once for this save."""
+    if getattr(instance, '_skip_signal', False):
+        return
+
+    changed = instance.changed_fields()
+    if update_fields is not None:
+        changed &= {field for field in PolicyHolder.TRACKED_FIELDS if field.removesuffix('_id') in update_fields}
+    if defer_policy_holder_save(instance, created, changed):
+        return
+    context = PolicyHolderSaveContext(instance, created, changed)
+
+    try:
+        instance._skip_signal = True  # Prevent recursion
+        for stage in POLICY_HOLDER_PIPELINE:
+            try:
+                stage(context)
+            except Exception as e:
+                logger.error(f"Error in PolicyHolder stage {stage.__name__} for policy ID {instance.id}: {str(e)}")
     finally:
         instance._skip_signal = False
+
+@receiver(pre_save, sender=RatingTableVersion)
+@receiver(pre_delete, sender=RatingTableVersion)
+def protect_active_rating_version(sender, instance, **kwargs):
+    """Activated versions are immutable; activate() itself saves a version that was still a draft."""
+    stored = RatingTableVersion.objects.filter(pk=instance.pk).first() if instance.pk is not None else None
+    if stored is not None:
+        stored.check_editable()
+
+@receiver(pre_save, sender=MortalityRate)
+@receiver(pre_delete, sender=MortalityRate)
+@receiver(pre_save, sender=DurationFactor)
+@receiver(pre_delete, sender=DurationFactor)
+@receiver(pre_save, sender=GSVRate)
+@receiver(pre_delete, sender=GSVRate)
+@receiver(pre_save, sender=SSVConfig)
+@receiver(pre_delete, sender=SSVConfig)
+@receiver(pre_save, sender=BonusRate)
+@receiver(pre_delete, sender=BonusRate)
+def protect_active_rating_rows(sender, instance, origin=None, **kwargs):
+    """Rows of an activated version cannot be saved or deleted, only replaced by publishing a new version."""
+    # A deleted product takes its GSV and SSV rows with it, whatever version they are in;
+    # ``origin`` is the policy, or queryset of policies, being deleted
+    if getattr(origin, 'model', type(origin)) is InsurancePolicy:
+        return
+    check_rating_version_editable(instance)
+
+@receiver(post_save, sender=InsurancePolicy)
+@receiver(post_delete, sender=InsurancePolicy)
+@receiver(post_save, sender=RatingTableVersion)
+@receiver(post_delete, sender=RatingTableVersion)
+@receiver(post_save, sender=MortalityRate)
+@receiver(post_delete, sender=MortalityRate)
+@receiver(post_save, sender=DurationFactor)
+@receiver(post_delete, sender=DurationFactor)
+@receiver(post_save, sender=GSVRate)
+@receiver(post_delete, sender=GSVRate)
+@receiver(post_save, sender=SSVConfig)
+@receiver(post_delete, sender=SSVConfig)
+@receiver(post_save, sender=BonusRate)
+@receiver(post_delete, sender=BonusRate)
+def refresh_rating_tables(sender, instance, **kwargs):
+    """Invalidate the cached rating tables whenever a reference row changes."""
+    if getattr(instance, 'rating_version_id', None) is not None:
+        # Draft rows are not in force until their version is activated, which
+        # invalidates below, and rows of activated versions cannot change
+        # (see protect_active_rating_rows)
+        return
+    if sender is RatingTableVersion and not instance.is_active:
+        return
+    invalidate_rating_tables()
+    if sender in (InsurancePolicy, RatingTableVersion, MortalityRate, DurationFactor):
+        schedule_rate_grid_rebuild()
+
 def update_agent_stats(policy_holder):
-    """Extract agent statistics update logic to a separate function for clarity"""
-    try:
-        with transaction.atomic():
-            agent = policy_holder.agent
-            
-            # Update agent's total policies
-            agent.total_policies_sold += 1
-            agent.last_policy_date = timezone.now().date()
-            agent.save()
-
-            # Create or update the monthly report
-            report_date = timezone.now().date()
-            report, created = AgentReport.objects.get_or_create(
-                agent=agent,
-                branch=agent.branch,
-                report_date=report_date.replace(day=1),  # First day of current month
-                defaults={
-                    'reporting_period': f"{report_date.year}-{report_date.month}",
-                    'policies_sold': 0,
-                    'total_premium': Decimal('0.00'),
-                    'commission_earned': Decimal('0.00'),
-                    'target_achievement': Decimal('0.00'),
-                    'renewal_rate': Decimal('0.00'),
-                    'customer_retention': Decimal('0.00'),
-                }
-            )
-            
-            report.policies_sold += 1
-            report.save()
-    except Exception as e:
-        logger.error(f"Error updating agent stats: {str(e)}")
+    """Count a newly issued policy towards its agent and their report for the month it started."""
+    record_sales(policy_holder.agent, policy_holder.start_date, policies_sold=1)
 
 def check_policy_anniversary(policy_holder):
     """Check if today is the policy's anniversary for bonus calculation"""
@@ -143,7 +314,7 @@ def check_policy_anniversary(policy_holder):
 def update_policy_holder_from_underwriting(sender, instance, **kwargs):
     """Update PolicyHolder's risk category based on Underwriting."""
     # Skip updates if manual_override is enabled or to prevent recursion
-    if instance.manual_override or getattr(instance, '_from_signal', False):
+    if instance.manual_override or getattr(instance, '_from_signal', False) or in_bulk_mode():
         return
 
     try:
@@ -200,18 +371,47 @@ def cleanup_policy_holder(sender, instance, **kwargs):
 @receiver(post_save, sender='app.PremiumPayment')
 def premium_payment_post_save(sender, instance, created, **kwargs):
     """Signal handler for post-save operations on PremiumPayment."""
+    if defer_payment_status(instance):
+        return
     try:
         logger.info(f"Premium payment post-save signal triggered for {instance}")
         
         # Update policy holder payment status based on premium payments
         update_policy_holder_payment_status(instance.policy_holder)
         
-        # Update agent reports and commission if applicable
-        update_agent_report_and_commission(instance)
-        
+        # A new or moved instalment changes what falls due
+        if created or instance.changed_fields() & {'payment_status', 'next_payment_date'}:
+            schedule_policy_events([instance.policy_holder_id])
+
     except Exception as e:
         logger.error(f"Error in premium_payment_post_save: {e}")
 
+@receiver(post_save, sender='app.PremiumTransaction')
+def premium_transaction_post_save(sender, instance, created, **kwargs):
+    """Apply a newly posted payment to the holder status and queue the agent report and commission."""
+    if not created:
+        return
+    if defer_side_effects(instance):
+        return
+    try:
+        premium_payment = instance.premium_payment
+        update_policy_holder_payment_status(premium_payment.policy_holder)
+        schedule_policy_events([premium_payment.policy_holder_id])
+        event = premium_collected_event(premium_payment, instance.premium_amount, instance.payment_date)
+        if event:
+            publish(*event)
+    except Exception as e:
+        logger.error(f"Error in premium_transaction_post_save: {e}")
+
+@outbox_handler('premium.collected')
+def agent_premium_collected(payload):
+    premium_payment = PremiumPayment.objects.select_related('policy_holder__agent').get(
+        pk=payload['premium_payment_id']
+    )
+    update_agent_report_and_commission(
+        premium_payment, Decimal(payload['premium_amount']), date.fromisoformat(payload['collected_on'])
+    )
+
 def update_policy_holder_payment_status(policy_holder):
     if getattr(policy_holder, '_skip_signal', False):
         return
@@ -223,12 +423,7 @@ def update_policy_holder_payment_status(policy_holder):
         if not premium_payment:
             return
 
-        if premium_payment.total_paid >= premium_payment.total_premium:
-            policy_holder.payment_status = 'Paid'
-        elif premium_payment.total_paid > 0:
-            policy_holder.payment_status = 'Partially Paid'
-        else:
-            policy_holder.payment_status = 'Unpaid'
+        policy_holder.payment_status = holder_payment_status(premium_payment)
 
         policy_holder.save(update_fields=['payment_status'])
 
@@ -236,96 +431,29 @@ def update_policy_holder_payment_status(policy_holder):
         logger.error(f"Error in update_policy_holder_payment_status: {e}")
     finally:
         policy_holder._skip_signal = False
-def update_agent_report_and_commission(premium_payment):
-    try:
-        policy_holder = premium_payment.policy_holder
+def update_agent_report_and_commission(premium_payment, amount, on_date=None):
+    """Add collected premium to the agent's monthly report and record their commission."""
+    policy_holder = premium_payment.policy_holder
 
-        # Skip if no agent is assigned
-        if not hasattr(policy_holder, 'agent') or not policy_holder.agent:
-            return
+    # Skip if no agent is assigned
+    if not hasattr(policy_holder, 'agent') or not policy_holder.agent:
+        return
+
+    today = on_date or date.today()
+    record_sales(policy_holder.agent, today, premium_collected=amount)
 
-        # Get or create agent report
-        today = date.today()
-        report, created = AgentReport.objects.get_or_create(
+    # Calculate and create commission
+    commission_rate = policy_holder.agent.commission_rate or Decimal('0.15')
+    commission_amount = amount * commission_rate
+    if commission_amount > 0:
+        Commission.objects.create(
             agent=policy_holder.agent,
-            branch=policy_holder.agent.branch,
-            report_date=today.replace(day=1),  # First day of the current month
-            defaults={
-                'reporting_period': f"{today.year}-{today.month}",
-                'policies_sold': 0,
-                'total_premium': Decimal('0.00'),
-                'commission_earned': Decimal('0.00'),
-                'target_achievement': Decimal('0.00'),
-                'renewal_rate': Decimal('0.00'),
-                'customer_retention': Decimal('0.00'),
-                'month': today.month,
-                'year': today.year,
-            }
+            policy_holder=policy_holder,
+            amount=commission_amount,
+            date=today,
+            status='Pending'
         )
 
-        # Update report fields
-        report.total_premium += premium_payment.paid_amount
-        report.save()
-
-        # Calculate and create commission
-        commission_rate = policy_holder.agent.commission_rate or Decimal('0.15')
-        commission_amount = premium_payment.paid_amount * commission_rate
-        if commission_amount > 0:
-            Commission.objects.create(
-                agent=policy_holder.agent,
-                policy_holder=policy_holder,
-                amount=commission_amount,
-                date=today,
-                status='Pending'
-            )
-
-    except Exception as e:
-        logger.error(f"Error in update_agent_report_and_commission: {e}")
-        
-@receiver(post_save, sender='app.PolicyHolder')
-def policy_holder_post_save(sender, instance, created, **kwargs):
-    """Signal handler for post-save operations on PolicyHolder"""
-    try:
-        # Don't proceed if this is a modification and payment_status hasn't changed
-        if not created and 'payment_status' not in kwargs.get('update_fields', []):
-            return
-
-        # Check if premium payment exists
-        premium_payment = instance.premium_payments.first()
-        
-        # Create new premium payment if doesn't exist and policy is approved
-        if not premium_payment and instance.status == 'Approved':
-            logger.info(f"Creating premium payment for {instance.id}")
-            premium_payment = PremiumPayment.objects.create(
-                policy_holder=instance
-            )
-            
-            # Force premium calculation
-            annual, interval = premium_payment.calculate_premium()
-            premium_payment.annual_premium = annual
-            premium_payment.interval_payment = interval
-            
-            # Set total premium based on duration and payment interval
-            if instance.payment_interval == "Single":
-                premium_payment.total_premium = interval
-            else:
-                premium_payment.total_premium = annual * Decimal(str(instance.duration_years))
-                
-            premium_payment.save()
-            
-            logger.info(f"Created premium payment: annual={annual}, interval={interval}, total={premium_payment.total_premium}")
-            
-            # Create initial underwriting if it doesn't exist
-            if not hasattr(instance, 'underwriting'):
-                from .models import Underwriting
-                Underwriting.objects.create(
-                    policy_holder=instance,
-                    status='Pending',
-                    assessment_date=date.today()
-                )
-    except Exception as e:
-        logger.error(f"Error in policy_holder_post_save: {e}")
-
 @receiver(post_save, sender=AgentApplication)
 def agent_application_approval(sender, instance, created, **kwargs):
     """Create SalesAgent when application is approved."""
@@ -453,43 +581,6 @@ def auto_finalize_payment(sender, instance, **kwargs):
     except Exception as e:
         logger.error(f"Error finalizing payment: {str(e)}")
 
-@receiver(post_save, sender=PolicyHolder)
-def create_policyholder_user(sender, instance, created, **kwargs):
-    """Create User account for PolicyHolder if it doesn't exist."""
-    if created and instance.phone_number and not instance.user:
-        try:
-            # Use phone number as username
-            username = instance.phone_number
-            
-            # Check if user already exists
-            if not User.objects.filter(username=username).exists():
-                # Create a random password (they can reset it later via OTP)
-                # or set a default password they must change
-                password = ''.join([str(random.randint(0, 9)) for _ in range(8)])
-                
-                # Create user
-                user = User.objects.create_user(
-                    username=username,
-                    email=instance.email,
-                    password=password,
-                    first_name=instance.first_name,
-                    last_name=instance.last_name
-                )
-                
-                # Link user to policy holder
-                instance.user = user
-                instance.save(update_fields=['user'])
-                
-                logger.info(f"Created user account for policy holder {instance.id}")
-            else:
-                # If user exists, link it
-                user = User.objects.get(username=username)
-                instance.user = user
-                instance.save(update_fields=['user'])
-                
-        except Exception as e:
-            logger.error(f"Error creating user for policy holder {instance.id}: {str(e)}")
-
 @receiver(post_save, sender=PolicySurrender)
 def handle_policy_surrender_status(sender, instance, created, **kwargs):
     """
@@ -593,6 +684,7 @@ def update_policy_access_on_surrender(sender, instance, **kwargs):
                 
             # Cancel any pending policy renewals
             policy_holder.renewals.filter(status='Pending').update(status='Expired')
+            schedule_policy_events([policy_holder.id])
             
             # Mark all loans as requiring attention
             for loan in policy_holder.loans.filter(loan_status='Active'):
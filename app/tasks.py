@@ -1,8 +1,18 @@
-from celery import shared_task
+from celery import chain, chord, shared_task
 from django.db import transaction
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from django.utils import timezone
-from app.models import UserProfile, PremiumPayment, Policy, Loan, PolicyHolder
+from app.models import UserProfile, PremiumPayment, PolicyHolder, BatchJobRun
+from app.rate_grid import rebuild_premium_rate_grid
+from app.outbox import drain
+from app.agent_counters import roll_up_counter_shards
+from app.loan_interest import accrue_loan_interest
+from app.leases import Lease, LeaseLost, LeaseUnavailable, acquire_lease, hold_lease
+from app.maintenance import (
+    MAINTENANCE_CHUNK_SIZE, MAINTENANCE_JOBS, MAINTENANCE_LEASE, NIGHTLY_MAINTENANCE, NIGHTLY_MAINTENANCE_LEASE_TTL,
+    add_counts, plan_chunks, run_maintenance_job,
+)
+from app.policy_events import run_due_events
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,83 +36,179 @@ def process_premium_payments():
 @shared_task
 def calculate_loan_interest():
     """
-    Calculate interest for all active loans.
+    Accrue interest for all active loans up to today.
     """
     try:
-        with transaction.atomic():
-            active_loans = Loan.objects.filter(status='ACTIVE')
-            
-            for loan in active_loans:
-                loan.apply_interest()
-                logger.info(f"Applied interest to loan {loan.id}")
+        accrued = accrue_loan_interest()
+        logger.info(f"Accrued interest on {accrued} loans")
     except Exception as e:
         logger.error(f"Error calculating loan interest: {str(e)}")
 
 @shared_task
-def check_policy_anniversaries():
+def check_policy_expirations():
     """
-    Check for policy anniversaries and apply bonuses if eligible.
+    Log policies maturing within the next 30 days.
     """
     try:
-        with transaction.atomic():
-            today = timezone.now().date()
-            
-            # Find policies with anniversary today
-            policies = Policy.objects.filter(
-                start_date__month=today.month,
-                start_date__day=today.day,
-                status='ACTIVE'
-            )
-            
-            for policy in policies:
-                years_active = today.year - policy.start_date.year
-                if years_active > 0:
-                    policy.apply_annual_bonus(years_active)
-                    logger.info(f"Applied anniversary bonus for policy {policy.id}, years: {years_active}")
+        today = timezone.now().date()
+        expiration_window = today + timedelta(days=30)  # 30 days from now
+
+        soon_expiring = PolicyHolder.objects.filter(
+            maturity_date__lte=expiration_window,
+            maturity_date__gte=today,
+            status='Active'
+        ).values_list('policy_number', 'maturity_date')
+
+        for policy_number, maturity_date in soon_expiring.iterator():
+            # Send notification logic would go here
+            logger.info(f"Policy {policy_number} matures on {maturity_date}")
     except Exception as e:
-        logger.error(f"Error checking policy anniversaries: {str(e)}")
+        logger.error(f"Error checking policy expirations: {str(e)}")
 
 @shared_task
-def check_policy_expirations():
+def send_payment_reminders():
     """
-    Check for policies that are expiring soon.
+    Send reminders for upcoming premium payments.
     """
     try:
-        with transaction.atomic():
-            today = timezone.now().date()
-            expiration_window = today + timedelta(days=30)  # 30 days from now
-            
-            # Find policies expiring within the window
-            soon_expiring = Policy.objects.filter(
-                end_date__lte=expiration_window,
-                end_date__gte=today,
-                status='ACTIVE'
-            )
-            
-            for policy in soon_expiring:
-                # Send notification logic would go here
-                logger.info(f"Policy {policy.id} expires on {policy.end_date}")
+        today = timezone.now().date()
+        reminder_date = today + timedelta(days=7)  # 7 days before due date
+
+        # Find payments due in 7 days
+        upcoming_payments = PremiumPayment.objects.filter(
+            next_payment_date=reminder_date,
+            payment_status__in=['Unpaid', 'Partially Paid']
+        ).values_list('policy_holder__policy_number', flat=True)
+
+        for policy_number in upcoming_payments.iterator():
+            # Send reminder notification logic would go here
+            logger.info(f"Reminder sent for payment due on {reminder_date} for policy {policy_number}")
     except Exception as e:
-        logger.error(f"Error checking policy expirations: {str(e)}")
+        logger.error(f"Error sending payment reminders: {str(e)}")
 
 @shared_task
-def send_payment_reminders():
+def run_nightly_maintenance(chunk_size=MAINTENANCE_CHUNK_SIZE):
     """
-    Send reminders for upcoming premium payments.
+    Fan the nightly maintenance jobs out over chunks of the book. Each
+    chunk runs the jobs in order as a chain of tasks, and a chord gathers
+    the chunks' counts into a BatchJobRun once all of them are done.
+
+    The run holds the maintenance lease until the chord finishes, so it
+    starts once however many beat schedulers fire it and never overlaps
+    the policy event runner or a maintenance command. It is not started
+    again once it has completed for the day.
     """
+    as_of_date = timezone.now().date()
+    if BatchJobRun.objects.filter(job_name=NIGHTLY_MAINTENANCE, as_of_date=as_of_date, status='Completed').exists():
+        logger.info(f"MAINTENANCE - Already completed for {as_of_date}")
+        return None
     try:
-        with transaction.atomic():
-            today = timezone.now().date()
-            reminder_date = today + timedelta(days=7)  # 7 days before due date
-            
-            # Find payments due in 7 days
-            upcoming_payments = PremiumPayment.objects.filter(
-                due_date=reminder_date,
-                status='PENDING'
-            )
-            
-            for payment in upcoming_payments:
-                # Send reminder notification logic would go here
-                logger.info(f"Reminder sent for payment due on {payment.due_date} for policy {payment.policy.id}")
+        lease = acquire_lease(MAINTENANCE_LEASE, ttl=NIGHTLY_MAINTENANCE_LEASE_TTL)
+    except LeaseUnavailable as e:
+        logger.info(f"MAINTENANCE - Not starting: {str(e)}")
+        return None
+
+    chunks = plan_chunks(chunk_size)
+    run = BatchJobRun.objects.create(job_name=NIGHTLY_MAINTENANCE, as_of_date=as_of_date)
+    if not chunks:
+        run.finish()
+        lease.release()
+        return run.pk
+
+    as_of = as_of_date.isoformat()
+    first_job, *later_jobs = MAINTENANCE_JOBS
+    header = [
+        chain(
+            run_maintenance_chunk.s({}, first_job, first_id, last_id, as_of, lease.token),
+            *(run_maintenance_chunk.s(job_name, first_id, last_id, as_of, lease.token) for job_name in later_jobs),
+        )
+        for first_id, last_id in chunks
+    ]
+    chord(header)(
+        finish_nightly_maintenance.s(run.pk, lease.token)
+        .on_error(fail_nightly_maintenance.s(run_id=run.pk, lease_token=lease.token))
+    )
+    logger.info(f"MAINTENANCE - Dispatched {len(chunks)} chunks for {as_of_date}")
+    return run.pk
+
+@shared_task(autoretry_for=(Exception,), dont_autoretry_for=(LeaseLost,), max_retries=3, retry_backoff=True)
+def run_maintenance_chunk(summary, job_name, first_id, last_id, as_of_date, lease_token):
+    """
+    Run one maintenance job over one chunk and add its counts to the
+    chunk's summary. The job commits on its own, so a retry repeats only
+    this job on this chunk; none is made once the run's lease is lost.
+    """
+    lease = Lease(MAINTENANCE_LEASE, lease_token, NIGHTLY_MAINTENANCE_LEASE_TTL)
+    counts = run_maintenance_job(job_name, first_id, last_id, date.fromisoformat(as_of_date), lease=lease)
+    return {**summary, job_name: counts}
+
+@shared_task
+def finish_nightly_maintenance(chunk_summaries, run_id, lease_token):
+    """
+    Record the counts of every chunk as the run summary.
+    """
+    run = BatchJobRun.objects.get(pk=run_id)
+    summary = {}
+    for chunk_summary in chunk_summaries:
+        add_counts(summary, chunk_summary)
+    run.counts = summary
+    run.save(update_fields=['counts'])
+    run.finish()
+    Lease(MAINTENANCE_LEASE, lease_token).release()
+    logger.info(f"MAINTENANCE - Finished run {run_id} as of {run.as_of_date}: {summary}")
+    return summary
+
+@shared_task
+def fail_nightly_maintenance(request, exc, traceback, run_id=None, lease_token=None):
+    """
+    Mark the run failed once a chunk has used up its retries.
+    """
+    logger.error(f"MAINTENANCE - Chunk {request.id} failed: {str(exc)}")
+    BatchJobRun.objects.get(pk=run_id).finish(error=str(exc))
+    Lease(MAINTENANCE_LEASE, lease_token).release()
+
+@shared_task
+def run_policy_events():
+    """
+    Process the policy events due today: instalments, fines, lapses,
+    anniversary bonuses, maturities and renewal reminders. Holds the
+    maintenance lease, so it never overlaps the other maintenance runs.
+    """
+    try:
+        with hold_lease(MAINTENANCE_LEASE) as lease:
+            run_due_events(lease=lease)
+    except LeaseUnavailable as e:
+        logger.info(f"POLICY EVENTS - Not running: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error running policy events: {str(e)}")
+
+@shared_task
+def rebuild_rate_grid():
+    """
+    Rebuild the PremiumRateGrid rows of policies whose rating inputs changed.
+    """
+    try:
+        rebuilt = rebuild_premium_rate_grid()
+        logger.info(f"Rebuilt premium rate grid for {rebuilt} policies")
+    except Exception as e:
+        logger.error(f"Error rebuilding premium rate grid: {str(e)}")
+
+@shared_task
+def drain_outbox():
+    """
+    Carry out pending outbox events: agent reports, commissions and user accounts.
+    """
+    try:
+        drain()
+    except Exception as e:
+        logger.error(f"Error draining outbox: {str(e)}")
+
+@shared_task
+def roll_up_agent_counters():
+    """
+    Fold the sales counted in agent counter shards into agent totals and monthly reports.
+    """
+    try:
+        roll_up_counter_shards()
     except Exception as e:
-        logger.error(f"Error sending payment reminders: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error rolling up agent counters: {str(e)}")
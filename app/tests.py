@@ -1,3 +1,1223 @@
+import argparse
+import io
+import itertools
+from concurrent.futures import Future
+from contextlib import nullcontext
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from celery import current_app
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import (
+    AgentReport, BatchJobRun, Bonus, BonusRate, Branch, Commission, Company, DurationFactor, GSVRate,
+    InsurancePolicy, JobLease, Loan, LoanInterestAccrual, LoanRepayment, MortalityRate, OutboxEvent, PolicyEvent,
+    PolicyHolder, PolicyNumberSequence, PolicyRenewal, PolicySurrender, PremiumPayment, PremiumTransaction,
+    RatingTableVersion, SalesAgent, SSVConfig,
+)
+from .agent_counters import add_unrolled_sales, reconcile_agent_counters, roll_up_counter_shards, with_sales_totals
+from .bulk import bulk_mode
+from .bonuses import BONUS_CATCH_UP_DAYS, accrue_anniversary_bonuses, anniversary_in
+from .fines import FineBatch, add_months, fine_for_days_late
+from .leases import LeaseLost, LeaseUnavailable, acquire_lease, hold_lease
+from .loan_interest import accrue_loan_interest, interest_paisa
+from .maintenance import MAINTENANCE_LEASE, check_renewals
+from .management.base import in_shard, parse_shard
+from .management.commands.update_premium_fines import Command as UpdatePremiumFines
+from .outbox import drain, publish
+from .payment_import import import_payments, read_payment_rows
+from .policy_events import plan_policy_events, run_due_events
+from .payments import collections, post_payment
+from .premium_engine import PremiumBatch, base_rate_from_rates, cents_to_decimal, premium_from_rates
+from .quotes import _quote
+from .rate_grid import rebuild_premium_rate_grid
+from .rating_tables import RatingTables, current_version, get_rating_tables
+from . import sequences
+
+DOCUMENTS = dict(
+    document_front='a.jpg', document_back='a.jpg', pp_photo='a.jpg',
+    nominee_document_front='a.jpg', nominee_document_back='a.jpg', nominee_pp_photo='a.jpg',
+)
+
+
+class FixtureBook:
+    """A small book: one company, branch and endowment policy with flat rate tables."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='C', company_code=1, address='x', email='a@b.com', phone_number='1')
+        cls.branch = Branch.objects.create(name='B', branch_code=1, company=cls.company)
+        cls.policy = InsurancePolicy.objects.create(
+            name='Endowment', policy_type='Endownment', base_multiplier=Decimal('1.25'),
+            min_sum_assured=Decimal('1000'), max_sum_assured=Decimal('10000000'),
+        )
+        MortalityRate.objects.create(age_group_start=18, age_group_end=70, rate=Decimal('4.00'))
+        DurationFactor.objects.create(min_duration=1, max_duration=40, policy_type='Endownment', factor=Decimal('1.10'))
+
+    @classmethod
+    def issue(cls, number, **fields):
+        """Onboard a holder through the usual saves and make it Active."""
+        fields = {
+            'policy': cls.policy, 'date_of_birth': date(1990, 1, 1), 'sum_assured': Decimal('500000'), 'duration_years': 10,
+            'payment_interval': 'annual', **fields,
+        }
+        holder = PolicyHolder.objects.create(
+            company=cls.company, branch=cls.branch, first_name='F', last_name=f'L{number}',
+            phone_number=f'98000{number:05d}', nominee_relation='x', policy_number=None, district='d',
+            municipality='m', ward='1', status='Pending', **DOCUMENTS, **fields,
+        )
+        holder.status = 'Active'
+        holder.save()
+        holder.refresh_from_db()
+        return holder
+
+
+class PolicyHolderPipelineQueryTests(FixtureBook, TestCase):
+    """
+    The PolicyHolder post-save pipeline used to be three receivers that each
+    reloaded and resaved the holder's underwriting and premium payment: 211
+    queries for the steps below, 42 of them for an address change.
+    """
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def test_onboarding_query_count(self):
+        holder = PolicyHolder(
+            company=self.company, branch=self.branch, policy=self.policy, first_name='F', last_name='L',
+            date_of_birth=date(1990, 1, 1), sum_assured=Decimal('500000'), duration_years=10,
+            phone_number='9800000001', nominee_relation='x', policy_number=None, district='d',
+            municipality='m', ward='1', status='Pending', **DOCUMENTS,
+        )
+
+        def save(**changes):
+            for field, value in changes.items():
+                setattr(holder, field, value)
+            return lambda: holder.save()
+
+        steps = {
+            'create': self.count_queries(save()),
+            'approve': self.count_queries(save(status='Approved')),
+            'activate': self.count_queries(save(status='Active')),
+            'edit address': self.count_queries(save(ward='7')),
+            'change sum assured': self.count_queries(save(sum_assured=Decimal('600000'))),
+        }
+
+        # The login account is created by the outbox drain, off the request path
+        self.assertEqual(drain(), 1)
+        holder.refresh_from_db()
+        self.assertIsNotNone(holder.user_id)
+        self.assertTrue(hasattr(holder, 'underwriting'))
+        self.assertEqual(holder.premium_payments.count(), 1)
+
+        # Fields no stage depends on only cost the holder's own save
+        self.assertLessEqual(steps['edit address'], 8, steps)
+        self.assertLessEqual(sum(steps.values()), 90, steps)
+
+
+class BulkModeTests(FixtureBook, TestCase):
+    """``bulk_mode`` batches the pipeline side effects but must leave the same book behind."""
+
+    UNDERWRITING_FIELDS = [
+        'risk_assessment_score', 'risk_category', 'premium_loading_percentage', 'medical_examination_required',
+        'needs_review',
+    ]
+    PAYMENT_FIELDS = [
+        'annual_premium', 'interval_payment', 'total_premium', 'total_paid', 'remaining_premium',
+        'payment_status', 'fine_due', 'next_payment_date', 'gsv_value', 'ssv_value',
+    ]
+
+    def onboard(self, prefix, block=nullcontext):
+        """Create, approve, activate and edit five holders, one ``block`` per step, and return them."""
+        holders = [
+            PolicyHolder(
+                company=self.company, branch=self.branch, policy=self.policy, first_name='F',
+                last_name=f'{prefix}{number}', date_of_birth=date(1970 + 5 * number, 1, 1),
+                sum_assured=Decimal('500000') + 100000 * number, duration_years=10 + number,
+                payment_interval='annual', phone_number=f'98{prefix}{number:05d}', nominee_relation='x',
+                policy_number=None, district='d', municipality='m', ward='1', status='Pending', **DOCUMENTS,
+            )
+            for number in range(5)
+        ]
+        for changes in ({}, {'status': 'Approved'}, {'status': 'Active'}, {'ward': '7', 'duration_years': 15}):
+            with block():
+                for holder in holders:
+                    for field, value in changes.items():
+                        setattr(holder, field, value)
+                    holder.save()
+        return holders
+
+    def book_state(self, holders):
+        drain()
+        state = []
+        for holder in holders:
+            holder.refresh_from_db()
+            published = OutboxEvent.objects.filter(payload__policy_holder_id=holder.pk)
+            state.append({
+                'holder': (holder.status, holder.risk_category, holder.payment_status, holder.user_id is not None),
+                'underwriting': [getattr(holder.underwriting, field) for field in self.UNDERWRITING_FIELDS],
+                'payments': list(holder.premium_payments.values_list(*self.PAYMENT_FIELDS)),
+                'events': sorted(holder.events.values_list('event_type', 'due_date', 'status')),
+                'outbox': sorted(published.values_list('event_type', flat=True)),
+            })
+        return state
+
+    def test_bulk_mode_leaves_the_same_book(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            one_by_one = self.onboard('10')
+        with self.captureOnCommitCallbacks(execute=True):
+            batched = self.onboard('20', bulk_mode)
+
+        expected = self.book_state(one_by_one)
+        self.assertTrue(all(state['payments'] and state['events'] for state in expected))
+        self.assertEqual(self.book_state(batched), expected)
+
+
+class PremiumQuoteViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.policy = InsurancePolicy.objects.create(
+            name='Endowment', policy_type='Endownment', base_multiplier=Decimal('1.25'),
+            min_sum_assured=Decimal('1000'), max_sum_assured=Decimal('10000000'),
+        )
+        MortalityRate.objects.create(age_group_start=18, age_group_end=70, rate=Decimal('4.00'))
+        DurationFactor.objects.create(min_duration=1, max_duration=40, policy_type='Endownment', factor=Decimal('1.10'))
+        cls.user = User.objects.create_user(username='agent', password='x')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_quote_as_normal_user(self):
+        response = self.client.get(reverse('premiumQuote'), {
+            'policy': self.policy.pk, 'age': 30, 'sum_assured': '500000', 'duration_years': 10,
+        })
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['policy'], self.policy.pk)
+        self.assertGreater(Decimal(str(response.data['annual_premium'])), 0)
+
+    def test_quote_matrix_as_normal_user(self):
+        response = self.client.post(reverse('premiumQuoteMatrix'), {
+            'policy': self.policy.pk, 'age': 30, 'sums_assured': ['500000', '1000000'],
+            'durations': [10, 20], 'payment_intervals': ['annual', 'quarterly'],
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(len(response.data['quotes']), 8)
+
+
+class RatingTableVersionTests(TestCase):
+    def setUp(self):
+        MortalityRate.objects.create(age_group_start=18, age_group_end=70, rate=Decimal('4.00'))
+        self.version = RatingTableVersion.publish(
+            'v1', {MortalityRate: [MortalityRate(age_group_start=18, age_group_end=70, rate=Decimal('5.00'))]}
+        )
+        self.row = MortalityRate.objects.get(rating_version=self.version)
+
+    def test_published_version_is_in_force(self):
+        tables = get_rating_tables()
+        self.assertEqual(tables.rating_version_id, self.version.pk)
+        self.assertEqual(tables.mortality_rate(30).rate, Decimal('5.00'))
+
+    def test_rows_of_active_version_cannot_change(self):
+        self.row.rate = Decimal('6.00')
+        with self.assertRaises(ValidationError):
+            self.row.save()
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.row.delete()
+        with self.assertRaises(ValidationError):
+            MortalityRate.objects.filter(pk=self.row.pk).update(rate=Decimal('6.00'))
+        with self.assertRaises(ValidationError):
+            MortalityRate.objects.filter(rating_version=None).update(rating_version=self.version)
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.version.delete()
+        self.row.refresh_from_db()
+        self.assertEqual(self.row.rate, Decimal('5.00'))
+
+    def test_row_cannot_leave_active_version(self):
+        self.row.rating_version = None
+        with self.assertRaises(ValidationError):
+            self.row.save()
+
+    def test_draft_edits_take_effect_on_activation(self):
+        draft = RatingTableVersion.create_draft('v2', based_on=self.version.pk)
+        row = MortalityRate.objects.get(rating_version=draft)
+        row.rate = Decimal('7.00')
+        row.save()
+        self.assertEqual(get_rating_tables().mortality_rate(30).rate, Decimal('5.00'))
+
+        draft.activate()
+        tables = get_rating_tables()
+        self.assertEqual(tables.rating_version_id, draft.pk)
+        self.assertEqual(tables.mortality_rate(30).rate, Decimal('7.00'))
+
+    def product(self, name):
+        return InsurancePolicy.objects.create(name=name, policy_type='Endownment')
+
+    def test_product_added_after_publishing_is_rated_from_its_own_rows(self):
+        published = self.product('Published')
+        version = RatingTableVersion.publish('v2', {
+            GSVRate: [GSVRate(policy=published, min_year=1, max_year=10, rate=Decimal('30.00'))],
+        })
+        # Unversioned rows of a product the version has rows for are not in force
+        GSVRate.objects.create(policy=published, min_year=1, max_year=10, rate=Decimal('99.00'))
+
+        added = self.product('Added')
+        GSVRate.objects.create(policy=added, min_year=1, max_year=10, rate=Decimal('40.00'))
+        SSVConfig.objects.create(policy=added, min_year=1, max_year=10, ssv_factor=Decimal('50.00'))
+
+        tables = get_rating_tables()
+        self.assertEqual(tables.rating_version_id, version.pk)
+        self.assertEqual(tables.gsv_rate(published.pk, 3).rate, Decimal('30.00'))
+        self.assertEqual(tables.gsv_rate(added.pk, 3).rate, Decimal('40.00'))
+        self.assertEqual(tables.ssv_config(added.pk, 3).ssv_factor, Decimal('50.00'))
+
+    def test_deleting_a_product_removes_its_rows_from_active_versions(self):
+        retired = self.product('Retired')
+        version = RatingTableVersion.publish('v2', {
+            GSVRate: [GSVRate(policy=retired, min_year=1, max_year=10, rate=Decimal('30.00'))],
+            SSVConfig: [SSVConfig(policy=retired, min_year=1, max_year=10, ssv_factor=Decimal('50.00'))],
+        })
+
+        retired.delete()
+        self.assertFalse(GSVRate.objects.filter(rating_version=version).exists())
+        self.assertFalse(SSVConfig.objects.filter(rating_version=version).exists())
+        # The rest of the version is untouched and still cannot be changed
+        self.assertEqual(MortalityRate.objects.get(rating_version=version).rate, Decimal('5.00'))
+        self.assertIsNone(get_rating_tables().gsv_rate(retired.pk, 3))
+        with self.assertRaises(ValidationError), transaction.atomic():
+            MortalityRate.objects.get(rating_version=version).delete()
+
+
+
+class PremiumLedgerTests(FixtureBook, TestCase):
+    def setUp(self):
+        self.payment = self.issue(1).premium_payments.get()
+
+    def test_balances_are_the_ledger_totals(self):
+        self.payment.add_payment(Decimal('2750.00'))
+        post_payment(self.payment, Decimal('500.00'), fine_amount=Decimal('0.00'), payment_date=date(2026, 1, 5))
+
+        self.payment.refresh_from_db()
+        ledger = self.payment.transactions.all()
+        self.assertEqual(ledger.count(), 2)
+        self.assertEqual(self.payment.total_paid, sum(t.premium_amount for t in ledger))
+        self.assertEqual(self.payment.remaining_premium, self.payment.total_premium - self.payment.total_paid)
+        self.assertEqual(self.payment.payment_status, 'Partially Paid')
+        self.assertEqual(collections(date(2026, 1, 5))['premium'], Decimal('500.00'))
+
+    def test_concurrent_postings_do_not_overwrite_each_other(self):
+        # Saving a stale copy used to write back the balance it was loaded with
+        first = PremiumPayment.objects.get(pk=self.payment.pk)
+        second = PremiumPayment.objects.get(pk=self.payment.pk)
+        post_payment(first, Decimal('100.00'))
+        post_payment(second, Decimal('200.00'))
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.total_paid, Decimal('300.00'))
+        self.assertEqual(second.total_paid, Decimal('300.00'))
+
+    def test_receipt_is_posted_once(self):
+        post_payment(self.payment, Decimal('100.00'), receipt_number='R-1')
+        with self.assertRaises(ValidationError):
+            post_payment(self.payment, Decimal('100.00'), receipt_number='R-1')
+
+        self.assertEqual(self.payment.total_paid, Decimal('100.00'))
+        self.assertEqual(PremiumTransaction.objects.filter(receipt_number='R-1').count(), 1)
+
+    def test_ledger_is_append_only(self):
+        posted = post_payment(self.payment, Decimal('100.00'))
+        posted.amount = Decimal('1.00')
+        with self.assertRaises(ValidationError):
+            posted.save()
+        with self.assertRaises(ValidationError):
+            posted.delete()
+
+
+class PaymentImportTests(FixtureBook, TestCase):
+    def setUp(self):
+        self.holders = [self.issue(number) for number in (1, 2, 3)]
+
+    def import_file(self, chunk_size):
+        lines = ['policy_number,amount,receipt_number,payment_date']
+        lines.append(f'{self.holders[0].policy_number},2750.00,BANK-1,2026-10-18')
+        lines.extend(f'{holder.policy_number},2750,,2026-10-18' for holder in self.holders[1:])
+        lines.append('x,1,,')
+        return import_payments(read_payment_rows(io.StringIO('\n'.join(lines))), io.StringIO(), chunk_size)
+
+    def test_reimport_posts_nothing_twice(self):
+        self.assertEqual(self.import_file(chunk_size=2), {'posted': 3, 'error': 1})
+        self.assertEqual(PremiumTransaction.objects.count(), 3)
+        self.assertEqual(PremiumTransaction.objects.filter(import_key__isnull=False).count(), 2)
+
+        # Rows without a receipt are recognised by their policy, amount and date
+        self.assertEqual(self.import_file(chunk_size=3), {'duplicate': 3, 'error': 1})
+        self.assertEqual(PremiumTransaction.objects.count(), 3)
+        for holder in self.holders:
+            self.assertEqual(holder.premium_payments.get().total_paid, Decimal('2750.00'))
+
+    def test_row_without_receipt_or_date_is_rejected(self):
+        lines = ['policy_number,amount,receipt_number,payment_date']
+        lines.append(f'{self.holders[0].policy_number},2750,,')
+        lines.append(f'{self.holders[1].policy_number},2750,BANK-2,')
+        results = io.StringIO()
+        counts = import_payments(read_payment_rows(io.StringIO('\n'.join(lines))), results)
+
+        self.assertEqual(counts, {'error': 1, 'posted': 1})
+        self.assertIn("payment date is required", results.getvalue())
+        self.assertFalse(self.holders[0].premium_payments.get().transactions.exists())
+
+
+class MarkPaymentAsPaidViewTests(FixtureBook, TestCase):
+    def setUp(self):
+        self.payment = self.issue(1).premium_payments.get()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='cashier', password='x'))
+
+    def pay(self, amount):
+        return self.client.post(reverse('markPaymentAsPaid', args=[self.payment.pk]), {'amount_paid': amount})
+
+    def test_bad_amount_is_rejected(self):
+        for amount in ('abc', 'NaN', '0'):
+            self.assertEqual(self.pay(amount).status_code, 400, amount)
+        self.assertFalse(self.payment.transactions.exists())
+
+    def test_payment_goes_through_add_payment_checks(self):
+        # Less than the instalment and more than the whole premium are both refused
+        self.assertEqual(self.pay('100').status_code, 400)
+        self.assertEqual(self.pay('99999999').status_code, 400)
+
+        due = self.payment.next_payment_date
+        response = self.pay('2750.00')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.total_paid, Decimal('2750.00'))
+        self.assertGreater(self.payment.next_payment_date, due)
+
+
+class JobLeaseTests(TestCase):
+    def test_released_lease_cannot_be_renewed(self):
+        lease = acquire_lease('job')
+        lease.renew()
+        lease.release()
+        with self.assertRaises(LeaseLost):
+            lease.renew()
+        self.assertGreater(acquire_lease('job').token, lease.token)
+
+    def test_expired_lease_cannot_be_renewed(self):
+        lease = acquire_lease('job')
+        JobLease.objects.filter(name='job').update(expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertRaises(LeaseLost):
+            lease.renew()
+
+    def test_maintenance_entry_points_share_one_lease(self):
+        from .tasks import run_nightly_maintenance, run_policy_events
+
+        with hold_lease(MAINTENANCE_LEASE):
+            for workers in ('1', '2'):
+                with self.assertRaises(CommandError):
+                    call_command('update_premium_fines', '--workers', workers, stdout=io.StringIO())
+            with self.assertRaises(LeaseUnavailable):
+                acquire_lease(MAINTENANCE_LEASE)
+            self.assertIsNone(run_nightly_maintenance())
+            run_policy_events()
+        self.assertFalse(BatchJobRun.objects.exists())
+
+
+class OverdueInstalmentTests(FixtureBook, TestCase):
+    def setUp(self):
+        self.today = date.today()
+        self.holder = self.issue(1)
+        self.payment = self.holder.premium_payments.get()
+        PremiumPayment.objects.filter(pk=self.payment.pk).update(next_payment_date=self.today - timedelta(days=40))
+        self.fine = fine_for_days_late(self.payment.interval_payment, 40)
+
+    def test_grace_end_is_processed_once(self):
+        plan_policy_events([self.holder.pk])
+        self.assertTrue(self.holder.events.filter(event_type='Grace End', due_date=self.today).exists())
+
+        self.assertIn('Grace End', run_due_events(self.today))
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.fine_due, self.fine)
+
+        # The fine was charged, so the holder gets no Grace End the days after
+        self.assertFalse(self.holder.events.filter(event_type='Grace End', status='Pending').exists())
+        self.assertNotIn('Grace End', run_due_events(self.today + timedelta(days=1)))
+
+    def test_payment_charges_the_fine_up_to_date(self):
+        PremiumPayment.objects.filter(pk=self.payment.pk).update(fine_due=Decimal('1.00'))
+        self.payment.refresh_from_db()
+
+        self.payment.add_payment(self.payment.interval_payment + self.fine)
+        posted = self.payment.transactions.get()
+        self.assertEqual(posted.fine_amount, self.fine)
+        self.assertEqual(self.payment.fine_due, Decimal('0.00'))
+
+
+class LoanRepaymentInterestTests(FixtureBook, TestCase):
+    def test_days_before_repayment_accrue_on_the_old_balance(self):
+        holder = self.issue(1)
+        loan = Loan.objects.bulk_create([Loan(
+            policy_holder=holder, loan_amount=Decimal('10000.00'), remaining_balance=Decimal('10000.00'),
+            interest_rate=Decimal('12.00'),
+        )])[0]
+        Loan.objects.filter(pk=loan.pk).update(last_interest_date=date.today() - timedelta(days=30))
+
+        LoanRepayment(loan=Loan.objects.get(pk=loan.pk), amount=Decimal('6000.00'), repayment_type='Principal').save()
+
+        accrual = LoanInterestAccrual.objects.get(loan=loan)
+        self.assertEqual((accrual.days, accrual.principal), (30, Decimal('10000.00')))
+        self.assertEqual(accrual.amount, Decimal('98.63'))
+        loan.refresh_from_db()
+        self.assertEqual((loan.remaining_balance, loan.accrued_interest), (Decimal('4000.00'), Decimal('98.63')))
+        self.assertEqual(loan.last_interest_date, date.today())
+
+
+class PremiumEngineTests(FixtureBook, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        MortalityRate.objects.create(age_group_start=71, age_group_end=99, rate=Decimal('7.35'))
+        DurationFactor.objects.create(min_duration=41, max_duration=60, policy_type='Endownment', factor=Decimal('0.95'))
+        DurationFactor.objects.create(min_duration=1, max_duration=60, policy_type='Term', factor=Decimal('1.00'))
+
+    def test_batch_matches_the_per_row_formula(self):
+        cases = list(itertools.product(
+            ('Endownment', 'Term'), (30, 75), (10, 45), (Decimal('1000'), Decimal('12345'), Decimal('999999')),
+            (Decimal('0'), Decimal('7.5'), Decimal('12.5')), ('annual', 'semi_annual', 'quarterly'),
+        ))
+        batch = PremiumBatch(
+            age=[c[1] for c in cases], sum_assured=[c[3] for c in cases], duration_years=[c[2] for c in cases],
+            policy_type=[c[0] for c in cases], base_multiplier=[Decimal('1.25')] * len(cases),
+            include_adb=[True] * len(cases), adb_percentage=[Decimal('0.15')] * len(cases),
+            include_ptd=[False] * len(cases), ptd_percentage=[Decimal('0.10')] * len(cases),
+            loading_percentage=[c[4] for c in cases], payment_interval=[c[5] for c in cases],
+        )
+        tables = get_rating_tables()
+        for row, (policy_type, age, duration, sum_assured, loading, interval) in enumerate(cases):
+            expected = premium_from_rates(
+                policy_type, sum_assured, tables.mortality_rate(age).rate,
+                tables.duration_factor(policy_type, duration).factor, base_multiplier=Decimal('1.25'),
+                adb_percentage=Decimal('0.15'), loading_percentage=loading,
+                interval_count={'annual': 1, 'semi_annual': 2, 'quarterly': 4}[interval],
+            )
+            self.assertTrue(batch.rated[row])
+            self.assertEqual((batch.annual_premium(row), batch.interval_payment(row)), expected, cases[row])
+
+    def test_rerate_premiums_matches_calculate_premium(self):
+        for number, (birth_year, sum_assured, duration, interval) in enumerate([
+            (1990, Decimal('500000'), 10, 'annual'),
+            (1968, Decimal('123457'), 20, 'quarterly'),
+            (1985, Decimal('1000000'), 45, 'semi_annual'),
+            (2000, Decimal('77777'), 5, 'quarterly'),
+        ], start=1):
+            self.issue(number, date_of_birth=date(birth_year, 3, 1), sum_assured=sum_assured,
+                       duration_years=duration, payment_interval=interval)
+        PremiumPayment.objects.update(annual_premium=0, interval_payment=0)
+
+        call_command('rerate_premiums', stdout=io.StringIO())
+
+        for payment in PremiumPayment.objects.select_related('policy_holder__policy'):
+            self.assertEqual((payment.annual_premium, payment.interval_payment), payment.calculate_premium())
+            self.assertGreater(payment.annual_premium, 0)
+
+
+
+class PremiumRateGridTests(FixtureBook, TestCase):
+    def tables(self, with_rate_grid=True):
+        return RatingTables(current_version(), with_rate_grid=with_rate_grid)
+
+    def test_grid_prices_match_rating_tables(self):
+        self.assertEqual(rebuild_premium_rate_grid(), 1)
+        grid, rates = self.tables(), self.tables(with_rate_grid=False)
+        self.assertEqual(len(grid.rate_grid), (70 - 18 + 1) * 40)
+        self.assertFalse(rates.rate_grid)
+
+        for age, duration, sum_assured, interval, loading in itertools.product(
+            (18, 35, 70), (1, 10, 40), (Decimal('1000'), Decimal('123457')), ('annual', 'quarterly'), (0, Decimal('7.5')),
+        ):
+            self.assertIsNotNone(grid.base_rate(self.policy.pk, age, duration))
+            inputs = (self.policy.pk, age, sum_assured, duration, interval, True, False, loading)
+            self.assertEqual(_quote(grid, *inputs), _quote(rates, *inputs), inputs)
+
+    def test_changed_rates_mark_the_grid_stale(self):
+        rebuild_premium_rate_grid()
+        MortalityRate.objects.update(rate=Decimal('4.50'))
+
+        # A stale grid is ignored until it is rebuilt from the new rates
+        self.assertEqual(self.tables().rate_grid, {})
+        self.assertEqual(rebuild_premium_rate_grid(), 1)
+        self.assertEqual(rebuild_premium_rate_grid(), 0)
+        grid = self.tables()
+        self.assertEqual(
+            grid.base_rate(self.policy.pk, 30, 10),
+            base_rate_from_rates('Endownment', Decimal('4.50'), Decimal('1.10'), self.policy.base_multiplier),
+        )
+
+class PremiumPaymentSaveTests(FixtureBook, TestCase):
+    DERIVED_FIELDS = [
+        'annual_premium', 'interval_payment', 'total_premium', 'total_paid', 'paid_amount', 'vat_amount',
+        'service_tax', 'tds_amount', 'remaining_premium', 'payment_status', 'fine_due', 'next_payment_date',
+        'gsv_value', 'ssv_value',
+    ]
+
+    def setUp(self):
+        self.payments = [self.issue(number).premium_payments.get() for number in (1, 2)]
+
+    def state(self, payment):
+        payment.refresh_from_db()
+        return {field: getattr(payment, field) for field in self.DERIVED_FIELDS}
+
+    def test_payment_save_matches_full_recalculation(self):
+        # Recomputing every derivation on every save was the old behaviour
+        changed, everything = self.payments
+        for payment in self.payments:
+            payment.paid_amount = Decimal('2750.00')
+        changed.save()
+        everything.save(recalculate=True)
+
+        self.assertEqual(self.state(changed), self.state(everything))
+        self.assertEqual(changed.total_paid, Decimal('2750.00'))
+        self.assertEqual(changed.paid_amount, Decimal('0.00'))
+        self.assertEqual(changed.transactions.get().amount, Decimal('2750.00'))
+
+    def test_save_after_ledger_posting_gets_its_own_receipt(self):
+        payment = self.payments[0]
+        posted = post_payment(payment, 100)
+
+        payment = PremiumPayment.objects.get(pk=payment.pk)
+        payment.paid_amount = Decimal('50.00')
+        payment.save()
+
+        saved = payment.transactions.exclude(pk=posted.pk).get()
+        self.assertEqual(saved.amount, Decimal('50.00'))
+        self.assertNotEqual(saved.receipt_number, posted.receipt_number)
+        self.assertEqual(payment.receipt_number, saved.receipt_number)
+        self.assertEqual(payment.total_paid, Decimal('150.00'))
+
+    def test_balance_follows_total_paid(self):
+        payment = self.payments[0]
+        self.assertEqual(payment.changed_fields(), set())
+        payment.total_paid = payment.total_premium
+        self.assertEqual(payment.changed_fields(), {'total_paid'})
+        payment.save()
+
+        self.assertEqual(payment.remaining_premium, Decimal('0.00'))
+        self.assertEqual(payment.payment_status, 'Paid')
+
+    def test_narrow_save_skips_unrelated_derivations(self):
+        payment = self.payments[0]
+        with mock.patch.object(PremiumPayment, 'calculate_premium') as calculate_premium, \
+                mock.patch.object(PremiumPayment, 'calculate_gsv') as calculate_gsv:
+            payment.next_payment_date += timedelta(days=1)
+            payment.save(update_fields=['next_payment_date'])
+            payment.save()
+        calculate_premium.assert_not_called()
+        calculate_gsv.assert_not_called()
+
+
+class PolicyNumberSequenceTests(FixtureBook, TestCase):
+    def setUp(self):
+        sequences._policy_numbers.reset()
+
+    def test_numbers_follow_the_old_format_and_order(self):
+        numbers = [self.issue(number).policy_number for number in (1, 2, 3)]
+        # Company code, branch code and a five digit serial, as the max + 1 lookup produced
+        self.assertEqual(numbers, [1100001, 1100002, 1100003])
+
+    def test_sequence_starts_after_numbers_issued_before_it(self):
+        PolicyHolder.objects.filter(pk=self.issue(1).pk).update(policy_number=1100041)
+        PolicyNumberSequence.objects.all().delete()
+        sequences._policy_numbers.reset()
+
+        self.assertEqual(self.issue(2).policy_number, 1100042)
+
+    def test_rolled_back_block_is_not_lost(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            first = sequences.allocate_policy_numbers(self.company, self.branch)
+            raise IntegrityError
+        self.assertEqual(sequences.allocate_policy_numbers(self.company, self.branch), first)
+
+
+class ReceiptSequenceTests(FixtureBook, TestCase):
+    def setUp(self):
+        sequences._receipt_numbers.reset()
+
+    def test_receipts_are_unique_and_sort_in_issue_order(self):
+        day = date(2026, 1, 5)
+        other_branch = Branch.objects.create(name='B2', branch_code=2, company=self.company)
+
+        issued = [
+            *sequences.allocate_receipt_numbers(self.branch, 3, day),
+            *sequences.allocate_receipt_numbers(self.branch, 2, day),
+        ]
+        self.assertEqual(issued[0], 'RCP-001-20260105-000001')
+        self.assertEqual(issued, sorted(issued))
+        self.assertEqual(len(set(issued)), 5)
+
+        # Each branch and day has its own sequence
+        self.assertEqual(sequences.allocate_receipt_numbers(other_branch, day=day), ['RCP-002-20260105-000001'])
+        self.assertEqual(sequences.allocate_receipt_numbers(self.branch, day=date(2026, 1, 6)), ['RCP-001-20260106-000001'])
+
+    def test_postings_get_distinct_receipts(self):
+        payment = self.issue(1).premium_payments.get()
+        receipts = [post_payment(payment, Decimal('10.00')).receipt_number for _ in range(3)]
+        self.assertEqual(len(set(receipts)), 3)
+        prefix = sequences.receipt_number_prefix(self.branch, timezone.localdate())
+        self.assertTrue(all(receipt.startswith(prefix) for receipt in receipts))
+
+
+class OutboxTests(FixtureBook, TestCase):
+    """Side effects the post-save receivers used to carry out inline now happen once, when drained."""
+
+    def setUp(self):
+        self.agent = SalesAgent.objects.create(
+            branch=self.branch, agent_code='A-1', phone_number='9811111111', commission_rate=Decimal('0.10')
+        )
+
+    def test_side_effects_happen_once(self):
+        holder = self.issue(1, agent=self.agent)
+        self.assertIsNone(holder.user_id)
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.total_policies_sold, 0)
+
+        self.assertEqual(drain(), 2)
+        holder.refresh_from_db()
+        self.agent.refresh_from_db()
+        self.assertEqual(holder.user.username, holder.phone_number)
+        self.assertEqual(self.agent.total_policies_sold, 1)
+        self.assertEqual(self.agent.last_policy_date, holder.start_date)
+
+        holder.premium_payments.get().add_payment(Decimal('2750.00'))
+        self.assertEqual(drain(), 1)
+        self.assertEqual(drain(), 0)
+        self.agent.refresh_from_db()
+        self.assertEqual(self.agent.total_policies_sold, 1)
+        self.assertEqual(self.agent.total_premium_collected, Decimal('2750.00'))
+        commission = Commission.objects.get(agent=self.agent)
+        self.assertEqual(commission.amount, Decimal('275.00'))
+        self.assertEqual(User.objects.filter(username=holder.phone_number).count(), 1)
+
+    def test_failed_event_does_not_hold_up_the_rest(self):
+        publish('no.such.event', {})
+        holder = self.issue(1)
+
+        self.assertEqual(drain(), 1)
+        failed = OutboxEvent.objects.get(event_type='no.such.event')
+        self.assertIsNone(failed.processed_at)
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('no.such.event', failed.last_error)
+        holder.refresh_from_db()
+        self.assertIsNotNone(holder.user_id)
+
+
+class AgentCounterTests(FixtureBook, TestCase):
+    """Sharded agents end up with the same totals as agents updated in place."""
+
+    def sell(self, agent, first_number):
+        for number in range(first_number, first_number + 3):
+            self.issue(number, agent=agent).premium_payments.get().add_payment(Decimal('2750.00'))
+        drain()
+
+    def totals(self, agent):
+        agent = with_sales_totals(SalesAgent.objects.filter(pk=agent.pk)).get()
+        report = add_unrolled_sales(AgentReport.objects.get(agent=agent))
+        return agent.policies_sold_total, agent.premium_collected_total, report.policies_sold, report.total_premium
+
+    def agent_totals(self, agent):
+        agent = with_sales_totals(SalesAgent.objects.filter(pk=agent.pk)).get()
+        return agent.policies_sold_total, agent.premium_collected_total
+
+    def test_sharded_totals_match_unsharded(self):
+        plain = SalesAgent.objects.create(branch=self.branch, agent_code='A-1', phone_number='9811111111')
+        sharded = SalesAgent.objects.create(
+            branch=self.branch, agent_code='A-2', phone_number='9822222222', counter_shards=4
+        )
+        self.sell(plain, 1)
+        self.sell(sharded, 11)
+
+        expected = (3, Decimal('8250.00'), 3, Decimal('8250.00'))
+        self.assertEqual(self.totals(plain), expected)
+        # Readers add the shards before the roll-up, and the roll-up moves them onto the agent
+        self.assertEqual(self.agent_totals(sharded), expected[:2])
+        sharded.refresh_from_db()
+        self.assertEqual(sharded.total_policies_sold, 0)
+        self.assertFalse(AgentReport.objects.filter(agent=sharded).exists())
+
+        self.assertEqual(roll_up_counter_shards(), 1)
+        sharded.refresh_from_db()
+        self.assertEqual((sharded.total_policies_sold, sharded.total_premium_collected), expected[:2])
+        self.assertEqual(self.totals(sharded), expected)
+        self.assertEqual(roll_up_counter_shards(), 0)
+
+        # Both agree with a rebuild from the policies and the ledger
+        self.assertEqual(reconcile_agent_counters(), (0, 0))
+
+    def test_reconcile_repairs_drifted_counters(self):
+        agent = SalesAgent.objects.create(branch=self.branch, agent_code='A-1', phone_number='9811111111')
+        self.sell(agent, 1)
+        SalesAgent.objects.filter(pk=agent.pk).update(total_policies_sold=7)
+        AgentReport.objects.filter(agent=agent).update(total_premium=Decimal('1.00'))
+
+        self.assertEqual(reconcile_agent_counters(dry_run=True), (1, 1))
+        self.assertEqual(self.agent_totals(agent)[0], 7)
+        self.assertEqual(reconcile_agent_counters(), (1, 1))
+        self.assertEqual(self.totals(agent), (3, Decimal('8250.00'), 3, Decimal('8250.00')))
+
+
+class AnniversaryBonusTests(FixtureBook, TestCase):
+    """The batch bonus credit matches Bonus.update_anniversary_bonus run holder by holder."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Bonuses are only paid on the 'Endowment' spelling, which premiums are not rated for
+        cls.policy = InsurancePolicy.objects.create(
+            name='With profits', policy_type='Endowment', base_multiplier=Decimal('1.25'),
+            min_sum_assured=Decimal('1000'), max_sum_assured=Decimal('10000000'),
+        )
+        BonusRate.objects.create(policy_type='Endowment', min_year=1, max_year=9, bonus_per_thousand=Decimal('40.00'))
+
+    def started(self, years, days_since_anniversary):
+        """A start date ``years`` before an anniversary ``days_since_anniversary`` days ago."""
+        anniversary = date.today() - timedelta(days=days_since_anniversary)
+        return anniversary_in(anniversary, anniversary.year - years)
+
+    def credited(self, holder):
+        bonus = holder.bonuses.get()
+        history = list(holder.bonus_history.values_list('policy_year', 'bonus_amount', 'bonus_rate'))
+        return bonus.accrued_amount, bonus.last_anniversary_processed, history
+
+    def test_matches_per_holder_update(self):
+        start_date = self.started(3, 5)
+        batch, single = self.issue(1, start_date=start_date), self.issue(2, start_date=start_date)
+
+        Bonus.objects.create(policy_holder=single, start_date=single.start_date).update_anniversary_bonus()
+        self.assertEqual(accrue_anniversary_bonuses([batch]), 1)
+
+        self.assertEqual(self.credited(batch), self.credited(single))
+        self.assertEqual(self.credited(batch)[0], Decimal('20000.00'))
+        # An anniversary is only credited once
+        self.assertEqual(accrue_anniversary_bonuses([batch]), 0)
+        self.assertEqual(self.credited(batch), self.credited(single))
+
+    def test_skips_first_year_and_stale_anniversaries(self):
+        first_year = self.issue(1, start_date=self.started(0, 5))
+        stale = self.issue(2, start_date=self.started(3, BONUS_CATCH_UP_DAYS + 1))
+
+        self.assertEqual(accrue_anniversary_bonuses([first_year, stale]), 0)
+        self.assertFalse(Bonus.objects.exists())
+
+
+class MaintenanceCheckpointTests(FixtureBook, TestCase):
+    """A failed maintenance run resumes from its checkpoint and ends as one straight run would."""
+
+    def setUp(self):
+        self.payments = [
+            self.issue(number, start_date=date.today() - timedelta(days=200), payment_interval='quarterly')
+            .premium_payments.get()
+            for number in range(1, 4)
+        ]
+
+    def run_fines(self, **options):
+        call_command('update_premium_fines', chunk_size=1, stdout=io.StringIO(), **options)
+
+    def test_resume_after_failed_chunk(self):
+        handle_chunk = UpdatePremiumFines.handle_chunk
+        chunks = []
+
+        def fail_second_chunk(command, policy_holders, as_of_date, **options):
+            chunks.append(policy_holders)
+            if len(chunks) == 2:
+                raise RuntimeError('chunk failed')
+            return handle_chunk(command, policy_holders, as_of_date, **options)
+
+        with mock.patch.object(UpdatePremiumFines, 'handle_chunk', fail_second_chunk):
+            with self.assertRaises(RuntimeError):
+                self.run_fines()
+
+        run = BatchJobRun.objects.get(job_name='update_premium_fines')
+        self.assertEqual(run.status, 'Failed')
+        self.assertEqual(run.last_key, self.payments[0].policy_holder_id)
+        self.assertEqual(run.counts, {'updated': 1, 'fines_added': 1})
+        fines = [PremiumPayment.objects.get(pk=payment.pk).fine_due for payment in self.payments]
+        self.assertGreater(fines[0], 0)
+        self.assertEqual(fines[1:], [Decimal('0.00')] * 2)
+
+        self.run_fines(resume=True)
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'Completed')
+        self.assertEqual(run.last_key, self.payments[-1].policy_holder_id)
+        self.assertEqual(run.counts, {'updated': 3, 'fines_added': 3})
+        for payment in self.payments:
+            payment.refresh_from_db()
+            self.assertEqual(payment.fine_due, payment.calculate_fine())
+
+        # A shard completed today is not run again
+        self.run_fines(resume=True)
+        self.assertEqual(BatchJobRun.objects.count(), 1)
+        self.assertEqual(BatchJobRun.objects.get().counts, run.counts)
+
+
+class InlineExecutor:
+    """Stands in for ProcessPoolExecutor, running each submitted shard in this process."""
+
+    def __init__(self, max_workers, initializer):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class ShardedCommandTests(FixtureBook, TestCase):
+    def setUp(self):
+        self.payments = [
+            self.issue(number, start_date=date.today() - timedelta(days=200), payment_interval='quarterly')
+            .premium_payments.get()
+            for number in range(1, 6)
+        ]
+
+    def test_parse_shard_rejects_bad_input(self):
+        self.assertEqual(parse_shard('1/4'), (1, 4))
+        for value in ('', '1', '1/', 'a/4', '1/4/2', '1.5/4', '4/4', '-1/4', '0/0'):
+            with self.subTest(value=value), self.assertRaises(argparse.ArgumentTypeError):
+                parse_shard(value)
+
+    def test_shards_cover_the_book_once(self):
+        policy_holders = PolicyHolder.objects.all()
+        book = set(policy_holders.values_list('pk', flat=True))
+        for count in (1, 2, 3, 7):
+            shards = [set(in_shard(policy_holders, (index, count)).values_list('pk', flat=True))
+                      for index in range(count)]
+            self.assertEqual(sum(len(shard) for shard in shards), len(book), count)
+            self.assertEqual(set().union(*shards), book, count)
+
+    def test_workers_counts_are_merged(self):
+        # Workers run in this process; closing the connections would end the test transaction
+        with mock.patch('app.management.base.ProcessPoolExecutor', InlineExecutor), \
+                mock.patch('app.management.base.connections'), \
+                mock.patch.object(UpdatePremiumFines, 'report') as report:
+            call_command('update_premium_fines', workers=3, chunk_size=1, stdout=io.StringIO())
+
+        runs = BatchJobRun.objects.filter(job_name='update_premium_fines').order_by('shard')
+        self.assertEqual([run.shard for run in runs], ['0/3', '1/3', '2/3'])
+        self.assertTrue(all(run.counts['updated'] for run in runs))
+        self.assertEqual(report.call_args.args[0], {'updated': 5, 'fines_added': 5})
+        for payment in self.payments:
+            payment.refresh_from_db()
+            self.assertEqual(payment.fine_due, payment.calculate_fine())
+
+
+class PolicyLapseTests(FixtureBook, TestCase):
+    """check_policy_expiry leaves the book as checking each unpaid premium in turn did."""
+
+    def lapsing(self, number, *days_ago):
+        """A holder with an unpaid premium due ``days_ago`` days ago for each value given."""
+        holder = self.issue(number, start_date=date.today() - timedelta(days=1190))
+        for _ in days_ago[1:]:
+            PremiumPayment.objects.create(policy_holder=holder)
+        for payment, days in zip(holder.premium_payments.order_by('id'), days_ago):
+            PremiumPayment.objects.filter(pk=payment.pk).update(next_payment_date=date.today() - timedelta(days=days))
+        return holder
+
+    def surrender(self, holder):
+        return holder.surrender_requests.values(
+            'surrender_type', 'status', 'approval_date', 'gsv_amount', 'ssv_amount', 'outstanding_loans',
+            'processing_fee', 'tax_deduction', 'surrender_amount',
+        ).get()
+
+    def payment_statuses(self, holder):
+        return list(holder.premium_payments.order_by('id').values_list('payment_status', flat=True))
+
+    def test_matches_per_premium_check(self):
+        lapsed = self.lapsing(1, 1100)
+        overdue, checked_alone = self.lapsing(2, 1100, 100), self.lapsing(3, 1100, 100)
+        current = self.lapsing(4, 100)
+
+        # What the command used to do for each unpaid premium past the threshold
+        payment = checked_alone.premium_payments.order_by('id').first()
+        self.assertTrue(payment.check_policy_expiry())
+        payment.save(update_fields=['payment_status'])
+
+        call_command('check_policy_expiry', stdout=io.StringIO())
+        self.assertEqual(BatchJobRun.objects.get(job_name='check_policy_expiry').counts, {'checked': 2, 'expired': 2})
+
+        for holder in (lapsed, overdue, checked_alone, current):
+            holder.refresh_from_db()
+        self.assertEqual(lapsed.status, 'Expired')
+        self.assertEqual(self.payment_statuses(lapsed), ['Expired'])
+        self.assertFalse(lapsed.surrender_requests.exists())
+
+        self.assertEqual(overdue.status, checked_alone.status)
+        self.assertEqual(overdue.status, 'Surrendered')
+        self.assertEqual(self.payment_statuses(overdue), self.payment_statuses(checked_alone))
+        self.assertEqual(self.surrender(overdue), self.surrender(checked_alone))
+
+        self.assertEqual(current.status, 'Active')
+        self.assertFalse(current.surrender_requests.exists())
+
+
+class PremiumFineTests(FixtureBook, TestCase):
+    """The column-wise fines match PremiumPayment.calculate_fine row by row."""
+
+    def test_fine_batch_matches_decimal_formula(self):
+        instalments = [Decimal(v) for v in ('0.01', '1.50', '333.33', '1234.57', '2750.00', '3000.00', '98765.43')]
+        rows = [
+            (instalment, days_late)
+            for instalment in instalments
+            for days_late in itertools.chain(range(0, 40), range(40, 1200, 37))
+        ]
+        today = date(2026, 1, 5)
+        batch = FineBatch(
+            [today - timedelta(days=days_late) for _, days_late in rows] + [None],
+            [instalment for instalment, _ in rows] + [Decimal('2750.00')],
+            today,
+        )
+        for row, (instalment, days_late) in enumerate(rows):
+            self.assertEqual(batch.fine(row), fine_for_days_late(instalment, days_late), (instalment, days_late))
+        self.assertEqual(batch.fine(len(rows)), Decimal('0.00'))
+
+    def test_command_matches_per_payment_update(self):
+        start_date = date.today() - timedelta(days=200)
+        late, undated, undated_not_due, paid = (
+            self.issue(number, start_date=start_date, payment_interval=interval).premium_payments.get()
+            for number, interval in enumerate(['quarterly', 'quarterly', 'annual', 'quarterly'], start=1)
+        )
+        PremiumPayment.objects.filter(pk__in=[undated.pk, undated_not_due.pk]).update(next_payment_date=None)
+        PremiumPayment.objects.filter(pk=paid.pk).update(payment_status='Paid')
+
+        # What the command used to work out for each payment it saved
+        late.refresh_from_db()
+        undated.next_payment_date = add_months(start_date, 3)
+        expected = {
+            late.pk: (late.calculate_fine(), late.next_payment_date),
+            undated.pk: (undated.calculate_fine(), undated.next_payment_date),
+            undated_not_due.pk: (Decimal('0.00'), None),
+            paid.pk: (Decimal('0.00'), add_months(start_date, 3)),
+        }
+        self.assertGreater(expected[late.pk][0], 0)
+        self.assertGreater(expected[undated.pk][0], 0)
+
+        call_command('update_premium_fines', stdout=io.StringIO())
+        updated = {
+            pk: (fine_due, next_payment_date)
+            for pk, fine_due, next_payment_date in PremiumPayment.objects.values_list('pk', 'fine_due', 'next_payment_date')
+        }
+        self.assertEqual(updated, expected)
+        self.assertEqual(BatchJobRun.objects.get(job_name='update_premium_fines').counts, {'updated': 3, 'fines_added': 2})
+
+
+def per_loan_interest(remaining_balance, interest_rate, days):
+    """Interest as Loan.accrue_interest worked it out for one loan before the ledger."""
+    daily_rate = interest_rate / 100 / 365
+    return (remaining_balance * Decimal(daily_rate) * Decimal(days)).quantize(Decimal('1.00'))
+
+
+class LoanInterestLedgerTests(FixtureBook, TestCase):
+    def test_integer_interest_matches_decimal(self):
+        for balance, rate, days in itertools.product(
+            (Decimal('0.01'), Decimal('999.99'), Decimal('10000.00'), Decimal('123456.78'), Decimal('7300.00')),
+            (Decimal('0.50'), Decimal('8.00'), Decimal('10.00'), Decimal('12.75')),
+            (1, 2, 30, 31, 365, 400),
+        ):
+            self.assertEqual(
+                cents_to_decimal(interest_paisa(balance, rate, days)), per_loan_interest(balance, rate, days),
+                (balance, rate, days),
+            )
+
+    def test_accrual_matches_per_loan_path(self):
+        holder = self.issue(1)
+        terms = [
+            (Decimal('10000.00'), Decimal('12.00'), 30, 'Active'),
+            (Decimal('2500.50'), Decimal('9.50'), 1, 'Active'),
+            (Decimal('123456.78'), Decimal('10.00'), 400, 'Active'),
+            (Decimal('5000.00'), Decimal('10.00'), 0, 'Active'),
+            (Decimal('5000.00'), Decimal('10.00'), 30, 'Paid'),
+        ]
+        loans = Loan.objects.bulk_create([
+            Loan(policy_holder=holder, loan_amount=balance, remaining_balance=balance, interest_rate=rate,
+                 accrued_interest=Decimal('1.00'), loan_status=status)
+            for balance, rate, _, status in terms
+        ])
+        for loan, (_, _, days, _) in zip(loans, terms):
+            Loan.objects.filter(pk=loan.pk).update(last_interest_date=date.today() - timedelta(days=days))
+
+        self.assertEqual(accrue_loan_interest(chunk_size=2), 3)
+        for loan, (balance, rate, days, status) in zip(loans, terms):
+            loan.refresh_from_db()
+            accrued = per_loan_interest(balance, rate, days) if status == 'Active' else Decimal('0.00')
+            self.assertEqual(loan.accrued_interest, Decimal('1.00') + accrued, (balance, rate, days, status))
+            ledger = list(loan.interest_accruals.values_list('days', 'principal', 'amount'))
+            self.assertEqual(ledger, [(days, balance, accrued)] if status == 'Active' and days else [])
+
+        # Loans already accrued today are left alone
+        self.assertEqual(accrue_loan_interest(), 0)
+        self.assertEqual(LoanInterestAccrual.objects.count(), 3)
+
+
+class MaintenanceBook(FixtureBook):
+    """A book with something for every maintenance job to do today."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.bonus_policy = InsurancePolicy.objects.create(
+            name='With profits', policy_type='Endowment', base_multiplier=Decimal('1.25'),
+            min_sum_assured=Decimal('1000'), max_sum_assured=Decimal('10000000'),
+        )
+        BonusRate.objects.create(policy_type='Endowment', min_year=1, max_year=9, bonus_per_thousand=Decimal('40.00'))
+
+    def setUp(self):
+        today = date.today()
+        # A fine to charge, with a loan to accrue interest on
+        late = self.issue(1, start_date=today - timedelta(days=200), payment_interval='quarterly')
+        loan = Loan.objects.bulk_create([Loan(
+            policy_holder=late, loan_amount=Decimal('10000.00'), remaining_balance=Decimal('10000.00'),
+            interest_rate=Decimal('12.00'),
+        )])[0]
+        Loan.objects.filter(pk=loan.pk).update(last_interest_date=today - timedelta(days=30))
+
+        # One policy to expire and one to surrender for non-payment
+        lapsed = self.issue(2, start_date=today - timedelta(days=1190))
+        surrendering = self.issue(3, start_date=today - timedelta(days=1190))
+        PremiumPayment.objects.create(policy_holder=surrendering)
+        first_payments = [lapsed.premium_payments.get().pk, surrendering.premium_payments.order_by('id')[0].pk]
+        PremiumPayment.objects.filter(pk__in=first_payments).update(next_payment_date=today - timedelta(days=1100))
+        PremiumPayment.objects.filter(policy_holder=surrendering).exclude(pk__in=first_payments).update(
+            next_payment_date=today - timedelta(days=100)
+        )
+
+        # A renewal to raise and one whose grace period has passed
+        maturing, unrenewed = self.issue(4), self.issue(5)
+        PolicyHolder.objects.filter(pk=maturing.pk).update(maturity_date=today + timedelta(days=20))
+        # Saved while its grace period was still running
+        PolicyRenewal.objects.bulk_create([PolicyRenewal(
+            policy_holder=unrenewed, due_date=today - timedelta(days=40), grace_period_end=today - timedelta(days=10),
+            renewal_amount=5,
+        )])
+
+        # An anniversary bonus to credit
+        anniversary = today - timedelta(days=5)
+        self.issue(6, policy=self.bonus_policy, start_date=anniversary_in(anniversary, anniversary.year - 3))
+
+    def book_state(self):
+        return {
+            'holders': list(PolicyHolder.objects.order_by('pk').values_list('pk', 'status', 'payment_status')),
+            'payments': list(PremiumPayment.objects.order_by('pk').values_list(
+                'pk', 'payment_status', 'fine_due', 'next_payment_date'
+            )),
+            'loans': list(Loan.objects.order_by('pk').values_list('pk', 'accrued_interest', 'last_interest_date')),
+            'bonuses': list(Bonus.objects.order_by('policy_holder_id').values_list(
+                'policy_holder_id', 'accrued_amount', 'last_anniversary_processed'
+            )),
+            'renewals': list(PolicyRenewal.objects.order_by('policy_holder_id', 'due_date').values_list(
+                'policy_holder_id', 'due_date', 'status', 'renewal_amount'
+            )),
+            'surrenders': list(PolicySurrender.objects.order_by('policy_holder_id').values_list(
+                'policy_holder_id', 'status', 'surrender_amount'
+            )),
+        }
+
+    def state_after_every_job(self):
+        """The book after each maintenance job runs on its own over the whole book, then rolled back."""
+        with transaction.atomic():
+            call_command('update_premium_fines', stdout=io.StringIO())
+            accrue_loan_interest()
+            call_command('check_policy_expiry', stdout=io.StringIO())
+            call_command('update_bonuses', stdout=io.StringIO())
+            check_renewals(PolicyHolder.objects.all(), date.today())
+            state = self.book_state()
+            transaction.set_rollback(True)
+        return state
+
+
+class NightlyMaintenanceTests(MaintenanceBook, TestCase):
+    def test_chord_matches_running_every_job(self):
+        from .tasks import run_nightly_maintenance
+
+        expected = self.state_after_every_job()
+        # Every job has something to change
+        before = self.book_state()
+        for name in expected:
+            self.assertNotEqual(expected[name], before[name], name)
+
+        # Chunks and the chord callback run in this process
+        self.addCleanup(setattr, current_app.conf, 'task_always_eager', current_app.conf.task_always_eager)
+        current_app.conf.task_always_eager = True
+        run_id = run_nightly_maintenance(chunk_size=2)
+        self.assertEqual(self.book_state(), expected)
+
+        run = BatchJobRun.objects.get(pk=run_id)
+        self.assertEqual(run.status, 'Completed')
+        self.assertEqual(run.counts['check_policy_expiry'], {'checked': 2, 'expired': 2})
+        self.assertEqual(run.counts['accrue_loan_interest'], {'accrued': 1})
+        self.assertEqual(run.counts['check_renewals'], {'renewals_created': 1, 'renewals_expired': 1})
+        # The lease is given back, and the run is not repeated the same day
+        acquire_lease(MAINTENANCE_LEASE).release()
+        self.assertIsNone(run_nightly_maintenance())
+
+
+class PolicyEventRunnerTests(MaintenanceBook, TestCase):
+    def test_due_events_match_running_every_job(self):
+        expected = self.state_after_every_job()
+
+        plan_policy_events(PolicyHolder.objects.values_list('pk', flat=True))
+        summary = run_due_events()
+        # Interest is accrued by its own daily task rather than by events
+        accrue_loan_interest()
+        self.assertEqual(self.book_state(), expected)
+        self.assertEqual(set(summary), {'Grace End', 'Lapse', 'Anniversary', 'Renewal Reminder'})
+
+        self.assertFalse(PolicyEvent.objects.filter(status='Pending', due_date__lte=date.today()).exists())
+        # Nothing done today falls due again tomorrow
+        self.assertEqual(run_due_events(date.today() + timedelta(days=1)), {})
+
+    def test_saves_after_a_run_do_not_bring_back_its_events(self):
+        today = date.today()
+        late, anniversary = PolicyHolder.objects.get(last_name='L1'), PolicyHolder.objects.get(last_name='L6')
+        with self.captureOnCommitCallbacks(execute=True):
+            plan_policy_events(PolicyHolder.objects.values_list('pk', flat=True))
+        self.assertTrue(late.events.filter(event_type='Grace End', due_date=today).exists())
+        self.assertTrue(anniversary.events.filter(event_type='Anniversary', due_date=today).exists())
+        run_due_events()
+
+        # A payment, a pipeline save and a bulk block each plan the holders again from today
+        with self.captureOnCommitCallbacks(execute=True):
+            post_payment(late.premium_payments.get(), 10)
+        with self.captureOnCommitCallbacks(execute=True):
+            anniversary.status = 'Pending'
+            anniversary.save()
+            anniversary.status = 'Active'
+            anniversary.save()
+        with self.captureOnCommitCallbacks(execute=True), bulk_mode():
+            for holder in (late, anniversary):
+                holder.duration_years += 1
+                holder.save()
+
+        self.assertFalse(PolicyEvent.objects.filter(status='Pending', due_date__lte=today).exists())
+        self.assertEqual(anniversary.events.get(status='Pending', event_type='Anniversary').due_date,
+                         anniversary_in(anniversary.start_date, today.year + 1))
 
-# Create your tests here.
+    def test_start_date_is_not_an_anniversary(self):
+        holder = self.issue(7, start_date=date.today())
+        plan_policy_events([holder.pk])
+        self.assertEqual(holder.events.get(event_type='Anniversary').due_date,
+                         anniversary_in(holder.start_date, holder.start_date.year + 1))
@@ -35,6 +35,10 @@ urlpatterns = [
     path('policyholders/<int:id>/delete', views.deletePolicyHolder, name='deletePolicyHolder'),
     path('policyholders/branch/<int:branchId>', views.policyHoldersByBranch, name='policyHoldersByBranch'),
 
+    # Premium Quotes
+    path('quote', views.premiumQuote, name='premiumQuote'),
+    path('quote/matrix', views.premiumQuoteMatrix, name='premiumQuoteMatrix'),
+
     # Claims
     path('claims', views.getAllClaims, name='getAllClaims'),
     path('claims/create', views.createClaimRequest, name='createClaimRequest'),
@@ -69,6 +73,7 @@ urlpatterns = [
     path('payments/due/<str:dueDate>', views.premiumPaymentsDue, name='premiumPaymentsDue'),
     path('payments/status/<str:status>', views.paymentProcessingByStatus, name='paymentProcessingByStatus'),
     path('payments/<int:payment_id>/pay', views.markPaymentAsPaid, name='markPaymentAsPaid'),
+    path('payments/import', views.importPayments, name='importPayments'),
 
 
     # Underwriting
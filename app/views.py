@@ -2,18 +2,26 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, redirect
 from django.db.models import Q, Prefetch
 from django.contrib import messages
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 from .serializers import *
 from .models import *
+from .quotes import quote_premium, quote_matrix, quote_for_policy_holder
+from .payments import PaymentLockTimeout
+from .agent_counters import with_sales_totals
+from .payment_import import FILE_FORMATS, IMPORT_CHUNK_SIZE, detect_format, import_payments, read_payment_rows
 from .frontend_data import Dashboard, MortalityRateGeneratorForm, MortalityRateBulkForm
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, FileResponse
+import io
+import tempfile
 from django.contrib.admin import site
 
 
@@ -147,21 +155,95 @@ def policyHolderDetails(request, id):
                 PolicyHolder.objects.filter(company=request.user.company), id=id
             )
 
-        # Perform premium calculations
+        # Quote the premium from the cached rating tables; nothing is saved
         if holder.policy:
-            premium_payment = PremiumPayment(policy_holder=holder)
-            _, loaded_annual_premium, interval_payment = premium_payment.calculate_premium()
+            quote = quote_for_policy_holder(holder) or {}
 
             response_data = PolicyHolderSerializer(holder).data
             response_data.update({
-                "loaded_annual_premium": float(loaded_annual_premium),
-                "interval_payment": float(interval_payment),
+                "loaded_annual_premium": float(quote.get('annual_premium', 0)),
+                "interval_payment": float(quote.get('interval_payment', 0)),
             })
             return Response(response_data)
         else:
             return Response({"error": "PolicyHolder has no associated policy."}, status=400)
     except PolicyHolder.DoesNotExist:
         return Response({"error": "PolicyHolder not found."}, status=404)
+    except ValidationError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def premiumQuote(request):
+    """Price a prospective policy without creating a holder or payment."""
+    data = request.data if request.method == 'POST' else request.query_params
+    serializer = PremiumQuoteSerializer(data=data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # Insurance policies are products offered to every branch, so any user may quote them
+    params = serializer.validated_data
+    policy = params['policy']
+
+    try:
+        quote = quote_premium(
+            policy.pk,
+            params['age'],
+            params['sum_assured'],
+            params['duration_years'],
+            params['payment_interval'],
+            include_adb=params['include_adb'],
+            include_ptd=params['include_ptd'],
+            loading_percentage=params['loading_percentage'],
+        )
+    except ValidationError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    if quote is None:
+        return Response(
+            {"error": "No mortality rate or duration factor covers this age and duration."},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    return Response({
+        "policy": policy.pk,
+        "age": params['age'],
+        "sum_assured": params['sum_assured'],
+        "duration_years": params['duration_years'],
+        "payment_interval": params['payment_interval'],
+        **quote,
+    })
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def premiumQuoteMatrix(request):
+    """Price every duration / sum assured / interval combination for one applicant."""
+    data = request.data if request.method == 'POST' else request.query_params
+    serializer = PremiumQuoteMatrixSerializer(data=data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # Insurance policies are products offered to every branch, so any user may quote them
+    params = serializer.validated_data
+    policy = params['policy']
+
+    matrix = quote_matrix(
+        policy.pk,
+        params['age'],
+        params['durations'],
+        params['sums_assured'],
+        params['payment_intervals'],
+        include_adb=params['include_adb'],
+        include_ptd=params['include_ptd'],
+        loading_percentage=params['loading_percentage'],
+    )
+    return Response({
+        "policy": policy.pk,
+        "age": params['age'],
+        "durations": params['durations'],
+        "sums_assured": params['sums_assured'],
+        "payment_intervals": params['payment_intervals'],
+        "quotes": matrix,
+    })
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
@@ -317,12 +399,12 @@ def deleteAgent(request, id):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def salesAgentsWithPolicies(request):
-    agents = SalesAgent.objects.all()
+    agents = with_sales_totals(SalesAgent.objects.all())
     data = [{
         "id": agent.id,
         "firstName": agent.first_name,
         "lastName": agent.last_name,
-        "totalPoliciesSold": agent.total_policies_sold,
+        "totalPoliciesSold": agent.policies_sold_total,
     } for agent in agents]
     return Response(data)
 
@@ -581,13 +663,48 @@ def deleteCompany(request, id):
 def markPaymentAsPaid(request, payment_id):
     payment = get_object_or_404(PremiumPayment, id=payment_id)
     data = request.data
-    amount_paid = Decimal(data.get('amount_paid', 0))
+    try:
+        amount_paid = Decimal(str(data.get('amount_paid', 0)))
+    except InvalidOperation:
+        amount_paid = None
+    if amount_paid is None or not amount_paid.is_finite():
+        return Response({'error': 'Payment amount must be a number.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    payment.total_paid += amount_paid
-    payment.status = "Paid" if payment.total_paid >= payment.annual_premium else "Partially Paid"
-    payment.save()
+    try:
+        # Same checks as every other payment: full premium, no overpayment, fines
+        payment.add_payment(amount_paid)
+    except ValidationError as e:
+        return Response({'error': '; '.join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+    except PaymentLockTimeout as e:
+        return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
     return Response(PremiumPaymentSerializer(payment).data)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def importPayments(request):
+    """Post a bank collection file (CSV or JSON lines) and return the per-row results as CSV."""
+    upload = request.FILES.get('file')
+    if upload is None:
+        return Response({'error': 'Upload the collection file as "file".'}, status=status.HTTP_400_BAD_REQUEST)
+    file_format = request.data.get('format') or detect_format(upload.name)
+    if file_format not in FILE_FORMATS:
+        return Response({'error': f'Unsupported format "{file_format}".'}, status=status.HTTP_400_BAD_REQUEST)
+
+    premium_payments = PremiumPayment.objects.all()
+    if not request.user.is_superuser:
+        premium_payments = premium_payments.filter(policy_holder__company=request.user.company)
+
+    # Stream rows from the upload and results to disk so memory stays flat for large files
+    source = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+    results = tempfile.TemporaryFile(mode='w+b')
+    results_text = io.TextIOWrapper(results, encoding='utf-8', newline='')
+    import_payments(read_payment_rows(source, file_format), results_text, IMPORT_CHUNK_SIZE, premium_payments)
+    results_text.flush()
+    results_text.detach()
+    results.seek(0)
+    return FileResponse(results, as_attachment=True, filename='payment_import_results.csv',
+                        content_type='text/csv')
+
 
 
 # html api view
@@ -662,17 +779,18 @@ def manage_mortality_rates(request):
             
             if bulk_form.is_valid():
                 try:
-                    # Clear existing rates if needed
-                    MortalityRate.objects.all().delete()
-                    
-                    # Create new rates
-                    for i, range_data in enumerate(age_ranges):
-                        rate_value = bulk_form.cleaned_data[f'rate_{i}']
-                        MortalityRate.objects.create(
-                            age_group_start=range_data['start'],
-                            age_group_end=range_data['end'],
-                            rate=rate_value
-                        )
+                    # Publish the new rates as a new version, which is in force from today
+                    RatingTableVersion.publish(
+                        f"Mortality rates {timezone.now():%Y-%m-%d %H:%M}",
+                        {MortalityRate: [
+                            MortalityRate(
+                                age_group_start=range_data['start'],
+                                age_group_end=range_data['end'],
+                                rate=bulk_form.cleaned_data[f'rate_{i}']
+                            )
+                            for i, range_data in enumerate(age_ranges)
+                        ]},
+                    )
                     messages.success(request, 'Mortality rates have been updated successfully.')
                     return redirect('admin:index')
                 except Exception as e:
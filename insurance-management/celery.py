@@ -15,22 +15,34 @@ app.autodiscover_tasks()
 
 # Configure the periodic tasks
 app.conf.beat_schedule = {
-    'apply-premium-fines-daily': {
-        'task': 'app.tasks.apply_premium_fines',
-        'schedule': crontab(hour=0, minute=0),  # Run at midnight every day
+    'run-policy-events-daily': {
+        'task': 'app.tasks.run_policy_events',
+        'schedule': crontab(hour=0, minute=0),  # Fines, lapses, bonuses, maturities and renewals due today
     },
-    'accrue-loan-interest-daily': {
-        'task': 'app.tasks.accrue_loan_interest',
-        'schedule': crontab(hour=1, minute=0),  # Run at 1 AM every day
+    'run-nightly-maintenance': {
+        'task': 'app.tasks.run_nightly_maintenance',
+        'schedule': crontab(hour=1, minute=0, day_of_week=0),  # Full sweep of the book on Sundays
     },
-    'check-policy-anniversaries': {
-        'task': 'app.tasks.check_policy_anniversaries',
-        'schedule': crontab(hour=2, minute=0),  # Run at 2 AM every day
+    'accrue-loan-interest-daily': {
+        'task': 'app.tasks.calculate_loan_interest',
+        'schedule': crontab(hour=0, minute=10),  # Interest is charged on each day's balance
     },
     'check-policy-expiration': {
-        'task': 'app.tasks.check_policy_expiration',
+        'task': 'app.tasks.check_policy_expirations',
         'schedule': crontab(hour=3, minute=0),  # Run at 3 AM every day
     },
+    'rebuild-premium-rate-grid-daily': {
+        'task': 'app.tasks.rebuild_rate_grid',
+        'schedule': crontab(hour=0, minute=5),  # Pick up rating versions taking effect today
+    },
+    'drain-outbox': {
+        'task': 'app.tasks.drain_outbox',
+        'schedule': crontab(),  # Every minute, for events whose drain could not be queued
+    },
+    'roll-up-agent-counters': {
+        'task': 'app.tasks.roll_up_agent_counters',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes, for sharded agents
+    },
     'send-payment-reminders': {
         'task': 'app.tasks.send_payment_reminders',
         'schedule': crontab(hour=9, minute=0),  # Run at 9 AM every day